@@ -1,12 +1,72 @@
+import asyncio
+import base64
+import cProfile
+import functools
+import gzip
+import http.client
+import io
+import json
 import logging
 import os
+import pstats
+import random
+import re
+import socket
+import ssl
+import stat
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
 
 from shlex import split as shlex_split
-from typing import List, NamedTuple, Optional, Any, Sequence
+from typing import List, NamedTuple, Optional, Any, Sequence, Tuple
+from urllib.parse import urljoin, urlsplit
+from urllib.request import getproxies, proxy_bypass
+
+from pepper import Pepper
+from pepper.exceptions import PepperException
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 log = logging.getLogger(__name__)
 
+# errors reading a compressed response body
+DECODING_ERRORS = (OSError, EOFError, zlib.error, http.client.HTTPException)
+
+# bytes of a response body read at once
+READ_SIZE = 65536
+
+# profilers which can be enabled with SALT_PLUGIN_PROFILE
+PROFILERS = ('cpu', 'memory')
+
+# number of functions and allocation sites listed in a profile report
+PROFILE_TOP = 25
+
+# characters of a payload shown in debug logs
+PREVIEW_SIZE = 256
+
+# request bodies smaller than this many bytes are not worth compressing
+COMPRESS_MIN_SIZE = 1024
+
+# name of the library encoding and decoding JSON
+JSON_CODEC = 'json' if orjson is None else 'orjson'
+
+# characters escaped in the JSON output, as by the json module: non-ASCII
+# characters and DEL, control characters are escaped by both libraries
+NON_ASCII = re.compile(r'[^\x00-\x7e]')
+
+# ends of the floats in the output of orjson, which writes some floats in
+# another notation than the json module, e.g. 1e-7 or 0.00001 for 1e-07 or
+# 1e-05; two patterns, as patterns with a literal prefix are searched fastest
+FLOAT_FRACTION = re.compile(r'\.\d+(?:[,\]}]|":)')
+FLOAT_EXPONENT = re.compile(r'e-?\d+(?:[,\]}]|":)')
+
 
 def str_to_bool(string: str) -> Optional[bool]:
     """
@@ -50,6 +110,248 @@ class DataItem(NamedTuple):
     data_type: str
 
 
+def _escape_non_ascii(match) -> str:
+    """
+    Return the JSON escape sequence of a matched character.
+    """
+    code = ord(match.group())
+    if code > 0xffff:
+        # characters beyond the basic plane are escaped as surrogate pair
+        code -= 0x10000
+        return '\\u%04x\\u%04x' % (0xd800 | code >> 10, 0xdc00 | code & 0x3ff)
+    return '\\u%04x' % code
+
+
+def json_dumps(value: Any, sort_keys: bool = False) -> str:
+    """
+    Serialize a value to compact, ASCII-only JSON, with orjson if installed.
+
+    The output is identical to json.dumps(value, separators=(',', ':')).
+    Non-ASCII characters are escaped, so the output can be written in any
+    locale Rundeck runs the plugin with. Documents with floats are written
+    with the json module, as orjson writes some floats in another notation.
+    Non-finite floats are not valid JSON and may differ.
+
+    :param value: The value to serialize.
+    :param sort_keys: Whether to sort the keys of dictionaries.
+
+    :returns: The JSON document.
+    """
+    # the patterns of the floats need a separator after them, which a float
+    # as document lacks
+    if orjson is not None and not isinstance(value, float):
+        try:
+            option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+            content = orjson.dumps(value, option=option).decode('utf-8')
+        except orjson.JSONEncodeError:
+            # e.g. integers exceeding 64 bit, handled by the json module
+            pass
+        else:
+            # a match within a string only costs writing it with the json module
+            if isinstance(value, str) or not (FLOAT_FRACTION.search(content) or FLOAT_EXPONENT.search(content)):
+                if content.isascii() and '\x7f' not in content:
+                    return content
+                # non-ASCII characters only occur within strings of the document
+                return NON_ASCII.sub(_escape_non_ascii, content)
+
+    return json.dumps(value, separators=(',', ':'), sort_keys=sort_keys)
+
+
+def json_loads(content) -> Any:
+    """
+    Parse a JSON document, with orjson if installed.
+
+    :param content: The JSON document as bytes or str.
+
+    :returns: The parsed value.
+
+    :raises ValueError: If the document is not valid JSON.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # e.g. integers exceeding 64 bit or NaN, handled by the json module
+            pass
+
+    return json.loads(content)
+
+
+class Preview:
+    """
+    Size-capped preview of a payload, such as a low state or a response, to
+    be passed as argument to a debug log call.
+
+    The payload is only serialized once the log record is emitted. Payloads
+    longer than size characters are shown by their head and tail and their
+    size in bytes.
+
+    :param value: The payload.
+    :param size: The maximum number of characters shown.
+    """
+    __slots__ = ('value', 'size')
+
+    def __init__(self, value: Any, size: int = PREVIEW_SIZE):
+        self.value = value
+        self.size = size
+
+    def __str__(self) -> str:
+        if isinstance(self.value, bytes):
+            text = self.value.decode('utf-8', 'replace')
+        elif isinstance(self.value, str):
+            text = self.value
+        else:
+            try:
+                text = json_dumps(self.value)
+            except (TypeError, ValueError):
+                text = repr(self.value)
+
+        if len(text) <= self.size:
+            return text
+
+        tail = self.size // 4
+        return f"{text[:self.size - tail]} ... {text[-tail:]} ({len(text.encode('utf-8'))} bytes)"
+
+
+def compress_file(file_obj, compresslevel=9, chunk_size=1048576):
+    """
+    Copied from saltstack's salt.utils.gzip_util.compress_file
+
+    Generator that reads chunk_size bytes at a time from a file/filehandle and
+    yields the compressed result of each read.
+
+    .. note::
+        Each chunk is compressed separately. They cannot be stitched together
+        to form a compressed file. This function is designed to break up a file
+        into compressed chunks for transport and decompression/reassembly on a
+        remote host.
+
+    :param file_obj: The file object or path to the file to be compressed.
+    :type file_obj: file or str
+    :param compresslevel: The compression level, ranging from 0 to 9. Defaults to 9.
+    :type compresslevel: int, optional
+    :param chunk_size: The size of each chunk to read and compress, in bytes. Defaults to 1048576 (1MB).
+    :type chunk_size: int, optional
+    :return: The compressed data chunk.
+    :rtype: bytes
+    """
+    try:
+        bytes_read = int(chunk_size)
+        if bytes_read != chunk_size:
+            raise ValueError
+    except ValueError:
+        raise ValueError("chunk_size must be an integer")
+    try:
+        while bytes_read == chunk_size:
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=compresslevel) as gzipf:
+                try:
+                    bytes_read = gzipf.write(file_obj.read(chunk_size))
+                except AttributeError:
+                    # Open the file and re-attempt the read
+                    file_obj = open(file_obj, "rb")
+                    bytes_read = gzipf.write(file_obj.read(chunk_size))
+            yield buf.getvalue()
+    finally:
+        try:
+            file_obj.close()
+        except AttributeError:
+            pass
+
+
+def file_mode(path):
+    """
+    Get mode from path.
+
+    Returns file permissions including the sticky bit as integer
+
+    :param path: The path to the file.
+    :type path: str
+    :return: The file permissions.
+    :rtype: int
+    """
+    try:
+        return int(oct(stat.S_IMODE(os.stat(path).st_mode)))
+    except (TypeError, IndexError, ValueError):
+        return None
+
+
+def chunk_low_states(host, src, dest, chunk_size):
+    """
+    Generator that yields a ``cp.recv_chunked`` low state for each compressed
+    chunk of the source file.
+
+    :param host: The minion id receiving the file.
+    :type host: str
+    :param src: The path to the source file.
+    :type src: str
+    :param dest: The destination path on the minion.
+    :type dest: str
+    :param chunk_size: The size of each chunk to read and compress, in bytes.
+    :type chunk_size: int
+    :return: The low state transferring a single chunk.
+    :rtype: dict
+    """
+    for index, chunk in enumerate(compress_file(src, chunk_size=chunk_size), start=1):
+        chunk = base64.b64encode(chunk).decode('ascii')
+        append = index > 1
+
+        # arguments for cp.recv_chunked, gzipped
+        args = [dest, chunk, append, True, file_mode(src)]
+
+        # payload
+        yield {
+            'client': 'local',
+            'tgt': host,
+            'fun': 'cp.recv_chunked',
+            'arg': args,
+            'full_return': True,  # full return to get retcode
+        }
+
+
+def batch_low_states(low_states, request_size):
+    """
+    Generator that groups consecutive ``cp.recv_chunked`` low states into
+    lists sent as a single request to the Salt-API.
+
+    A batch is closed as soon as adding the next chunk would exceed
+    request_size bytes of encoded chunk data. Each batch contains at least one
+    low state, hence a request_size of 0 sends every chunk on its own.
+
+    :param low_states: The low states to be grouped.
+    :type low_states: iterable of dict
+    :param request_size: The budget of encoded chunk bytes per request.
+    :type request_size: int
+    :return: The low states to be sent in one request.
+    :rtype: list
+    """
+    batch = []
+    batch_size = 0
+    for low_state in low_states:
+        chunk_size = len(low_state['arg'][1])
+        if batch and batch_size + chunk_size > request_size:
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append(low_state)
+        batch_size += chunk_size
+
+    if batch:
+        yield batch
+
+
+def lookup_jid_low_state(jid: str) -> dict:
+    """
+    Compile the low state looking up the returns of a job in the master's
+    job cache.
+    """
+    return {
+        'client': 'runner',
+        'fun': 'jobs.lookup_jid',
+        'jid': jid,
+    }
+
+
 def parse_data(data_items: List[DataItem]) -> dict:
     """
     Parse data items and retrieve values from environment variables provided by Rundeck.
@@ -60,7 +362,7 @@ def parse_data(data_items: List[DataItem]) -> dict:
     :returns: A dictionary with data keys and their corresponding values.
     :rtype: dict
     """
-    log.debug(f'Parsing data_items: {data_items}')
+    log.debug('Parsing data_items: %s', data_items)
     data = {}
     for item in data_items:
         env_value: Any = os.getenv(item.env_var, None)
@@ -73,7 +375,7 @@ def parse_data(data_items: List[DataItem]) -> dict:
                 env_value = int(env_value)
             data[item.key] = env_value
         else:
-            log.debug(f'data_item {item.key} is empty')
+            log.debug('data_item %s is empty', item.key)
             data[item.key] = None
     return data
 
@@ -109,3 +411,1049 @@ def sanitize_dict(input_dict: dict, sensitive_keys: Sequence[str]) -> dict:
             sanitized_dict[key] = "********"
 
     return sanitized_dict
+
+
+def profile_settings() -> Optional[dict]:
+    """
+    Parse the profiling settings from the environment, or return None if
+    profiling is disabled for this invocation.
+
+    SALT_PLUGIN_PROFILE takes a comma-separated list of profilers, cpu and
+    memory. SALT_PLUGIN_PROFILE_DIR is the directory of the reports, which
+    keeps the reports of the latest SALT_PLUGIN_PROFILE_KEEP invocations,
+    100 by default. SALT_PLUGIN_PROFILE_SAMPLE is the percentage of
+    invocations profiled, 100 by default.
+
+    :returns: A dictionary with the profilers, directory and number of
+              reports kept, or None.
+    """
+    try:
+        data = parse_data([
+            DataItem('profilers', 'SALT_PLUGIN_PROFILE', 'str'),
+            DataItem('directory', 'SALT_PLUGIN_PROFILE_DIR', 'str'),
+            DataItem('keep', 'SALT_PLUGIN_PROFILE_KEEP', 'int'),
+            DataItem('sample', 'SALT_PLUGIN_PROFILE_SAMPLE', 'int'),
+        ])
+    except ValueError as exception:
+        # a malformed setting must not fail the provider
+        log.warning('Not profiling, invalid profiling setting: %s', exception)
+        return None
+    if not data['profilers'] or not data['directory']:
+        return None
+
+    profilers = {profiler.strip() for profiler in data['profilers'].split(',') if profiler.strip()}
+    unknown = profilers.difference(PROFILERS)
+    if unknown:
+        log.warning('Ignoring unknown profilers %s. Use any of: %s', ', '.join(sorted(unknown)), ', '.join(PROFILERS))
+        profilers -= unknown
+
+    sample = 100 if data['sample'] is None else data['sample']
+    if not profilers or random.uniform(0, 100) >= sample:
+        return None
+
+    return {
+        'profilers': profilers,
+        'directory': data['directory'],
+        'keep': 100 if data['keep'] is None else max(data['keep'], 1),
+    }
+
+
+def profile_name(name: str) -> re.Pattern:
+    """
+    Return the pattern of the report names of a provider, see write_profile.
+    Other files in the profile directory do not match.
+    """
+    return re.compile(rf'{re.escape(name)}-\d{{8}}T\d{{6}}-\d+-[a-z0-9_]+\.txt')
+
+
+def prune_profiles(directory: str, keep: int, name: str):
+    """
+    Remove the reports of all but the latest keep invocations of a provider
+    from the profile directory.
+    """
+    pattern = profile_name(name)
+    reports = []
+    for entry in os.scandir(directory):
+        if pattern.fullmatch(entry.name):
+            try:
+                reports.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                continue
+
+    for _, path in sorted(reports)[:-keep]:
+        for report in (path, f'{path[:-4]}.prof'):
+            try:
+                os.unlink(report)
+            except FileNotFoundError:
+                pass
+
+
+def write_profile(settings: dict, name: str, elapsed: float, profiler: Optional[cProfile.Profile],
+                  snapshot: Optional[tracemalloc.Snapshot], peak: int) -> str:
+    """
+    Write the profile report of an invocation to a new file in the profile
+    directory and return its path.
+
+    The report lists the functions with the highest cumulative time and the
+    allocation sites with the most memory allocated. The complete CPU
+    profile is written next to it with the extension .prof, to be inspected
+    with pstats or snakeviz.
+    """
+    directory = settings['directory']
+    os.makedirs(directory, exist_ok=True)
+
+    # the file name is unique, even for invocations within the same second
+    prefix = f"{name}-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-"
+    fd, path = tempfile.mkstemp(dir=directory, prefix=prefix, suffix='.txt')
+    with os.fdopen(fd, 'w', encoding='utf-8') as report:
+        report.write(f"{name} {' '.join(sys.argv[1:])}\nWall time: {elapsed:.3f} s\n")
+
+        if profiler is not None:
+            report.write('\nFunctions with the highest cumulative time:\n')
+            stats = pstats.Stats(profiler, stream=report)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TOP)
+            stats.dump_stats(f'{path[:-4]}.prof')
+
+        if snapshot is not None:
+            report.write(f'\nPeak memory traced: {peak / 1024:.1f} KiB\nAllocation sites with the most memory:\n')
+            for statistic in snapshot.statistics('lineno')[:PROFILE_TOP]:
+                report.write(f'{statistic}\n')
+
+    prune_profiles(directory, settings['keep'], name)
+    return path
+
+
+def profiled(name: str):
+    """
+    Decorator running the main function of a provider under cProfile and/or
+    tracemalloc if enabled in the environment, see profile_settings. The
+    report is written once the function returns or exits.
+
+    :param name: The name of the provider, used as prefix of the reports.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            settings = profile_settings()
+            if settings is None:
+                return function(*args, **kwargs)
+
+            profiler = cProfile.Profile() if 'cpu' in settings['profilers'] else None
+            if 'memory' in settings['profilers']:
+                tracemalloc.start()
+            start = time.perf_counter()
+            if profiler is not None:
+                profiler.enable()
+
+            try:
+                return function(*args, **kwargs)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                elapsed = time.perf_counter() - start
+
+                snapshot, peak = None, 0
+                if tracemalloc.is_tracing():
+                    peak = tracemalloc.get_traced_memory()[1]
+                    snapshot = tracemalloc.take_snapshot().filter_traces([
+                        tracemalloc.Filter(False, tracemalloc.__file__),
+                        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+                    ])
+                    tracemalloc.stop()
+
+                # a failing report must not fail the provider
+                try:
+                    path = write_profile(settings, name, elapsed, profiler, snapshot, peak)
+                    log.debug('Profile written to %s', path)
+                except OSError as exception:
+                    log.warning('Unable to write the profile: %s', exception)
+
+        return wrapper
+    return decorator
+
+
+class SaltApiError(PepperException):
+    """
+    Error of a request to the Salt-API.
+
+    :param message: The description of the error.
+    :param path: The path of the request.
+    :param status: The HTTP status of the response, if one was received.
+    """
+
+    def __init__(self, message: str, path: Optional[str] = None, status: Optional[int] = None):
+        super().__init__(message)
+        self.path = path
+        self.status = status
+
+
+def status_error(path: str, status: int, reason: str) -> SaltApiError:
+    """
+    Return the error of a response with an HTTP error status.
+    """
+    if status == 401:
+        return SaltApiError('Authentication denied', path, status)
+
+    if status == 500:
+        return SaltApiError('Server error.', path, status)
+
+    return SaltApiError(f'Error with request: HTTP Error {status}: {reason}', path, status)
+
+
+def parse_status_line(status_line: bytes) -> Tuple[int, str]:
+    """
+    Parse the status line of an HTTP response into its status and reason.
+
+    :raises http.client.BadStatusLine: if the status line is malformed
+    """
+    version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+    if not version.startswith('HTTP/'):
+        raise http.client.BadStatusLine(status_line)
+    try:
+        return int(status), reason
+    except ValueError:
+        raise http.client.BadStatusLine(status_line)
+
+
+class _TLSContext(ssl.SSLContext):
+    """
+    TLS context which resumes the latest session of its connections. asyncio
+    does not pass a session when it wraps a connection, hence it is added
+    here.
+    """
+    session = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session or self.session)
+
+
+def ssl_context(verify: bool) -> ssl.SSLContext:
+    """
+    Create the TLS context of the connections to the Salt-API.
+    """
+    context = _TLSContext(ssl.PROTOCOL_TLS_CLIENT)
+    if verify:
+        context.load_default_certs()
+        return context
+
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def encode_request(path: str, data: Any, auth: dict, accept: str = 'application/json', compression: bool = True,
+                   compress_requests: bool = False) -> Tuple[dict, Optional[bytes]]:
+    """
+    Compile the headers and body of a request to the Salt-API.
+
+    :param path: The path of the request.
+    :param data: The data posted as JSON, or None for a GET request.
+    :param auth: The authentication of the client, whose token is attached.
+    :param accept: The media type of the response.
+    :param compression: Whether to accept gzip compressed responses.
+    :param compress_requests: Whether to compress large request bodies.
+
+    :returns: The headers and the body, or None without data.
+    """
+    headers = {
+        'Accept': accept,
+        'Accept-Encoding': 'gzip' if compression else 'identity',
+        'Content-Type': 'application/json',
+        'X-Requested-With': 'XMLHttpRequest',
+    }
+
+    # Build POST data
+    postdata = None
+    if data is not None:
+        postdata = json_dumps(data).encode()
+        if compress_requests and len(postdata) >= COMPRESS_MIN_SIZE:
+            postdata = gzip.compress(postdata, compresslevel=1)
+            headers['Content-Encoding'] = 'gzip'
+        headers['Content-Length'] = str(len(postdata))
+
+    # Add auth header to request
+    if path != '/run' and auth and 'token' in auth and auth['token']:
+        headers['X-Auth-Token'] = auth['token']
+
+    return headers, postdata
+
+
+class SaltApiClient(Pepper):
+    """
+    Pepper client which runs its requests one at a time on an
+    AsyncSaltApiClient with an event loop of its own.
+
+    Pepper opens a new connection, and with HTTPS performs a new TLS handshake,
+    for each request. This client keeps the connection open for the lifetime
+    of the instance and resumes the TLS session if the server closed it in
+    between. The timeout applies to each step of a request, like a socket
+    timeout.
+    """
+
+    def __init__(self, api_url='https://localhost:8000', debug_http=False, ignore_ssl_errors=False, timeout=None,
+                 compression=True, compress_requests=False):
+        # the requests are sent one at a time, through one connection
+        self._client = AsyncSaltApiClient(api_url=api_url, ignore_ssl_errors=ignore_ssl_errors, timeout=timeout,
+                                          max_connections=1, compression=compression,
+                                          compress_requests=compress_requests)
+        self._loop = None
+        super().__init__(api_url=api_url, debug_http=debug_http, ignore_ssl_errors=ignore_ssl_errors)
+        self.timeout = timeout
+
+    @property
+    def auth(self) -> dict:
+        """
+        The authentication of the client, shared with its asyncio client.
+        """
+        return self._client.auth
+
+    @auth.setter
+    def auth(self, auth: dict):
+        self._client.auth = auth
+
+    def _event_loop(self) -> asyncio.AbstractEventLoop:
+        """
+        Return the event loop of the client, which is created on first use.
+        """
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop
+
+    def _run(self, awaitable):
+        """
+        Run a step of a request on the event loop of the client.
+
+        :raises asyncio.TimeoutError: if the step exceeded the timeout
+        """
+        return self._event_loop().run_until_complete(asyncio.wait_for(awaitable, self.timeout))
+
+    def close(self):
+        """
+        Close the connection to the Salt-API.
+        """
+        self._client.close()
+        if self._loop is not None:
+            # the closed connections release their sockets in the loop
+            self._loop.run_until_complete(asyncio.sleep(0))
+            self._loop.close()
+            self._loop = None
+
+    def _use_pepper(self, data) -> bool:
+        """
+        Whether the request has to be sent through Pepper's own request path.
+        """
+        return self._client._use_blocking(data)
+
+    def _send(self, path, data=None, accept='application/json', compression=True):
+        """
+        Send a request to the Salt-API and return the unread body of the
+        response as binary file object, which is decompressed while read if
+        the response is compressed.
+        """
+        try:
+            response = self._run(self._client.open(path, data, accept, compression))
+        except asyncio.TimeoutError:
+            raise SaltApiError('Error with request: timed out', path)
+
+        if not self.salt_version and response.headers.get('x-salt-version'):
+            self._parse_salt_version(response.headers['x-salt-version'])
+
+        body = io.BufferedReader(_ResponseBody(self, response), READ_SIZE)
+        if response.headers.get('content-encoding', '').lower() == 'gzip':
+            return gzip.GzipFile(fileobj=body, mode='rb')
+        return body
+
+    def req(self, path, data=None):
+        """
+        Send a request to the Salt-API and return the parsed response.
+
+        If the current instance contains an authentication token it will be
+        attached to the request as a custom header.
+
+        :rtype: dictionary
+        """
+        if self._use_pepper(data):
+            return super().req(path, data)
+
+        body = self._send(path, data)
+        try:
+            content = body.read()
+        except DECODING_ERRORS as exception:
+            log.debug('Error with request', exc_info=True)
+            raise SaltApiError(f'Error with request: {exception}', path)
+        finally:
+            body.close()
+
+        try:
+            return json_loads(content)
+        except ValueError:
+            log.debug('Error converting response from JSON', exc_info=True)
+            raise SaltApiError('Unable to parse the server response.', path)
+
+    def low_stream(self, lowstate, path='/'):
+        """
+        Execute a command through salt-api and return the unread body of the
+        response as binary file object, which is decompressed while read.
+
+        The body has to be read completely and closed before the next request
+        is sent.
+
+        :param list lowstate: a list of lowstate dictionaries
+        """
+        if self._use_pepper(lowstate):
+            return io.BytesIO(json_dumps(super().req(path, lowstate)).encode())
+
+        return self._send(path, lowstate)
+
+    def events(self, path='/events'):
+        """
+        Subscribe to the event bus of the Salt master and return the unread
+        body of the server-sent event stream as binary file object.
+
+        The stream occupies the connection until it is closed, other requests
+        need a client of their own.
+        """
+        if self._use_pepper(None):
+            raise PepperException('The event stream is not supported with kerberos and plain HTTP proxies')
+
+        # events are delivered one at a time, compression would buffer them
+        return self._send(path, accept='text/event-stream', compression=False)
+
+    def low_as_completed(self, lowstates, path='/', concurrency=4, deadline=None):
+        """
+        Send independent requests of low states concurrently and yield their
+        parsed responses as each request completes.
+
+        The requests are sent by an AsyncSaltApiClient sharing the
+        authentication token, through up to concurrency connections of its
+        own. A response is released once the caller is done with it, so only
+        the responses not yet consumed are held in memory.
+
+        :param list lowstates: a list of requests, each a list of lowstate
+                               dictionaries
+        :param deadline: The seconds each request may take, defaults to the
+                         timeout of the client
+
+        :returns: Tuples of the position of the request in lowstates and its
+                  response, or the SaltApiError if the request failed
+        """
+        client = AsyncSaltApiClient(api_url=self.api_url, ignore_ssl_errors=not self._ssl_verify,
+                                    timeout=self.timeout, max_connections=concurrency,
+                                    compression=self._client.compression,
+                                    compress_requests=self._client.compress_requests)
+        client.auth = self.auth
+
+        loop = self._event_loop()
+        tasks = {}
+        try:
+            for position, lowstate in enumerate(lowstates):
+                tasks[loop.create_task(client.low(lowstate, path, deadline))] = position
+
+            while tasks:
+                done, _ = loop.run_until_complete(asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED))
+                for task in done:
+                    position = tasks.pop(task)
+                    exception = task.exception()
+                    if exception is None:
+                        yield position, task.result()
+                    elif isinstance(exception, PepperException):
+                        yield position, exception
+                    else:
+                        raise exception
+        finally:
+            # requests still pending when the caller stopped or failed
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                loop.run_until_complete(asyncio.wait(tasks))
+            client.close()
+            loop.run_until_complete(asyncio.sleep(0))
+
+
+class _ResponseBody(io.RawIOBase):
+    """
+    Raw binary file object of the body of a response, which is read on the
+    event loop of a SaltApiClient.
+    """
+
+    def __init__(self, client: SaltApiClient, response: '_AsyncResponse'):
+        super().__init__()
+        self._client = client
+        self._response = response
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        try:
+            content = self._client._run(self._response.read(len(buffer)))
+        except asyncio.TimeoutError:
+            # like the read of a socket with a timeout
+            raise socket.timeout('timed out')
+        buffer[:len(content)] = content
+        return len(content)
+
+    def close(self):
+        if not self.closed:
+            self._response.close()
+        super().close()
+
+
+class _AsyncResponse:
+    """
+    Response of an AsyncSaltApiClient, whose body is read on demand.
+
+    The connection returns to the pool of the client once the body was read
+    completely. Closing the response before closes the connection.
+    """
+
+    def __init__(self, client: 'AsyncSaltApiClient', reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 status: int, reason: str, headers: dict):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._client = client
+        self._reader = reader
+        self._writer = writer
+        self._chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+        self._chunks = 0
+        # the bytes left of the body or of the current chunk, None for a
+        # body ending with the connection
+        self._left = 0
+        if not self._chunked:
+            self._left = int(headers['content-length']) if 'content-length' in headers else None
+            if self._left is None:
+                headers['connection'] = 'close'
+            elif self._left == 0:
+                self._finish()
+
+    async def read(self, size=-1) -> bytes:
+        """
+        Read up to size bytes of the raw body, or the rest of the body if size
+        is negative. Returns an empty bytes object at the end of the body.
+        """
+        try:
+            if size >= 0:
+                return await self._read(size)
+
+            chunks = []
+            while True:
+                chunk = await self._read(READ_SIZE)
+                if not chunk:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+        except BaseException:
+            # also drops the connection of a read cancelled at its timeout
+            self.close()
+            raise
+
+    async def _read(self, size) -> bytes:
+        """
+        Read up to size bytes of the raw body.
+        """
+        if self._writer is None:
+            return b''
+
+        if self._chunked and self._left == 0:
+            if self._chunks:
+                # the line break ending the previous chunk
+                await self._reader.readline()
+            self._chunks += 1
+            line = await self._reader.readline()
+            try:
+                self._left = int(line.split(b';', 1)[0], 16)
+            except ValueError:
+                raise http.client.IncompleteRead(line)
+            if self._left == 0:
+                # skip the trailer
+                while (await self._reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                self._finish()
+                return b''
+
+        if self._left is None:
+            content = await self._reader.read(size)
+            if not content:
+                self._finish()
+            return content
+
+        content = await self._reader.read(min(size, self._left))
+        if not content:
+            raise asyncio.IncompleteReadError(b'', self._left)
+        self._left -= len(content)
+        if self._left == 0 and not self._chunked:
+            self._finish()
+        return content
+
+    def _finish(self):
+        """
+        Release the connection once the body was read completely.
+        """
+        if self.headers.get('connection', '').lower() == 'close':
+            self._client._drop(self._writer)
+        else:
+            self._client._release(self._reader, self._writer)
+        self._writer = None
+
+    def close(self):
+        """
+        Close the response, and its connection unless the body was read
+        completely.
+        """
+        if self._writer is not None:
+            self._client._drop(self._writer)
+            self._writer = None
+
+
+class AsyncSaltApiClient:
+    """
+    Asyncio client of the Salt-API, which sends concurrent requests through a
+    pool of HTTP/1.1 keep-alive connections.
+
+    Up to max_connections requests are in flight at once, each bounded by a
+    deadline of its own. HTTPS connections resume the TLS session of the
+    previous connection and are tunneled through a proxy if one is set.
+    Requests with kerberos authentication or through a plain HTTP proxy are
+    sent by Pepper in threads instead.
+    """
+
+    def __init__(self, api_url='https://localhost:8000', ignore_ssl_errors=False, timeout=None, max_connections=4,
+                 compression=True, compress_requests=False):
+        split = urlsplit(api_url)
+        if split.scheme not in ['http', 'https']:
+            raise PepperException(f'salt-api URL missing HTTP(s) protocol: {api_url}')
+
+        self.api_url = api_url
+        self.auth = {}
+        # default deadline of a request in seconds
+        self.timeout = timeout
+        self.max_connections = max_connections
+        # accept gzip compressed responses
+        self.compression = compression
+        # compress request bodies, requires a server decompressing them
+        self.compress_requests = compress_requests
+        self._ssl_verify = not ignore_ssl_errors
+        self._ssl_context = None
+        self._scheme = split.scheme
+        self._host = split.hostname
+        self._port = split.port or (443 if split.scheme == 'https' else 80)
+        self._idle = []
+        self._connections = set()
+        self._semaphore = None
+
+        # urllib honors proxies from the environment; plain HTTP proxies
+        # expect absolute URIs, which is left to Pepper's request path
+        self._proxy = None
+        if not proxy_bypass(self._host):
+            self._proxy = getproxies().get(self._scheme)
+
+    def _use_blocking(self, data) -> bool:
+        """
+        Whether the request has to be sent through Pepper's own request path.
+        """
+        return ((hasattr(data, 'get') and data.get('eauth') == 'kerberos')
+                or self.auth.get('eauth') == 'kerberos'
+                or (self._proxy is not None and self._scheme == 'http'))
+
+    def _blocking_req(self, path, data):
+        """
+        Send a request with a blocking SaltApiClient sharing the
+        authentication token, which sends it through Pepper.
+        """
+        client = SaltApiClient(api_url=self.api_url, ignore_ssl_errors=not self._ssl_verify, timeout=self.timeout,
+                               compression=self.compression, compress_requests=self.compress_requests)
+        client.auth = self.auth
+        try:
+            if path == '/login':
+                return {'return': [client.login(**data)]}
+            return client.req(path, data)
+        finally:
+            client.close()
+
+    def _tunnel(self) -> socket.socket:
+        """
+        Open a connection to the proxy and tunnel it to the Salt-API.
+        """
+        proxy = urlsplit(self._proxy)
+        sock = socket.create_connection((proxy.hostname, proxy.port or 80), self.timeout)
+        try:
+            target = f'{self._host}:{self._port}'
+            sock.sendall(f'CONNECT {target} HTTP/1.1\r\nHost: {target}\r\n\r\n'.encode('latin-1'))
+            with sock.makefile('rb') as response:
+                status, reason = parse_status_line(response.readline())
+                while response.readline() not in (b'\r\n', b'\n', b''):
+                    pass
+            if status != 200:
+                raise OSError(f'Tunnel connection failed: {status} {reason}')
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    async def _connect(self):
+        """
+        Open a connection to the Salt-API.
+        """
+        sock = None
+        if self._proxy is not None:
+            sock = await asyncio.get_running_loop().run_in_executor(None, self._tunnel)
+
+        if self._scheme == 'https':
+            # TLS sessions can only be resumed within the same context
+            if self._ssl_context is None:
+                self._ssl_context = ssl_context(self._ssl_verify)
+            if sock is not None:
+                reader, writer = await asyncio.open_connection(sock=sock, ssl=self._ssl_context,
+                                                               server_hostname=self._host)
+            else:
+                reader, writer = await asyncio.open_connection(self._host, self._port, ssl=self._ssl_context)
+        else:
+            reader, writer = await asyncio.open_connection(self._host, self._port)
+
+        self._connections.add(writer)
+        return reader, writer
+
+    def _release(self, reader, writer):
+        """
+        Return a connection whose response was read completely to the pool.
+        """
+        ssl_object = writer.get_extra_info('ssl_object')
+        if ssl_object is not None and ssl_object.session is not None:
+            self._ssl_context.session = ssl_object.session
+        self._idle.append((reader, writer))
+
+    def _drop(self, writer):
+        """
+        Close a connection, whose response may not have been read completely.
+        """
+        self._connections.discard(writer)
+        writer.transport.abort()
+
+    def close(self):
+        """
+        Close the connections to the Salt-API.
+        """
+        self._idle.clear()
+        while self._connections:
+            self._drop(next(iter(self._connections)))
+
+    @staticmethod
+    async def _read_head(status_line, reader):
+        """
+        Read the headers of a response after its status line and return its
+        status, reason and lower-cased headers.
+        """
+        status, reason = parse_status_line(status_line)
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if status_line.startswith(b'HTTP/1.0 ') and headers.get('connection', '').lower() != 'keep-alive':
+            headers['connection'] = 'close'
+
+        return status, reason, headers
+
+    async def _request(self, method, path, body, headers) -> _AsyncResponse:
+        """
+        Send a request through a pooled connection and return its response,
+        whose body has not been read yet.
+
+        A reused connection closed by the server while idle is replaced and
+        the request sent again, but only if sending failed or the connection
+        was closed before the status line of the response. Otherwise the
+        request may have been processed and must not be repeated.
+        """
+        url = urlsplit(urljoin(self.api_url, path.lstrip('/')))
+        target = url.path or '/'
+        if url.query:
+            target = f'{target}?{url.query}'
+
+        host = self._host if url.port is None else f'{self._host}:{url.port}'
+        head = f'{method} {target} HTTP/1.1\r\nHost: {host}\r\n'
+        head += ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+        request = (head + '\r\n').encode('latin-1') + (body or b'')
+
+        while True:
+            reused = bool(self._idle)
+            reader, writer = self._idle.pop() if reused else await self._connect()
+            try:
+                try:
+                    writer.write(request)
+                    await writer.drain()
+                    status_line = await reader.readline()
+                except (ConnectionResetError, BrokenPipeError):
+                    status_line = b''
+
+                if not status_line:
+                    self._drop(writer)
+                    if reused:
+                        continue
+                    raise ConnectionResetError('Remote end closed connection without response')
+
+                status, reason, response_headers = await self._read_head(status_line, reader)
+                return _AsyncResponse(self, reader, writer, status, reason, response_headers)
+            except BaseException:
+                # also drops the connection of a request cancelled at its
+                # deadline, as its response may still arrive
+                self._drop(writer)
+                raise
+
+    async def open(self, path, data=None, accept='application/json', compression=True) -> _AsyncResponse:
+        """
+        Send a request to the Salt-API and return its response, whose body has
+        not been read yet. The body has to be read completely or the response
+        closed.
+
+        :param accept: The media type of the response.
+        :param compression: Whether to accept a gzip compressed response, if
+                            enabled for the client.
+
+        :raises SaltApiError: if the request failed or the response has an
+                              HTTP error status
+        """
+        headers, postdata = encode_request(path, data, self.auth, accept, self.compression and compression,
+                                           self.compress_requests)
+
+        method = 'POST' if postdata is not None else 'GET'
+        try:
+            response = await self._request(method, path, postdata, headers)
+        except (OSError, EOFError, http.client.HTTPException, ValueError) as exception:
+            log.debug('Error with request', exc_info=True)
+            raise SaltApiError(f'Error with request: {exception}', path)
+
+        if response.status >= 400:
+            # the body of an error is not needed, drop the connection instead
+            response.close()
+            raise status_error(path, response.status, response.reason)
+
+        return response
+
+    async def _send(self, path, data=None):
+        """
+        Send a request to the Salt-API and return the parsed response.
+        """
+        response = await self.open(path, data)
+        try:
+            content = await response.read()
+            if response.headers.get('content-encoding', '').lower() == 'gzip':
+                content = gzip.decompress(content)
+        except DECODING_ERRORS as exception:
+            log.debug('Error with request', exc_info=True)
+            raise SaltApiError(f'Error with request: {exception}', path)
+
+        try:
+            return json_loads(content)
+        except ValueError:
+            log.debug('Error converting response from JSON', exc_info=True)
+            raise SaltApiError('Unable to parse the server response.', path)
+
+    async def req(self, path, data=None, deadline=None):
+        """
+        Send a request to the Salt-API and return the parsed response.
+
+        The request waits for one of max_connections slots and then has to
+        complete within its deadline.
+
+        :param deadline: The seconds the request may take, defaults to the
+                         timeout of the client
+
+        :raises SaltApiError: if the request failed or missed its deadline
+        """
+        if self._semaphore is None:
+            # created within the running event loop
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+
+        if deadline is None:
+            deadline = self.timeout
+
+        async with self._semaphore:
+            if self._use_blocking(data):
+                request = asyncio.get_running_loop().run_in_executor(None, self._blocking_req, path, data)
+            else:
+                request = self._send(path, data)
+
+            try:
+                return await asyncio.wait_for(request, deadline)
+            except asyncio.TimeoutError:
+                raise SaltApiError(f'Request exceeded its deadline of {deadline} seconds', path)
+
+    async def login(self, username=None, password=None, eauth=None, **kwargs):
+        """
+        Authenticate with the Salt-API and keep the token for subsequent
+        requests.
+        """
+        if username is not None:
+            kwargs['username'] = username
+        if password is not None:
+            kwargs['password'] = password
+        if eauth is not None:
+            kwargs['eauth'] = eauth
+
+        self.auth = (await self.req('/login', kwargs)).get('return', [{}])[0]
+        return self.auth
+
+    async def low(self, lowstate, path='/', deadline=None):
+        """
+        Execute a command through salt-api and return the response.
+
+        :param list lowstate: a list of lowstate dictionaries
+        """
+        return await self.req(path, lowstate, deadline)
+
+
+class _JsonStream:
+    """
+    Reads JSON values one at a time from a text stream, without reading the
+    whole document into memory.
+    """
+
+    def __init__(self, stream, read_size=65536):
+        self._stream = stream
+        self._read_size = read_size
+        self._buffer = ''
+        self._position = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self, size) -> bool:
+        """
+        Read more data into the buffer, dropping the consumed part.
+        """
+        if self._eof:
+            return False
+        try:
+            chunk = self._stream.read(size)
+        except DECODING_ERRORS as exception:
+            raise ValueError(f'Unable to read the JSON stream: {exception}')
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._position:] + chunk
+        self._position = 0
+        return True
+
+    def peek(self) -> str:
+        """
+        Return the next non-whitespace character without consuming it, or an
+        empty string at the end of the stream.
+        """
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position] in ' \t\n\r':
+                self._position += 1
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if not self._fill(self._read_size):
+                return ''
+
+    def expect(self, char: str):
+        """
+        Consume the next non-whitespace character, which has to be char.
+        """
+        if self.peek() != char:
+            raise ValueError(f'Expected {char!r} at position {self._position} of the JSON stream')
+        self._position += 1
+
+    def value(self) -> Any:
+        """
+        Decode and consume the next JSON value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._position)
+            except json.JSONDecodeError:
+                # incomplete value, read at least as much again as buffered
+                if not self._fill(max(self._read_size, len(self._buffer))):
+                    raise
+                continue
+            # a number may continue in the next chunk
+            if end == len(self._buffer) and isinstance(value, (int, float)) and self._fill(self._read_size):
+                continue
+            self._position = end
+            return value
+
+
+def iter_low_state_return(stream, encoding='utf-8', read_size=65536):
+    """
+    Generator that parses the response of a single low state from a binary
+    stream and yields the items of its return one at a time, e.g. the returns
+    of the targeted minions.
+
+    :param stream: The binary stream of the response body, e.g. returned by
+                   SaltApiClient.low_stream
+    :param encoding: The encoding of the response body
+    :param read_size: The number of characters read from the stream at once
+    :return: Tuples of key and value of the return, e.g. minion and its return
+    """
+    reader = _JsonStream(io.TextIOWrapper(stream, encoding=encoding), read_size)
+
+    reader.expect('{')
+    if reader.value() != 'return':
+        raise ValueError('Response does not start with a return')
+    reader.expect(':')
+    reader.expect('[')
+    if reader.peek() == ']':
+        return
+    reader.expect('{')
+
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        yield key, reader.value()
+        if reader.peek() == ',':
+            reader.expect(',')
+            continue
+        reader.expect('}')
+        return
+
+
+def iter_events(stream, encoding='utf-8'):
+    """
+    Generator that parses a server-sent event stream of the Salt-API from a
+    binary stream and yields the events, each a dictionary with tag and data.
+
+    :param stream: The binary stream of the response body, e.g. returned by
+                   SaltApiClient.events
+    :param encoding: The encoding of the event stream
+    :return: The events of the Salt master's event bus
+    :raises socket.timeout: if nothing was received within the timeout of
+                            the client
+    :raises ValueError: if reading the stream failed
+    """
+    lines = []
+    while True:
+        try:
+            raw_line = stream.readline()
+        except socket.timeout:
+            raise
+        except (OSError, http.client.HTTPException) as exception:
+            raise ValueError(f'Unable to read the event stream: {exception}')
+        if not raw_line:
+            return
+
+        line = raw_line.decode(encoding).rstrip('\r\n')
+        if line:
+            lines.append(line)
+            continue
+
+        # an empty line dispatches the event, only its data is needed as
+        # it repeats the tag
+        data = '\n'.join(field[6:] if field.startswith('data: ') else field[5:]
+                         for field in lines if field.startswith('data:'))
+        lines = []
+        if not data:
+            continue
+        try:
+            event = json_loads(data)
+        except ValueError:
+            log.warning('Ignoring unparsable event: %s', data)
+            continue
+        if isinstance(event, dict) and 'tag' in event:
+            yield event
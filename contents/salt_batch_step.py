@@ -0,0 +1,270 @@
+#!/usr/bin/env python -u
+import logging
+import os
+import re
+import sys
+import tempfile
+
+from typing import List, Optional, Tuple
+
+from pepper.exceptions import PepperException
+
+from common import DataItem, Preview, SaltApiClient, json_dumps, parse_data, profiled, sanitize_dict
+
+log = logging.getLogger(__name__)
+
+# target types accepted by salt's local client
+TARGET_TYPES = ('compound', 'glob', 'list', 'grain', 'pillar', 'nodegroup', 'pcre', 'ipcidr')
+
+# keys of a Rundeck node filter which select nodes by their name
+NODE_FILTER_NAME_KEYS = ('name', 'nodename', 'hostname')
+
+# characters of a Rundeck node filter value which make it a regular expression
+NODE_FILTER_PATTERN = re.compile(r'[*?+|\[\](){}^$\\]')
+
+
+def node_filter_target(node_filter: str) -> Optional[List[str]]:
+    """
+    Convert a Rundeck node filter selecting nodes by their names into the
+    list of minion ids.
+
+    Only bare node names and the name, nodename and hostname keys with
+    comma-separated names are supported, as any other filter is resolved by
+    Rundeck against its resource model.
+
+    :param node_filter: The job's node filter, e.g. 'name: web1,web2 db1'
+
+    :returns: The minion ids, or None if the filter cannot be converted
+    """
+    minions = []
+    key = None
+    for token in node_filter.split():
+        if token.endswith(':'):
+            key = token[:-1]
+            continue
+
+        if ':' in token:
+            key, token = token.split(':', 1)
+
+        if key is not None and key not in NODE_FILTER_NAME_KEYS:
+            return None
+
+        for name in token.split(','):
+            if not name:
+                continue
+            if name.startswith('!') or NODE_FILTER_PATTERN.search(name):
+                return None
+            if name not in minions:
+                minions.append(name)
+        key = None
+
+    return minions or None
+
+
+def batch_low_state(data: dict, args: List[str]) -> dict:
+    """
+    Prepare the low state running cmd.run_all on the target in batches.
+    """
+    low_state = {
+        'client': 'local_batch',
+        'tgt': data['tgt'],
+        'tgt_type': data['tgt-type'],
+        'fun': 'cmd.run_all',
+        'arg': args,
+        'batch': data['batch'],
+    }
+    if data['batch-wait']:
+        low_state['batch_wait'] = data['batch-wait']
+
+    return low_state
+
+
+def collect_batch_returns(response: dict) -> dict:
+    """
+    Merge the returns of all batches into the results of the minions.
+
+    Each batch yields the returns of its minions. A return of cmd.run_all is
+    a dictionary with the command's output and retcode, any other return,
+    such as an error message of the minion, is taken as failed output.
+
+    :returns: The minion ids mapped to their retcode, stdout and stderr
+    """
+    results = {}
+    for batch in response.get('return', []):
+        if not isinstance(batch, dict):
+            log.warning('Ignoring unexpected batch return: %s', Preview(batch))
+            continue
+
+        for minion, ret in batch.items():
+            if isinstance(ret, dict) and 'retcode' in ret:
+                results[minion] = {
+                    'retcode': ret['retcode'],
+                    'stdout': ret.get('stdout', ''),
+                    'stderr': ret.get('stderr', ''),
+                }
+            else:
+                results[minion] = {'retcode': 1, 'stdout': '', 'stderr': str(ret)}
+
+    return results
+
+
+def format_report(results: dict, missing: List[str]) -> Tuple[str, int]:
+    """
+    Format the results of all minions as one report for Rundeck's log.
+
+    :param results: The minion ids mapped to their retcode, stdout and stderr
+    :param missing: The targeted minions which did not return
+
+    :returns: The report, and the step's return code, 0 if all minions
+              returned and succeeded
+    """
+    lines = []
+    for minion in sorted(results):
+        result = results[minion]
+        lines.append(f"--- {minion} (retcode {result['retcode']}) ---")
+        if result['stdout']:
+            lines.append(result['stdout'])
+        if result['stderr']:
+            lines.append(result['stderr'])
+
+    for minion in missing:
+        lines.append(f'--- {minion} (no return) ---')
+
+    failed = sorted(minion for minion, result in results.items() if result['retcode'] != 0)
+    lines.append(f'{len(results)} minions returned, {len(failed)} failed, {len(missing)} did not return')
+    if failed:
+        lines.append(f"Failed: {', '.join(failed)}")
+
+    return '\n'.join(lines), 1 if failed or missing else 0
+
+
+def write_report(path: str, results: dict, missing: List[str]):
+    """
+    Atomically write the results of all minions as a JSON report.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.batch-step-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as report_file:
+            report_file.write(json_dumps({'minions': results, 'missing': missing}, sort_keys=True))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+@profiled('salt-batch-step')
+def main():
+    """
+    Main function to run a command on many minions in batches via Salt-API
+
+    This function retrieves necessary data from environment variables provided by Rundeck.
+    """
+    # parse environment provided by rundeck
+    data_items = [
+        DataItem('cmd', 'RD_CONFIG_COMMAND', 'str'),
+        DataItem('tgt', 'RD_CONFIG_TARGET', 'str'),
+        DataItem('tgt-type', 'RD_CONFIG_TARGET_TYPE', 'str'),
+        DataItem('node-filter', 'RD_JOB_FILTER', 'str'),
+        DataItem('batch', 'RD_CONFIG_BATCH_SIZE', 'str'),
+        DataItem('batch-wait', 'RD_CONFIG_BATCH_WAIT', 'int'),
+        DataItem('runas', 'RD_CONFIG_RUNAS', 'str'),
+        DataItem('args', 'RD_CONFIG_CMD_RUN_ARGS', 'shstr'),
+        DataItem('report', 'RD_CONFIG_REPORT', 'str'),
+        DataItem('url', 'RD_CONFIG_URL', 'str'),
+        DataItem('eauth', 'RD_CONFIG_EAUTH', 'str'),
+        DataItem('user', 'RD_CONFIG_USER', 'str'),
+        DataItem('password', 'RD_CONFIG_PASSWORD', 'str'),
+        DataItem('verify_ssl', 'RD_CONFIG_VERIFYSSL', 'bool'),
+        DataItem('log-level', 'RD_JOB_LOGLEVEL', 'str'),
+    ]
+
+    data = parse_data(data_items)
+    log.debug('Data: %s', sanitize_dict(data, ['password']))
+
+    # use rundeck's log level if defined
+    if data['log-level'] == 'DEBUG':
+        log_level = 'DEBUG'
+    else:
+        log_level = 'ERROR'
+    log.setLevel(logging.getLevelName(log_level))
+
+    # Sanity checks for required input
+    for key in ['cmd', 'url', 'eauth', 'user', 'password']:
+        if not data[key]:
+            log.error('No %s specified. Command not sent.', key)
+            sys.exit(1)
+
+    # target the job's nodes unless a target is specified
+    targeted = []
+    if data['tgt']:
+        if data['tgt-type'] is None or data['tgt-type'] == '':
+            data['tgt-type'] = 'compound'
+        if data['tgt-type'] not in TARGET_TYPES:
+            log.error('Unknown target type %s. Use any of: %s', data['tgt-type'], ', '.join(TARGET_TYPES))
+            sys.exit(1)
+        if data['tgt-type'] == 'list':
+            targeted = [minion for minion in data['tgt'].split(',') if minion]
+    else:
+        targeted = node_filter_target(data['node-filter'] or '')
+        if targeted is None:
+            log.error('Unable to convert the node filter "%s" into a list of minions. Specify a target.',
+                      data['node-filter'] or '')
+            sys.exit(1)
+        data['tgt'] = ','.join(targeted)
+        data['tgt-type'] = 'list'
+
+    if data['batch'] is None or data['batch'] == '':
+        data['batch'] = '10%'
+
+    # prepare payload contents
+    args = [data['cmd']]
+
+    if data['runas'] is not None and data['runas'] != '':
+        args.append(f"runas={data['runas']}")
+
+    if data['args'] is not None and data['args'] != '':
+        args.extend(data['args'])
+
+    low_state = batch_low_state(data, args)
+
+    # login to the API
+    client = SaltApiClient(api_url=data['url'], ignore_ssl_errors=not data['verify_ssl'])
+    try:
+        response = client.login(username=data['user'], password=data['password'], eauth=data['eauth'])
+        log.debug('Logging into API: %s', Preview(response))
+
+        # send payload, the response holds the returns of all batches
+        response = client.low(lowstate=[low_state])
+    except PepperException as exception:
+        print(str(exception))
+        sys.exit(1)
+    except ValueError as exception:
+        log.error('Unable to parse the server response: %s', exception)
+        sys.exit(1)
+    finally:
+        client.close()
+    log.debug('Received raw response: %s', Preview(response))
+
+    results = collect_batch_returns(response)
+    missing = [minion for minion in targeted if minion not in results]
+
+    report, return_code = format_report(results, missing)
+
+    if data['report']:
+        try:
+            write_report(data['report'], results, missing)
+        except OSError as exception:
+            log.error('Unable to write the report %s: %s', data['report'], exception)
+            return_code = return_code or 1
+
+    # print report to stdout for Rundeck to pickup
+    print(report)
+
+    # rundeck reads return code
+    sys.exit(return_code)
+
+
+if __name__ == '__main__':
+    main()
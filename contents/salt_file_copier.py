@@ -2,16 +2,12 @@
 
 import logging
 import os
-import stat
 import sys
-import gzip
-import base64
-import io
 
-from pepper import Pepper
 from pepper.exceptions import PepperException
 
-from common import DataItem, parse_data, sanitize_dict
+from common import DataItem, Preview, SaltApiClient, batch_low_states, chunk_low_states, parse_data, profiled, \
+    sanitize_dict
 
 # Configure the logging system
 log = logging.getLogger(__name__)
@@ -22,69 +18,57 @@ console.setStream(sys.stderr)
 log.addHandler(console)
 
 
-def compress_file(file_obj, compresslevel=9, chunk_size=1048576):
+def chunk_retcodes(response, host, count):
     """
-    Copied from saltstack's salt.utils.gzip_util.compress_file
-
-    Generator that reads chunk_size bytes at a time from a file/filehandle and
-    yields the compressed result of each read.
-
-    .. note::
-        Each chunk is compressed separately. They cannot be stitched together
-        to form a compressed file. This function is designed to break up a file
-        into compressed chunks for transport and decompression/reassembly on a
-        remote host.
-
-    :param file_obj: The file object or path to the file to be compressed.
-    :type file_obj: file or str
-    :param compresslevel: The compression level, ranging from 0 to 9. Defaults to 9.
-    :type compresslevel: int, optional
-    :param chunk_size: The size of each chunk to read and compress, in bytes. Defaults to 1048576 (1MB).
-    :type chunk_size: int, optional
-    :return: The compressed data chunk.
-    :rtype: bytes
+    Return the retcode of each chunk of a request, in the order of its low
+    states. A chunk without return counts as failed.
+
+    :param response: The response of the Salt-API to the request.
+    :type response: dict
+    :param host: The minion id receiving the file.
+    :type host: str
+    :param count: The number of chunks of the request.
+    :type count: int
+    :return: The retcode of each chunk.
+    :rtype: list
     """
-    try:
-        bytes_read = int(chunk_size)
-        if bytes_read != chunk_size:
-            raise ValueError
-    except ValueError:
-        raise ValueError("chunk_size must be an integer")
-    try:
-        while bytes_read == chunk_size:
-            buf = io.BytesIO()
-            with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=compresslevel) as gzipf:
-                try:
-                    bytes_read = gzipf.write(file_obj.read(chunk_size))
-                except AttributeError:
-                    # Open the file and re-attempt the read
-                    file_obj = open(file_obj, "rb")
-                    bytes_read = gzipf.write(file_obj.read(chunk_size))
-            yield buf.getvalue()
-    finally:
-        try:
-            file_obj.close()
-        except AttributeError:
-            pass
+    returns = response.get('return', [])
+    retcodes = []
+    for position in range(count):
+        minion_returns = returns[position] if position < len(returns) else {}
+        retcodes.append(minion_returns.get(host, {}).get('retcode', 1))
+    return retcodes
 
 
-def file_mode(path):
+def describe_failure(retcodes, transferred, total_chunks):
     """
-    Get mode from path.
-
-    Returns file permissions including the sticky bit as integer
-
-    :param path: The path to the file.
-    :type path: str
-    :return: The file permissions.
-    :rtype: int
+    Describe the state of the destination after a request with a failed
+    chunk.
+
+    The Salt-API runs the chunks of a request one after another, even if one
+    of them failed. A later chunk which succeeded is appended after the gap of
+    the failed chunk, so the destination is corrupt.
+
+    :param retcodes: The retcode of each chunk of the request.
+    :type retcodes: list
+    :param transferred: The number of chunks transferred by earlier requests.
+    :type transferred: int
+    :param total_chunks: The number of chunks of the file.
+    :type total_chunks: int
+    :return: The description, empty if no chunk was written.
+    :rtype: str
     """
-    try:
-        return int(oct(stat.S_IMODE(os.stat(path).st_mode)))
-    except (TypeError, IndexError, ValueError):
-        return None
+    first = next(position for position, retcode in enumerate(retcodes) if retcode != 0)
+    appended = sum(1 for retcode in retcodes[first + 1:] if retcode == 0)
+    if appended:
+        return (f" File corrupt: chunk {transferred + first + 1} of {total_chunks} failed, but {appended} "
+                f"later chunk(s) of the same request were still appended.")
+    if transferred + first > 0:
+        return f" File partially transferred ({transferred + first} of {total_chunks} chunks)."
+    return ""
 
 
+@profiled('salt-file-copier')
 def main():
     """
     Main function to execute the file transfer via Salt-API
@@ -97,6 +81,8 @@ def main():
         DataItem('src', 'RD_FILE_COPY_FILE', 'str'),
         DataItem('dest', 'RD_FILE_COPY_DESTINATION', 'str'),
         DataItem('chunk-size', 'RD_CONFIG_SALT_FILE_COPY_CHUNK_SIZE', 'int'),
+        DataItem('request-size', 'RD_CONFIG_SALT_FILE_COPY_REQUEST_SIZE', 'int'),
+        DataItem('request-compression', 'RD_CONFIG_SALT_FILE_COPY_REQUEST_COMPRESSION', 'bool'),
         DataItem('url', 'RD_CONFIG_URL', 'str'),
         DataItem('eauth', 'RD_CONFIG_EAUTH', 'str'),
         DataItem('user', 'RD_CONFIG_USER', 'str'),
@@ -105,7 +91,7 @@ def main():
         DataItem('log-level', 'RD_JOB_LOGLEVEL', 'str'),
     ]
     data = parse_data(data_items)
-    log.debug(f"Data: {sanitize_dict(data, ['password'])}")
+    log.debug('Data: %s', sanitize_dict(data, ['password']))
 
     # use rundeck's log level if defined
     if data['log-level'] == 'DEBUG':
@@ -133,69 +119,69 @@ def main():
             os.path.isfile(src) and \
             os.access(src, os.R_OK):
 
-        log.debug(f'Normalized source path is: {src}')
+        log.debug('Normalized source path is: %s', src)
     else:
-        log.error(f'The specified source file is not readable: {data["src"]}')
+        log.error('The specified source file is not readable: %s', data['src'])
         sys.exit(1)
 
     dest = os.path.normpath(data['dest'])
-    log.debug(f'Normalized destination path is: {dest}')
+    log.debug('Normalized destination path is: %s', dest)
 
     # set default chunk-size if not provided
     if data['chunk-size'] is None or data['chunk-size'] == "":
         data['chunk-size'] = 1048576
-    log.debug(f'Chunk-size: {data["chunk-size"]}')
+    log.debug('Chunk-size: %s', data['chunk-size'])
+
+    # by default every chunk is sent in its own request
+    if data['request-size'] is None or data['request-size'] == "":
+        data['request-size'] = 0
+    log.debug('Request-size: %s', data['request-size'])
 
     # login to the API
-    client = Pepper(api_url=data['url'], ignore_ssl_errors=not data['verify_ssl'])
+    client = SaltApiClient(api_url=data['url'], ignore_ssl_errors=not data['verify_ssl'],
+                           compress_requests=bool(data['request-compression']))
     try:
         response = client.login(username=data['user'], password=data['password'], eauth=data['eauth'])
     except PepperException as exception:
         print(str(exception))
         sys.exit(1)
-    log.debug(f'Logging into API: {response}')
-
-    for index, chunk in enumerate(compress_file(src, chunk_size=data['chunk-size']), start=1):
-        chunk = base64.b64encode(chunk).decode('ascii')
-        append = index > 1
+    log.debug('Logging into API: %s', Preview(response))
 
-        # arguments for cp.recv_chunked, gzipped
-        args = [dest, chunk, append, True, file_mode(src)]
+    # number of chunks yielded by compress_file, including the trailing empty
+    # chunk if the file size is a multiple of the chunk-size
+    total_chunks = os.path.getsize(src) // data['chunk-size'] + 1
 
-        # payload
-        low_state = {
-            'client': 'local',
-            'tgt': data['host'],
-            'fun': 'cp.recv_chunked',
-            'arg': args,
-            'full_return': True,  # full return to get retcode
-        }
+    low_states = chunk_low_states(data['host'], src, dest, data['chunk-size'])
+    transferred = 0
 
-        log.debug(f'Low state Payload: {low_state}')
+    for batch in batch_low_states(low_states, data['request-size']):
+        log.debug('Sending %s chunk(s) in one request', len(batch))
+        log.debug('Low state Payload: %s', Preview(batch))
 
         # send payload
         try:
-            response = client.low(lowstate=[low_state])
+            response = client.low(lowstate=batch)
         except PepperException as exception:
             print(str(exception))
             sys.exit(1)
-        log.debug(f'Received raw response: {response}')
+        log.debug('Received raw response: %s', Preview(response))
 
-        # filter response
-        minion_response = response.get('return', [{}])[0].get(data['host'], {})
-        return_code = minion_response.get('retcode', 1)
-
-        if return_code != 0:
+        # a failed chunk does not stop the later chunks of its request
+        retcodes = chunk_retcodes(response, data['host'], len(batch))
+        failed = [position for position, retcode in enumerate(retcodes) if retcode != 0]
+        if failed:
             # Publish failed
             log.critical(
                 "Publish failed.{} It may be necessary to "
                 "decrease the chunk-size (current value: "
                 "{})".format(
-                    " File partially transferred." if index > 1 else "",
+                    describe_failure(retcodes, transferred, total_chunks),
                     data['chunk-size'],
                 )
             )
-            sys.exit(return_code)
+            sys.exit(retcodes[failed[0]])
+
+        transferred += len(batch)
 
     sys.exit(0)
 
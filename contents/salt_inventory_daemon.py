@@ -0,0 +1,388 @@
+#!/usr/bin/env python -u
+import logging
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from typing import Optional, Set, Tuple
+
+from pepper.exceptions import PepperException
+
+from common import DataItem, Preview, SaltApiClient, iter_events, json_dumps, json_loads, parse_data, sanitize_dict
+
+log = logging.getLogger(__name__)
+
+# functions whose returns are the minion's grains
+GRAINS_FUNCTIONS = ('grains.items', 'grains.item')
+
+# functions changing the minion's grains, which are collected again afterwards
+GRAINS_REFRESH_FUNCTIONS = ('saltutil.refresh_grains', 'saltutil.sync_grains', 'saltutil.sync_all', 'grains.setval',
+                            'grains.setvals', 'grains.append', 'grains.delkey', 'grains.delval', 'grains.remove')
+
+# seconds to wait before reconnecting to the event stream, doubled after
+# each failed attempt
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 60
+
+# seconds after which the snapshot is written to record that the event
+# stream is still alive, even if the grains did not change
+HEARTBEAT_INTERVAL = 60
+
+
+def empty_index() -> dict:
+    """
+    Return an empty grains index.
+    """
+    return {'updated': None, 'minions': {}}
+
+
+def load_snapshot(path: str) -> dict:
+    """
+    Load the grains index from its snapshot, or return an empty index if the
+    snapshot does not exist or cannot be read.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as snapshot_file:
+            index = json_loads(snapshot_file.read())
+    except FileNotFoundError:
+        return empty_index()
+    except (OSError, ValueError) as exception:
+        log.warning('Ignoring unreadable snapshot %s: %s', path, exception)
+        return empty_index()
+
+    if not isinstance(index, dict) or not isinstance(index.get('minions'), dict):
+        log.warning('Ignoring malformed snapshot %s', path)
+        return empty_index()
+
+    return index
+
+
+def write_snapshot(path: str, index: dict):
+    """
+    Atomically replace the snapshot of the grains index.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.inventory-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as snapshot_file:
+            snapshot_file.write(json_dumps(index))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class SnapshotFlusher(threading.Thread):
+    """
+    Writes the snapshot of the grains index every flush interval if the index
+    changed, independently of the arrival of events.
+
+    The index is only modified while holding the lock of the flusher.
+    """
+
+    def __init__(self, path: str, index: dict, interval: float):
+        super().__init__(name='snapshot-flusher', daemon=True)
+        self.path = path
+        self.index = index
+        self.interval = interval
+        self.lock = threading.Lock()
+        self._changed = False
+        self._written_alive = index.get('alive') or 0
+        self._stopped = threading.Event()
+
+    def mark_changed(self):
+        """
+        Mark the index as changed, to be written with the next flush. The
+        caller holds the lock.
+        """
+        self._changed = True
+
+    def heartbeat(self, now: float):
+        """
+        Record that the event stream is alive. The snapshot is written for it
+        at most every HEARTBEAT_INTERVAL seconds. The caller holds the lock.
+        """
+        self.index['alive'] = now
+        if now - self._written_alive >= HEARTBEAT_INTERVAL:
+            self._changed = True
+
+    def flush(self):
+        """
+        Write the snapshot if the index changed since the last flush.
+        """
+        with self.lock:
+            if not self._changed:
+                return
+            try:
+                write_snapshot(self.path, self.index)
+            except OSError as exception:
+                log.error('Unable to write the snapshot %s: %s', self.path, exception)
+                return
+            self._changed = False
+            self._written_alive = self.index.get('alive') or 0
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.flush()
+
+    def stop(self):
+        """
+        Stop flushing periodically and write the pending changes.
+        """
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
+
+
+def apply_event(index: dict, event: dict, now: float) -> Tuple[bool, Set[str]]:
+    """
+    Update the grains index with an event of the Salt master's event bus.
+
+    :param index: The grains index, updated in place
+    :param event: The event with its tag and data
+    :param now: The time of the event
+
+    :returns: Whether the index changed, and the minions whose grains have to
+              be collected again
+    """
+    tag = event.get('tag', '')
+    data = event.get('data')
+    if not isinstance(data, dict):
+        return False, set()
+
+    parts = tag.split('/')
+
+    # salt/minion/<id>/start, the grains may have changed with the restart
+    if len(parts) == 4 and parts[:2] == ['salt', 'minion'] and parts[3] == 'start':
+        return False, {parts[2]}
+
+    # salt/key, a key was accepted, rejected or deleted
+    if tag == 'salt/key':
+        minion = data.get('id')
+        if not minion:
+            return False, set()
+        if data.get('act') == 'accept':
+            return False, {minion}
+        if data.get('act') in ('delete', 'reject') and minion in index['minions']:
+            del index['minions'][minion]
+            index['updated'] = now
+            return True, set()
+        return False, set()
+
+    # salt/job/<jid>/ret/<id>, the return of a minion
+    if len(parts) == 5 and parts[:2] == ['salt', 'job'] and parts[3] == 'ret':
+        minion = parts[4]
+        fun = data.get('fun')
+        if data.get('success') is False:
+            return False, set()
+
+        if fun in GRAINS_FUNCTIONS and isinstance(data.get('return'), dict):
+            grains = data['return']
+            if fun == 'grains.item' and minion in index['minions']:
+                # only some grains were returned
+                grains = dict(index['minions'][minion]['grains'], **grains)
+            index['minions'][minion] = {'grains': grains, 'updated': now}
+            index['updated'] = now
+            return True, set()
+
+        if fun in GRAINS_REFRESH_FUNCTIONS:
+            return False, {minion}
+
+    return False, set()
+
+
+def publish_grains_collection(client: SaltApiClient, tgt: str, tgt_type: Optional[str] = None):
+    """
+    Ask the targeted minions for their grains without waiting for the
+    returns, which are received from the event stream.
+    """
+    low_state = {
+        'client': 'local_async',
+        'tgt': tgt,
+        'fun': 'grains.items',
+    }
+    if tgt_type is not None:
+        low_state['tgt_type'] = tgt_type
+
+    response = client.low(lowstate=[low_state])
+    log.debug('Published grains collection: %s', Preview(response))
+
+
+def prune_index(client: SaltApiClient, index: dict, now: float) -> bool:
+    """
+    Remove the minions whose keys are no longer accepted, e.g. deleted while
+    the event stream was disconnected. Returns whether the index changed.
+    """
+    low_state = {
+        'client': 'wheel',
+        'fun': 'key.list',
+        'match': 'accepted',
+    }
+    ret = client.low(lowstate=[low_state]).get('return', [{}])[0]
+    try:
+        accepted = set(ret['data']['return']['minions'])
+    except (KeyError, TypeError):
+        log.error('Unable to list accepted minions: %s', Preview(ret))
+        return False
+
+    removed = set(index['minions']) - accepted
+    for minion in removed:
+        del index['minions'][minion]
+    if removed:
+        log.info('Removed minions without accepted keys: %s', ', '.join(sorted(removed)))
+        index['updated'] = now
+
+    return bool(removed)
+
+
+def follow_events(data: dict, index: dict, flusher: SnapshotFlusher) -> int:
+    """
+    Follow the event stream until it ends or stays silent for the read
+    timeout, keeping the grains index up to date. The flusher writes the
+    snapshot of the index.
+
+    Once subscribed, the index is backfilled: minions whose keys were deleted
+    meanwhile are removed and, at most every backfill interval, the targeted
+    minions are asked for their grains, as events may have been missed while
+    disconnected.
+
+    :returns: The number of events received
+    :raises PepperException: if a request to the API failed
+    """
+    # the read timeout detects a half-open connection of the stream
+    stream_client = SaltApiClient(api_url=data['url'], ignore_ssl_errors=not data['verify_ssl'],
+                                  timeout=data['read-timeout'])
+    stream_client.login(username=data['user'], password=data['password'], eauth=data['eauth'])
+
+    # the stream occupies the connection, other requests use a second one
+    client = SaltApiClient(api_url=data['url'], ignore_ssl_errors=not data['verify_ssl'])
+    client.auth = stream_client.auth
+
+    stream = stream_client.events()
+    log.info('Subscribed to the event stream of %s', data['url'])
+
+    received = 0
+    try:
+        now = time.time()
+        with flusher.lock:
+            flusher.heartbeat(now)
+            if prune_index(client, index, now):
+                flusher.mark_changed()
+
+        if now - (index.get('backfilled') or 0) >= data['backfill-interval']:
+            publish_grains_collection(client, data['tgt'])
+            with flusher.lock:
+                index['backfilled'] = now
+                flusher.mark_changed()
+
+        for event in iter_events(stream):
+            received += 1
+            with flusher.lock:
+                flusher.heartbeat(time.time())
+                changed, refresh = apply_event(index, event, time.time())
+                if changed:
+                    flusher.mark_changed()
+
+            if refresh:
+                log.debug('Collecting grains of %s after %s', ', '.join(sorted(refresh)), event['tag'])
+                publish_grains_collection(client, ','.join(sorted(refresh)), 'list')
+    except socket.timeout:
+        log.info('No event received for %s seconds, reconnecting', data['read-timeout'])
+    finally:
+        stream.close()
+        stream_client.close()
+        client.close()
+        flusher.flush()
+
+    log.info('The event stream ended after %s events', received)
+    return received
+
+
+def _terminate(signum, frame):
+    sys.exit(0)
+
+
+def main():
+    """
+    Main function of the inventory service
+
+    It follows the Salt-API event stream and keeps a snapshot of the grains
+    of all minions, which is read by the resource model source with the
+    'events' collector. Its configuration is read from environment variables.
+    """
+    data_items = [
+        DataItem('url', 'SALT_API_URL', 'str'),
+        DataItem('eauth', 'SALT_API_EAUTH', 'str'),
+        DataItem('user', 'SALT_API_USER', 'str'),
+        DataItem('password', 'SALT_API_PASSWORD', 'str'),
+        DataItem('verify_ssl', 'SALT_API_VERIFYSSL', 'bool'),
+        DataItem('tgt', 'SALT_INVENTORY_TGT', 'str'),
+        DataItem('snapshot', 'SALT_INVENTORY_SNAPSHOT', 'str'),
+        DataItem('flush-interval', 'SALT_INVENTORY_FLUSH_INTERVAL', 'int'),
+        DataItem('read-timeout', 'SALT_INVENTORY_READ_TIMEOUT', 'int'),
+        DataItem('backfill-interval', 'SALT_INVENTORY_BACKFILL_INTERVAL', 'int'),
+        DataItem('log-level', 'SALT_INVENTORY_LOG_LEVEL', 'str'),
+    ]
+
+    data = parse_data(data_items)
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+    log.setLevel(logging.getLevelName(data['log-level'] or 'INFO'))
+    log.debug('Data: %s', sanitize_dict(data, ['password']))
+
+    # Ensure defaults if parameter not set
+    if data['tgt'] is None:
+        data['tgt'] = '*'
+    if data['flush-interval'] is None:
+        data['flush-interval'] = 5
+    if data['read-timeout'] is None:
+        data['read-timeout'] = 300
+    if data['backfill-interval'] is None:
+        data['backfill-interval'] = 600
+    if data['verify_ssl'] is None:
+        data['verify_ssl'] = True
+
+    # Sanity checks for required input
+    for key in ['url', 'eauth', 'user', 'password', 'snapshot']:
+        if not data[key]:
+            log.error('No %s specified.', key)
+            sys.exit(1)
+
+    # write the snapshot when stopped by the service manager
+    signal.signal(signal.SIGTERM, _terminate)
+
+    index = load_snapshot(data['snapshot'])
+    log.info('Loaded %s minions from %s', len(index['minions']), data['snapshot'])
+
+    flusher = SnapshotFlusher(data['snapshot'], index, data['flush-interval'])
+    flusher.start()
+
+    delay = RECONNECT_DELAY
+    try:
+        while True:
+            subscribed = time.monotonic()
+            try:
+                received = follow_events(data, index, flusher)
+                # a stream silent until the read timeout was healthy as well
+                if received or time.monotonic() - subscribed >= MAX_RECONNECT_DELAY:
+                    delay = RECONNECT_DELAY
+            except PepperException as exception:
+                log.error('Following the event stream failed: %s', exception)
+            except ValueError as exception:
+                log.error('Unable to parse the server response: %s', exception)
+
+            log.info('Reconnecting in %s seconds', delay)
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+    finally:
+        flusher.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,223 @@
 #!/usr/bin/env python -u
+import base64
+import io
 import logging
+import os
 import sys
+import tempfile
+import time
+import zlib
+
+from typing import Optional
 
-from pepper import Pepper
 from pepper.exceptions import PepperException
 
-from common import DataItem, parse_data, sanitize_dict
+from common import DataItem, Preview, SaltApiClient, lookup_jid_low_state, parse_data, profiled, sanitize_dict
 
 log = logging.getLogger(__name__)
 
+# seconds between the lookups of the return of a command with timeout
+POLL_INTERVAL = 1
+
+# return code of commands killed after their timeout, as of coreutils' timeout
+TIMEOUT_RETCODE = 124
+
+# marker of the trailer carrying the command's retcode in compressed output
+RETCODE_MARKER = '__rundeck_salt_retcode__'
+
+# bytes of decompressed output held back while decoding, to strip the trailer
+TRAILER_SIZE = 64
+
+# prefix of the names of spill files
+SPILL_PREFIX = 'salt-node-executor-'
+
+# spill files kept in the spill directory by default
+SPILL_KEEP = 20
+
+
+def compressed_command(command: str) -> str:
+    """
+    Wrap the command into a shell pipeline compressing its output with gzip
+    and encoding it with base64 on the minion.
+
+    The command's stderr is merged into its output, as by cmd.run, and its
+    retcode is appended as trailer, since the pipeline returns the retcode
+    of base64.
+    """
+    # the newline ends a trailing comment of the command
+    return (f"{{ ( {command}\n) 2>&1; printf '\\n{RETCODE_MARKER} %s\\n' \"$?\"; }} "
+            f"| gzip -c | base64")
+
+
+def decode_compressed_output(encoded: str, out, read_size: int = 65536) -> int:
+    """
+    Decode the output of a compressed command while it is decompressed,
+    writing it to the binary stream out, and return the command's retcode
+    from the trailer.
+
+    As by cmd.run, trailing whitespace of the output is stripped.
+
+    :param encoded: The base64 encoded, gzip compressed output
+    :param out: The binary stream the output is written to
+    :param read_size: The number of characters decoded at once
+    :raises ValueError: if the output cannot be decoded or has no trailer
+    """
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    carry = ''
+    pending = b''
+    try:
+        for start in range(0, len(encoded), read_size):
+            # base64 is decoded in groups of four characters, line breaks
+            # are dropped
+            piece = carry + ''.join(encoded[start:start + read_size].split())
+            usable = len(piece) - len(piece) % 4
+            carry = piece[usable:]
+            pending += decompressor.decompress(base64.b64decode(piece[:usable], validate=True))
+
+            # hold back the trailer and trailing whitespace
+            held = max(len(pending) - len(pending.rstrip()), TRAILER_SIZE)
+            if len(pending) > held:
+                out.write(pending[:-held])
+                pending = pending[-held:]
+        pending += decompressor.flush()
+    except zlib.error as exception:
+        raise ValueError(f'Unable to decompress the output: {exception}')
+
+    if carry or not decompressor.eof:
+        raise ValueError('The compressed output ended prematurely')
+
+    marker = f'\n{RETCODE_MARKER} '.encode('ascii')
+    index = pending.rfind(marker)
+    if index < 0:
+        raise ValueError('The compressed output has no retcode trailer')
+
+    out.write(pending[:index].rstrip())
+    return int(pending[index + len(marker):])
+
+
+def spill_output(output: str, spill_dir: str, host: str) -> str:
+    """
+    Write the complete output of a command to a new file in the spill
+    directory and return its path.
+    """
+    os.makedirs(spill_dir, exist_ok=True)
+
+    # the file name is unique, even for commands within the same second
+    prefix = f"{SPILL_PREFIX}{host}-{time.strftime('%Y%m%dT%H%M%S')}-"
+    fd, path = tempfile.mkstemp(dir=spill_dir, prefix=prefix, suffix='.log')
+    with os.fdopen(fd, 'w', encoding='utf-8') as spill_file:
+        spill_file.write(output)
+
+    return path
+
+
+def prune_spill_files(spill_dir: str, keep: int):
+    """
+    Remove all but the latest keep spill files from the spill directory.
+    """
+    spill_files = []
+    for entry in os.scandir(spill_dir):
+        if entry.name.startswith(SPILL_PREFIX) and entry.name.endswith('.log'):
+            try:
+                spill_files.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                continue
+
+    for _, path in sorted(spill_files)[:-keep]:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
 
+def bound_output(output: str, limit: int, spill_path: Optional[str]) -> str:
+    """
+    Cut the output of a command down to its head and tail of together at most
+    limit bytes, noting the omitted bytes and the spill file of the complete
+    output in between.
+
+    :param output: The complete output
+    :param limit: The maximum number of bytes of the output kept
+    :param spill_path: The spill file of the complete output, or None if it
+                       could not be written
+    """
+    encoded = output.encode('utf-8')
+    head_size = limit // 2
+    tail_size = limit - head_size
+
+    # characters cut in half at the edges are dropped
+    head = encoded[:head_size].decode('utf-8', 'ignore')
+    tail = encoded[len(encoded) - tail_size:].decode('utf-8', 'ignore') if tail_size else ''
+    omitted = len(encoded) - head_size - tail_size
+
+    if spill_path is None:
+        return f'{head}\n... {omitted} of {len(encoded)} bytes omitted ...\n{tail}'
+    return f'{head}\n... {omitted} of {len(encoded)} bytes omitted, the complete output is in {spill_path} ...\n{tail}'
+
+
+def run_all_return(ret) -> dict:
+    """
+    Convert the return of cmd.run_all into the full return of cmd.run, with
+    the command's output as return and its retcode.
+    """
+    if not isinstance(ret, dict) or 'retcode' not in ret:
+        # e.g. an error message of the minion
+        return {'ret': ret, 'retcode': 1}
+
+    output = '\n'.join(stream for stream in (ret.get('stdout', ''), ret.get('stderr', '')) if stream)
+    return {'ret': output, 'retcode': ret['retcode']}
+
+
+def run_with_timeout(client: SaltApiClient, low_state: dict, host: str, timeout: int) -> Optional[dict]:
+    """
+    Publish the command asynchronously and poll the job cache for the
+    minion's return until the timeout passed. A command still running by
+    then is killed on the minion with saltutil.kill_job.
+
+    The command is run by cmd.run_all, whose return includes the retcode,
+    with its stderr merged into stdout as by cmd.run.
+
+    :returns: The full return of the minion, an empty dictionary if the
+              minion was not targeted, or None if the command timed out
+    :raises PepperException: if publishing the job failed
+    """
+    deadline = time.monotonic() + timeout
+    async_low_state = dict(low_state, client='local_async', fun='cmd.run_all',
+                           arg=low_state['arg'] + ['redirect_stderr=True'])
+    async_low_state.pop('full_return', None)
+    async_low_state.pop('gather_job_timeout', None)
+
+    job = client.low(lowstate=[async_low_state]).get('return', [{}])[0]
+    if not isinstance(job, dict) or not job.get('jid'):
+        raise PepperException(f'Publishing the job failed: {job}')
+    if host not in job.get('minions', []):
+        return {}
+    log.debug('Published job %s to %s with a timeout of %s seconds', job['jid'], host, timeout)
+
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(POLL_INTERVAL, remaining))
+
+        ret = client.low(lowstate=[lookup_jid_low_state(job['jid'])]).get('return', [{}])[0]
+        if isinstance(ret, dict) and host in ret:
+            log.debug('Received return of %s: %s', host, Preview(ret[host]))
+            return run_all_return(ret[host])
+
+    kill_low_state = {
+        'client': 'local',
+        'tgt': host,
+        'fun': 'saltutil.kill_job',
+        'arg': [job['jid']],
+    }
+    response = client.low(lowstate=[kill_low_state])
+    log.debug('Killed job %s on %s: %s', job['jid'], host, Preview(response))
+
+    return None
+
+
+@profiled('salt-node-executor')
 def main():
     """
     Main function to execute remote commands via Salt-API
@@ -23,6 +231,13 @@ def main():
         DataItem('runas', 'RD_CONFIG_RUNAS', 'str'),
         DataItem('args', 'RD_CONFIG_CMD_RUN_ARGS', 'shstr'),
         DataItem('node-args', 'RD_NODE_SALT_CMD_RUN_ARGS', 'shstr'),
+        DataItem('output-limit', 'RD_CONFIG_OUTPUT_LIMIT', 'int'),
+        DataItem('spill-dir', 'RD_CONFIG_SPILL_DIR', 'str'),
+        DataItem('spill-keep', 'RD_CONFIG_SPILL_KEEP', 'int'),
+        DataItem('timeout', 'RD_CONFIG_EXECUTION_TIMEOUT', 'int'),
+        DataItem('node-timeout', 'RD_NODE_SALT_EXECUTION_TIMEOUT', 'int'),
+        DataItem('gather-timeout', 'RD_CONFIG_GATHER_TIMEOUT', 'int'),
+        DataItem('output-compression', 'RD_CONFIG_OUTPUT_COMPRESSION', 'bool'),
         DataItem('url', 'RD_CONFIG_URL', 'str'),
         DataItem('eauth', 'RD_CONFIG_EAUTH', 'str'),
         DataItem('user', 'RD_CONFIG_USER', 'str'),
@@ -32,7 +247,7 @@ def main():
     ]
 
     data = parse_data(data_items)
-    log.debug(f"Data: {sanitize_dict(data, ['password'])}")
+    log.debug('Data: %s', sanitize_dict(data, ['password']))
 
     # use rundeck's log level if defined
     if data['log-level'] == 'DEBUG':
@@ -49,7 +264,7 @@ def main():
             sys.exit(1)
 
     # prepare payload contents
-    args = [data['cmd']]
+    args = [compressed_command(data['cmd']) if data['output-compression'] else data['cmd']]
 
     if data['runas'] is not None and data['runas'] != '':
         args.append(f"runas={data['runas']}")
@@ -68,31 +283,77 @@ def main():
         'arg': args,
         'full_return': True,  # full return to get retcode
     }
+    if data['gather-timeout'] is not None:
+        low_state['gather_job_timeout'] = data['gather-timeout']
+
+    # the node's timeout takes precedence over the project's
+    timeout = data['node-timeout'] if data['node-timeout'] is not None else data['timeout']
 
     # login to the API
-    client = Pepper(api_url=data['url'], ignore_ssl_errors=not data['verify_ssl'])
+    client = SaltApiClient(api_url=data['url'], ignore_ssl_errors=not data['verify_ssl'])
     try:
         response = client.login(username=data['user'], password=data['password'], eauth=data['eauth'])
     except PepperException as exception:
         print(str(exception))
         sys.exit(1)
-    log.debug(f'Logging into API: {response}')
+    log.debug('Logging into API: %s', Preview(response))
 
     # send payload
     try:
-        response = client.low(lowstate=[low_state])
+        if timeout:
+            minion_response = run_with_timeout(client, low_state, data['host'], timeout)
+        else:
+            response = client.low(lowstate=[low_state])
+            log.debug('Received raw response: %s', Preview(response))
+            minion_response = response.get('return', [{}])[0].get(data['host'], {})
     except PepperException as exception:
         print(str(exception))
         sys.exit(1)
-    log.debug(f'Received raw response: {response}')
+    except ValueError as exception:
+        log.error('Unable to parse the server response: %s', exception)
+        sys.exit(1)
+
+    if minion_response is None:
+        print(f'The command did not finish within {timeout} seconds and was killed.')
+        sys.exit(TIMEOUT_RETCODE)
 
     # filter response
-    minion_response = response.get('return', [{}])[0].get(data['host'], {})
-    data = minion_response.get('ret', 'No response received')
+    output = minion_response.get('ret', 'No response received')
     return_code = minion_response.get('retcode', 1)
 
+    # decode compressed output, straight to stdout unless it is bounded
+    if data['output-compression'] and return_code == 0 and isinstance(output, str):
+        decoded = io.BytesIO() if data['output-limit'] else sys.stdout.buffer
+        sys.stdout.flush()
+        try:
+            return_code = decode_compressed_output(output, decoded)
+        except ValueError as exception:
+            log.error('Unable to decode the compressed output: %s', exception)
+            sys.exit(1)
+
+        if not data['output-limit']:
+            decoded.write(b'\n')
+            sys.exit(return_code)
+        output = decoded.getvalue().decode('utf-8', 'replace')
+
+    # spill output beyond the limit to a file
+    if data['output-limit'] and len(str(output).encode('utf-8')) > data['output-limit']:
+        spill_dir = data['spill-dir'] or tempfile.gettempdir()
+        try:
+            spill_path = spill_output(str(output), spill_dir, data['host'])
+        except OSError as exception:
+            log.error('Unable to write the output to the spill directory: %s', exception)
+            spill_path = None
+
+        # spill files do not pile up with every command of large output
+        try:
+            prune_spill_files(spill_dir, data['spill-keep'] or SPILL_KEEP)
+        except OSError as exception:
+            log.warning('Unable to remove old spill files: %s', exception)
+        output = bound_output(str(output), data['output-limit'], spill_path)
+
     # print response to stdout for Rundeck to pickup
-    print(data)
+    print(output)
 
     # rundeck reads return code
     sys.exit(return_code)
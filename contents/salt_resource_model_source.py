@@ -1,15 +1,65 @@
 #!/usr/bin/env python -u
+import fcntl
+import fnmatch
+import hashlib
 import logging
+import math
+import os
+import signal
 import sys
 import json
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional, Tuple
 
-from pepper import Pepper
 from pepper.exceptions import PepperException
 
-from common import DataItem, parse_data, sanitize_dict
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from common import DataItem, Preview, SaltApiClient, iter_low_state_return, json_dumps, json_loads, \
+    lookup_jid_low_state, parse_data, profiled, sanitize_dict
 
 log = logging.getLogger(__name__)
 
+# delimiter of nested keys as used by salt's grains.item
+DEFAULT_TARGET_DELIM = ':'
+
+COLLECTORS = ('minions', 'master-cache', 'async', 'events', 'local-cache')
+
+# runners listing the live minions for presence-filtered targeting
+PRESENCE_RUNNERS = ('manage.up', 'manage.alived')
+
+# the master's minion data cache, as kept by salt's localfs cache
+LOCAL_CACHE_DIR = '/var/cache/salt/master/minions'
+
+# seconds between polls of the job cache by the async collector
+ASYNC_POLL_INTERVAL = 1
+
+# tags and attributes with this prefix are taken from the pillar
+PILLAR_PREFIX = 'pillar:'
+
+# attributes of Rundeck's nodes which are not overwritten by grains
+RESERVED_KEYS = {'nodename', 'hostname', 'username', 'description', 'tags', 'osFamily', 'osArch', 'osName',
+                 'osVersion', 'editUrl', 'remoteUrl'}
+
+OS_FAMILY_MAP = {
+    'Linux': 'unix',
+    'AIX': 'unix',
+    'MacOS': 'unix',
+    'VMware': 'unix',
+    'Windows': 'windows'
+}
+
+# settings which can be specified per master of a federated resource model
+MASTER_KEYS = ('url', 'eauth', 'user', 'verify_ssl', 'tgt', 'prefix')
+
+_MISSING = object()
+
 
 def configure_logging(log_level: str):
     """
@@ -19,20 +69,148 @@ def configure_logging(log_level: str):
     log.setLevel(logging.getLevelName(log_level))
 
 
-def validate_required_inputs(data: dict):
+def sanitize_masters(masters: Optional[str]) -> Optional[str]:
     """
-    Validate required data items provided by Rundeck
+    Replaces passwords within the JSON list of masters with a placeholder,
+    e.g. used for debug output. Unparsable masters are replaced entirely.
     """
-    # Sanity checks for required input
-    for key in ['url', 'eauth', 'user', 'password']:
-        if not data[key]:
-            msg = f'No {key} specified. Command not send.'
-            log.error(msg)
+    if not masters:
+        return masters
+
+    try:
+        parsed = json_loads(masters)
+    except ValueError:
+        return '********'
+
+    if not isinstance(parsed, list):
+        return '********'
+
+    return json_dumps([sanitize_dict(master, ['password']) if isinstance(master, dict) else master
+                       for master in parsed])
+
+
+def master_passwords(data: dict) -> dict:
+    """
+    Return the passwords of the masters by their URL, read from key storage
+    as a JSON object.
+    """
+    if not data.get('masters-passwords'):
+        return {}
+
+    try:
+        passwords = json_loads(data['masters-passwords'])
+    except ValueError:
+        # the secret itself is not logged
+        log.error('Unable to parse the masters passwords, they have to be a JSON object of URLs and passwords')
+        sys.exit(1)
+
+    if not isinstance(passwords, dict) or not all(isinstance(password, str) for password in passwords.values()):
+        log.error('The masters passwords have to be a JSON object of URLs and passwords')
+        sys.exit(1)
+
+    return passwords
+
+
+def master_configurations(data: dict) -> List[dict]:
+    """
+    Return the configuration of each Salt master of a federated resource
+    model. Settings not specified for a master are taken from the source's
+    configuration. The password of a master is taken from the masters
+    passwords in key storage, defaulting to the source's password.
+    """
+    try:
+        masters = json_loads(data['masters'])
+    except ValueError as exception:
+        log.error('Unable to parse the masters: %s', exception)
+        sys.exit(1)
+
+    if not isinstance(masters, list) or not all(isinstance(master, dict) for master in masters):
+        log.error('The masters have to be a JSON list of objects')
+        sys.exit(1)
+
+    # an empty list would skip the validation of the source's configuration
+    if not masters:
+        log.error('The masters have to list at least one master')
+        sys.exit(1)
+
+    passwords = master_passwords(data)
+
+    configurations = []
+    for master in masters:
+        if 'password' in master:
+            log.error('Passwords are not accepted in the masters, keep them in key storage as masters passwords')
             sys.exit(1)
 
+        unknown_keys = set(master) - set(MASTER_KEYS)
+        if unknown_keys:
+            log.error('Unknown master settings %s. Use any of: %s', ', '.join(sorted(unknown_keys)),
+                      ', '.join(MASTER_KEYS))
+            sys.exit(1)
+
+        configuration = dict(data)
+        configuration.update(master)
+        configuration['password'] = passwords.get(configuration['url'], data['password'])
+        configuration['masters'] = None
+        configuration['masters-passwords'] = None
+        configurations.append(configuration)
+
+    return configurations
+
+
+def validate_required_inputs(data: dict):
+    """
+    Validate required data items provided by Rundeck
+    """
     # Ensure defaults if parameter not set
     if data['tgt'] is None:
         data['tgt'] = '*'
+    if not data['collector']:
+        data['collector'] = 'minions'
+    if data['collector'] not in COLLECTORS:
+        log.error('Unknown collector %s. Use one of: %s', data['collector'], ', '.join(COLLECTORS))
+        sys.exit(1)
+    if not data['shard-parallelism']:
+        data['shard-parallelism'] = 4
+    if data['cache-expiry'] is None:
+        data['cache-expiry'] = 604800
+    if data['refresh-budget'] is None:
+        data['refresh-budget'] = 300
+    if data['collector'] == 'local-cache' and msgpack is None:
+        log.error("The 'local-cache' collector requires the python library msgpack")
+        sys.exit(1)
+    if not data['local-cache-dir']:
+        data['local-cache-dir'] = LOCAL_CACHE_DIR
+    if data['collector'] == 'events' and not data['inventory-snapshot']:
+        log.error("No inventory-snapshot specified, which is required by the 'events' collector")
+        sys.exit(1)
+    if data['inventory-max-age'] is None:
+        data['inventory-max-age'] = 900
+    if data['answered-percent'] is None:
+        data['answered-percent'] = 100
+    if not 0 < data['answered-percent'] <= 100:
+        log.error('Answered percent must be between 1 and 100, not %s', data['answered-percent'])
+        sys.exit(1)
+    if data['async-deadline'] is None:
+        data['async-deadline'] = 60
+    if data['presence'] and data['presence'] not in PRESENCE_RUNNERS:
+        log.error('Unknown presence runner %s. Use one of: %s', data['presence'], ', '.join(PRESENCE_RUNNERS))
+        sys.exit(1)
+    if data['presence-ttl'] is None:
+        data['presence-ttl'] = 60
+
+    if data['masters']:
+        data['masters'] = master_configurations(data)
+        configurations = data['masters']
+    else:
+        configurations = [data]
+
+    # Sanity checks for required input
+    for configuration in configurations:
+        for key in ['url', 'eauth', 'user', 'password']:
+            if not configuration[key]:
+                msg = f'No {key} specified. Command not send.'
+                log.error(msg)
+                sys.exit(1)
 
 
 def string_to_unique_set(src: str) -> set:
@@ -57,75 +235,960 @@ def prepare_grains(data: dict) -> set:
     needed_tags  = string_to_unique_set(data.get('tags', None))
     needed_attributes = string_to_unique_set(data.get('attributes', None))
 
-    log.debug(f'Tag grains: {needed_tags}')
-    log.debug(f'Attribute grains: {needed_attributes}')
+    log.debug('Tag grains: %s', needed_tags)
+    log.debug('Attribute grains: %s', needed_attributes)
 
-    return needed_grains | needed_tags | needed_attributes
+    return {key for key in needed_grains | needed_tags | needed_attributes if not key.startswith(PILLAR_PREFIX)}
 
 
-def collect_minions_grains(data, all_needed_grains):
+def prepare_pillar(data: dict) -> set:
     """
-    Execute low state API call and return minions response.
+    Prepare pillar keys for tags and attributes.
+    """
+    needed_keys = string_to_unique_set(data.get('tags', None)) | string_to_unique_set(data.get('attributes', None))
+
+    return {key[len(PILLAR_PREFIX):] for key in needed_keys if key.startswith(PILLAR_PREFIX)}
+
+
+def traverse_dict_and_list(data, key, default=None, delimiter=DEFAULT_TARGET_DELIM):
+    """
+    Copied from saltstack's salt.utils.data.traverse_dict_and_list
+
+    Traverse a dict or list using a colon-delimited (or otherwise delimited,
+    using the 'delimiter' param) target string. The target 'foo:bar:0' will
+    return data['foo']['bar'][0] if this value exists, and will otherwise
+    return the dict in the default argument.
+    Function will automatically determine the target type.
+    The target 'foo:bar:0' will return data['foo']['bar'][0] if data like
+    {'foo':{'bar':['baz']}} , if data like {'foo':{'bar':{'0':'baz'}}}
+    then return data['foo']['bar']['0']
+    """
+    ptr = data
+    if isinstance(key, str):
+        key = key.split(delimiter)
+
+    for each in key:
+        if isinstance(ptr, list):
+            try:
+                idx = int(each)
+            except ValueError:
+                embed_match = False
+                # Index was not numeric, lets look at any embedded dicts
+                for embedded in (x for x in ptr if isinstance(x, dict)):
+                    try:
+                        ptr = embedded[each]
+                        embed_match = True
+                        break
+                    except KeyError:
+                        pass
+                if not embed_match:
+                    # No embedded dicts matched, return the default
+                    return default
+            else:
+                embed_match = False
+                # Index was numeric, lets look at any embedded dicts
+                # using the string representation of the index
+                for embedded in (x for x in ptr if isinstance(x, dict)):
+                    try:
+                        ptr = embedded[each]
+                        embed_match = True
+                        break
+                    except KeyError:
+                        pass
+                if not embed_match:
+                    try:
+                        ptr = ptr[idx]
+                    except IndexError:
+                        return default
+        else:
+            try:
+                ptr = ptr[each]
+            except (KeyError, TypeError):
+                return default
+    return ptr
+
+
+def project_grains(grains: dict, all_needed_grains: set) -> dict:
+    """
+    Reduce a minion's complete grains to the needed grains, the same way
+    salt's grains.item resolves them on the minion.
+    """
+    return {key: traverse_dict_and_list(grains, key, '') for key in all_needed_grains}
+
+
+def api_login(data: dict) -> SaltApiClient:
+    """
+    Login to the API and return the authenticated client.
+
+    :raises PepperException: if the login failed
+    """
+    client = SaltApiClient(api_url=data['url'], ignore_ssl_errors=not data['verify_ssl'])
+    response = client.login(username=data['user'], password=data['password'], eauth=data['eauth'])
+    log.debug('Logging into API: %s', Preview(response))
+
+    return client
+
+
+def send_low_states(client: SaltApiClient, low_states: list) -> dict:
+    """
+    Send low states to the API and return its response.
+
+    :raises PepperException: if the request failed
+    """
+    response = client.low(lowstate=low_states)
+    log.debug('Received raw response: %s', Preview(response))
+
+    return response
+
+
+def presence_low_state(data: dict) -> dict:
+    """
+    Compile the low state listing the live minions with the configured
+    presence runner.
+    """
+    low_state = {
+        'client': 'runner',
+        'fun': data['presence'],
+    }
+
+    # manage.alived lists all minions connected recently, manage.up pings
+    # the targeted minions
+    if data['presence'] == 'manage.up':
+        low_state['tgt'] = data['tgt']
+        if data['timeout'] is not None:
+            low_state['timeout'] = data['timeout']
+        if data['gather-timeout'] is not None:
+            low_state['gather_job_timeout'] = data['gather-timeout']
+
+    return low_state
+
+
+def presence_cache_path(data: dict) -> str:
+    """
+    Return the path of the file caching the live minions for this source's
+    configuration.
+    """
+    key = json.dumps([data['url'], data['tgt'], data['presence']])
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return os.path.join(data['cache-dir'], f'presence-{digest}.json')
+
+
+def load_live_minions(path: str, now: float, ttl: int) -> Optional[List[str]]:
+    """
+    Return the cached live minions, or None if the cache expired or cannot
+    be read.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as cache_file:
+            cache = json_loads(cache_file.read())
+        if now - cache['checked'] < ttl and isinstance(cache['minions'], list):
+            return cache['minions']
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, TypeError) as exception:
+        log.warning('Ignoring unreadable presence cache %s: %s', path, exception)
+
+    return None
+
+
+def live_minions(data: dict, client: SaltApiClient) -> Optional[set]:
+    """
+    Return the live minions according to the presence runner, from the
+    presence cache if it is recent enough. Returns None if presence
+    filtering is disabled or the runner did not return a list of minions.
+    """
+    if not data['presence']:
+        return None
+
+    now = time.time()
+    path = presence_cache_path(data) if data['cache-dir'] else None
+    if path is not None:
+        minions = load_live_minions(path, now, data['presence-ttl'])
+        if minions is not None:
+            log.debug('Using %s live minions from the presence cache', len(minions))
+            return set(minions)
+
+    response = send_low_states(client, [presence_low_state(data)])
+    minions = response.get('return', [None])[0]
+    if not isinstance(minions, list):
+        log.warning('The %s runner did not return a list of minions, targeting all minions: %s', data['presence'],
+                    Preview(minions))
+        return None
+    log.debug('%s returned %s live minions', data['presence'], len(minions))
+
+    if path is not None:
+        write_grains_cache(path, {'checked': now, 'minions': minions})
+
+    return set(minions)
+
+
+def narrow_target(tgt: str, tgt_type: Optional[str], live: Optional[set]) -> Optional[Tuple[str, Optional[str]]]:
+    """
+    Narrow the target to the live minions, if known. Returns None if none of
+    the live minions can match.
+    """
+    if live is None:
+        return tgt, tgt_type
+    if not live:
+        return None
+
+    live_list = ','.join(sorted(live))
+    if tgt_type is None and tgt == '*':
+        return live_list, 'list'
+    if tgt_type == 'list':
+        minions = sorted(set(tgt.split(',')) & live)
+        return (','.join(minions), 'list') if minions else None
+
+    return f'( {tgt} ) and L@{live_list}', 'compound'
+
+
+def presence_target(data: dict, client: SaltApiClient) -> Optional[Tuple[str, Optional[str]]]:
+    """
+    Return the target and target type of the live minions matching the
+    configured target, or None if no live minion matches.
+    """
+    live = live_minions(data, client)
+    if data['presence'] == 'manage.up' and live is not None:
+        # the minions answering manage.up already match the target
+        target = (','.join(sorted(live)), 'list') if live else None
+    else:
+        target = narrow_target(data['tgt'], None, live)
+    if target is None:
+        log.warning('No live minions match the target %s', data['tgt'])
+
+    return target
+
+
+def item_low_state(data: dict, fun: str, tgt: str, keys: set, tgt_type: Optional[str] = None) -> dict:
+    """
+    Compile the low state collecting the given keys from the targeted minions
+    with grains.item or pillar.item.
     """
-    # Prepare payload
     low_state = {
         'client': 'local',
-        'tgt': data['tgt'],
-        'fun': 'grains.item',
-        'arg': list(all_needed_grains),
+        'tgt': tgt,
+        'fun': fun,
+        'arg': list(keys),
         'kwarg': {},
         'full_return': True,
     }
 
+    if tgt_type is not None:
+        low_state['tgt_type'] = tgt_type
     if data['timeout'] is not None:
         low_state['kwarg']['timeout'] = data['timeout']
     if data['gather-timeout'] is not None:
         low_state['kwarg']['gather_job_timeout'] = data['gather-timeout']
 
-    log.debug(f'Compiled low_state: {low_state}')
+    log.debug('Compiled low_state: %s', low_state)
+
+    return low_state
+
+
+def grains_low_state(data: dict, tgt: str, all_needed_grains: set, tgt_type: Optional[str] = None) -> dict:
+    """
+    Compile the low state collecting the needed grains from the targeted
+    minions.
+    """
+    return item_low_state(data, 'grains.item', tgt, all_needed_grains, tgt_type)
+
+
+def minions_low_states(data: dict, tgt: str, all_needed_grains: set, tgt_type: Optional[str] = None) -> list:
+    """
+    Compile the low states collecting the needed grains, and the needed
+    pillar keys if any, from the targeted minions in a single request.
+    """
+    low_states = [grains_low_state(data, tgt, all_needed_grains, tgt_type)]
+
+    needed_pillar = prepare_pillar(data)
+    if needed_pillar:
+        low_states.append(item_low_state(data, 'pillar.item', tgt, needed_pillar, tgt_type))
+
+    return low_states
+
+
+def merge_pillar_returns(returns: list) -> dict:
+    """
+    Merge the minions' pillar.item returns, if any, into their grains.item
+    returns. Pillar keys are prefixed to keep them apart from grains.
+    """
+    minions = returns[0]
+    if len(returns) < 2 or not isinstance(minions, dict):
+        return minions
 
-    # Login to the API
-    client = Pepper(api_url=data['url'], ignore_ssl_errors=not data['verify_ssl'])
+    pillars = returns[1] if isinstance(returns[1], dict) else {}
+
+    for minion, ret in minions.items():
+        pillar_ret = pillars.get(minion)
+        if not isinstance(ret, dict) or not isinstance(ret.get('ret'), dict):
+            continue
+        if not isinstance(pillar_ret, dict) or not isinstance(pillar_ret.get('ret'), dict):
+            log.warning('Minion %s does not have parsable pillar return', minion)
+            continue
+
+        for key, value in pillar_ret['ret'].items():
+            ret['ret'][f'{PILLAR_PREFIX}{key}'] = value
+
+    return minions
+
+
+def collect_minions_grains(data, all_needed_grains):
+    """
+    Execute low state API call and return minions response.
+    """
+    client = api_login(data)
+    target = presence_target(data, client)
+    if target is None:
+        return {}
+
+    tgt, tgt_type = target
+    response = send_low_states(client, minions_low_states(data, tgt, all_needed_grains, tgt_type))
+
+    minions = merge_pillar_returns(response.get('return', [{}]))
+    return minions
+
+
+def list_accepted_minions(client: SaltApiClient) -> List[str]:
+    """
+    Return the ids of all minions with accepted keys.
+    """
+    low_state = {
+        'client': 'wheel',
+        'fun': 'key.list',
+        'match': 'accepted',
+    }
+    response = send_low_states(client, [low_state])
+
+    ret = response.get('return', [{}])[0]
     try:
-        response = client.login(username=data['user'], password=data['password'], eauth=data['eauth'])
-    except PepperException as exception:
-        print(str(exception))
-        sys.exit(1)
-    log.debug(f'Logging into API: {response}')
+        return ret['data']['return']['minions']
+    except (KeyError, TypeError):
+        log.error('Unable to list accepted minions: %s', Preview(ret))
+        return []
+
+
+def minion_shards(data: dict, client: SaltApiClient, live: Optional[set] = None) -> List[Tuple[str, str]]:
+    """
+    Split the target into shards and return their targets and target types.
+
+    Configured shard targets, such as nodegroups, are used as compound
+    targets. Otherwise, the accepted minions matching the target are split
+    into list targets of at most shard-size minions. Shards are narrowed to
+    the live minions, if given.
+    """
+    if data['shard-targets']:
+        shards = [narrow_target(tgt.strip(), 'compound', live) for tgt in data['shard-targets'].split(';')
+                  if tgt.strip()]
+        return [shard for shard in shards if shard is not None]
+
+    # the target is a glob, matched the same way as by the master
+    matched = sorted(minion for minion in list_accepted_minions(client) if fnmatch.fnmatch(minion, data['tgt'])
+                     and (live is None or minion in live))
+    size = data['shard-size']
+
+    return [(','.join(matched[index:index + size]), 'list') for index in range(0, len(matched), size)]
+
+
+def collect_sharded_grains(data, all_needed_grains):
+    """
+    Collect the grains of the targeted minions in shards, querying up to
+    shard-parallelism shards concurrently. Each shard is merged as soon as
+    it completes. A failed shard is logged and does not affect the other
+    shards.
+    """
+    client = api_login(data)
+    shards = minion_shards(data, client, live_minions(data, client))
+    log.debug('Collecting grains in %s shards', len(shards))
+
+    requests = [minions_low_states(data, tgt, all_needed_grains, tgt_type) for tgt, tgt_type in shards]
+    minions = {}
+    for position, response in client.low_as_completed(requests, concurrency=data['shard-parallelism']):
+        tgt = shards[position][0]
+        if isinstance(response, PepperException):
+            log.error('Collecting grains of shard %s failed: %s', tgt, response)
+            continue
+
+        shard_minions = merge_pillar_returns(response.get('return', [{}]))
+        if not isinstance(shard_minions, dict):
+            log.error('Shard %s did not return minion data: %s', tgt, Preview(shard_minions))
+            continue
+
+        log.debug('Shard %s returned %s minions', tgt, len(shard_minions))
+        minions.update(shard_minions)
+
+    client.close()
+    return minions
+
+
+def collect_master_cache_grains(data, all_needed_grains):
+    """
+    Read the grains, and pillar keys if needed, of the targeted minions from
+    the master's minion data cache using the cache.grains and cache.pillar
+    runners, and return them in the format of a full return of the minions.
+
+    Optionally, minions missing from the cache are asked for their grains.
+    """
+    needed_pillar = prepare_pillar(data)
+
+    low_states = [{
+        'client': 'runner',
+        'fun': 'cache.grains',
+        'tgt': data['tgt'],
+    }]
+    if needed_pillar:
+        low_states.append({
+            'client': 'runner',
+            'fun': 'cache.pillar',
+            'tgt': data['tgt'],
+        })
+    log.debug('Compiled low_states: %s', low_states)
+
+    client = api_login(data)
+    response = send_low_states(client, low_states)
+
+    returns = response.get('return', [{}])
+    cached = returns[0]
+    if not isinstance(cached, dict):
+        log.warning('The cache.grains runner did not return minion data: %s', Preview(cached))
+        cached = {}
+    cached_pillars = returns[1] if len(returns) > 1 and isinstance(returns[1], dict) else {}
+
+    minions = {}
+    for minion, grains in cached.items():
+        if isinstance(grains, dict) and grains:
+            minions[minion] = {'ret': project_grains(grains, all_needed_grains), 'retcode': 0}
+
+            pillar = cached_pillars.get(minion)
+            if needed_pillar and isinstance(pillar, dict):
+                for key, value in project_grains(pillar, needed_pillar).items():
+                    minions[minion]['ret'][f'{PILLAR_PREFIX}{key}'] = value
+
+    if data['cache-fallback']:
+        # ask the minions missing from the cache directly
+        if minions:
+            tgt = f"{data['tgt']} and not L@{','.join(sorted(minions))}"
+            fallback_low_states = minions_low_states(data, tgt, all_needed_grains, 'compound')
+        else:
+            fallback_low_states = minions_low_states(data, data['tgt'], all_needed_grains)
+
+        response = send_low_states(client, fallback_low_states)
+        missing = merge_pillar_returns(response.get('return', [{}]))
+        log.debug('Collected %s minions missing from the cache', len(missing))
+        minions.update(missing)
+
+    return minions
+
+
+def collect_async_grains(data, all_needed_grains):
+    """
+    Publish the collection of the needed grains, and pillar keys if any,
+    asynchronously and poll the job cache for the minions' returns.
+
+    Polling stops once answered-percent of the targeted minions answered or
+    the async-deadline passed, so slow minions do not delay the refresh.
+    Minions which did not answer by then are left out.
+
+    :raises PepperException: if publishing the jobs failed
+    """
+    client = api_login(data)
+    target = presence_target(data, client)
+    if target is None:
+        return {}
 
-    # Send payload
+    tgt, tgt_type = target
+    low_states = minions_low_states(data, tgt, all_needed_grains, tgt_type)
+    for low_state in low_states:
+        low_state['client'] = 'local_async'
+        del low_state['full_return']
+
+    deadline = time.monotonic() + data['async-deadline']
+    jobs = send_low_states(client, low_states).get('return', [])
+    if len(jobs) != len(low_states) or not all(isinstance(job, dict) and job.get('jid') for job in jobs):
+        raise PepperException(f'Publishing the jobs failed: {jobs}')
+
+    targeted = set(jobs[0].get('minions', []))
+    required = math.ceil(len(targeted) * data['answered-percent'] / 100)
+    lookups = [lookup_jid_low_state(job['jid']) for job in jobs]
+    log.debug('Published jobs %s to %s minions, waiting for %s of them', [job['jid'] for job in jobs], len(targeted),
+              required)
+
+    returns = [{} for _ in lookups]
+    answered = set()
+    while len(answered) < required:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(ASYNC_POLL_INTERVAL, remaining))
+
+        returns = [ret if isinstance(ret, dict) else {} for ret in
+                   send_low_states(client, lookups).get('return', [])]
+        # a minion answered once it returned all of its jobs
+        answered = targeted.intersection(*returns) if len(returns) == len(lookups) else set()
+        log.debug('%s of %s minions answered', len(answered), len(targeted))
+
+    missing = targeted - answered
+    if missing:
+        log.warning('%s of %s minions did not answer in time: %s', len(missing), len(targeted),
+                    ', '.join(sorted(missing)))
+
+    # convert to the format of a full return of the minions, unparsable
+    # returns are reported when generating the nodes
+    full_returns = [
+        {minion: {'ret': ret[minion] if isinstance(ret[minion], dict) else None, 'retcode': 0}
+         for minion in sorted(answered)}
+        for ret in returns
+    ]
+    return merge_pillar_returns(full_returns)
+
+
+def collect_event_grains(data, all_needed_grains):
+    """
+    Read the grains of the targeted minions from the snapshot of the
+    inventory service, which follows the Salt-API event stream, and return
+    them in the format of a full return of the minions.
+
+    The target is matched as glob. Pillar keys are not part of the snapshot.
+    If the inventory service did not confirm its event stream alive within
+    the inventory max age, the grains are collected from the minions instead.
+
+    :raises PepperException: if the snapshot cannot be read
+    """
+    path = data['inventory-snapshot']
     try:
-        response = client.low(lowstate=[low_state])
-    except PepperException as exception:
-        print(str(exception))
-        sys.exit(1)
-    log.debug(f'Received raw response: {response}')
+        with open(path, 'r', encoding='utf-8') as snapshot_file:
+            snapshot = json_loads(snapshot_file.read())
+        indexed = snapshot['minions']
+    except (OSError, ValueError, KeyError, TypeError) as exception:
+        raise PepperException(f'Unable to read the inventory snapshot {path}: {exception}')
+
+    alive = snapshot.get('alive')
+    if data['inventory-max-age'] and (not isinstance(alive, (int, float))
+                                      or time.time() - alive > data['inventory-max-age']):
+        log.warning('The inventory service did not update the snapshot %s within %s seconds, '
+                    'collecting grains from the minions', path, data['inventory-max-age'])
+        return collect_minions_grains(data, all_needed_grains)
 
-    minions = response.get('return', [{}])[0]
+    if prepare_pillar(data):
+        log.warning("Pillar keys are not supported by the 'events' collector")
+
+    minions = {}
+    for minion, entry in indexed.items():
+        if not fnmatch.fnmatch(minion, data['tgt']):
+            continue
+        if isinstance(entry, dict) and isinstance(entry.get('grains'), dict):
+            minions[minion] = {'ret': project_grains(entry['grains'], all_needed_grains), 'retcode': 0}
+
+    log.debug('Read %s minions from the inventory snapshot updated at %s', len(minions), snapshot.get('updated'))
     return minions
 
 
+def read_minion_data(path: str, grain_roots: set, pillar_roots: set) -> Tuple[dict, dict]:
+    """
+    Read the grains and pillar of a minion from its file in the master's
+    minion data cache.
+
+    The msgpack document is unpacked lazily: only the top-level grains and
+    pillar keys in grain_roots and pillar_roots are unpacked, all other
+    values are skipped.
+
+    :raises ValueError: if the file is not a valid minion data document
+    :raises OSError: if the file cannot be read
+    """
+    sections = {'grains': (grain_roots, {}), 'pillar': (pillar_roots, {})}
+    with open(path, 'rb') as data_file:
+        unpacker = msgpack.Unpacker(data_file, raw=False, strict_map_key=False)
+        try:
+            for _ in range(unpacker.read_map_header()):
+                section = unpacker.unpack()
+                if section not in sections or not sections[section][0]:
+                    unpacker.skip()
+                    continue
+
+                roots, values = sections[section]
+                for _ in range(unpacker.read_map_header()):
+                    key = unpacker.unpack()
+                    if key in roots:
+                        values[key] = unpacker.unpack()
+                    else:
+                        unpacker.skip()
+        except msgpack.UnpackException as exception:
+            raise ValueError(f'Invalid minion data: {exception}')
+
+    return sections['grains'][1], sections['pillar'][1]
+
+
+def local_cache_index_path(data: dict, all_needed_grains: set) -> str:
+    """
+    Return the path of the index of the minion data files read by the
+    local-cache collector for this source's configuration.
+    """
+    key = json.dumps([data['local-cache-dir'], sorted(all_needed_grains), sorted(prepare_pillar(data))])
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return os.path.join(data['local-cache-index-dir'], f'local-cache-{digest}.json')
+
+
+def load_local_cache_index(path: str) -> dict:
+    """
+    Load the index of the minion data files read by the previous run, or
+    return an empty index if it does not exist or cannot be read.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as index_file:
+            index = json_loads(index_file.read())
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as exception:
+        log.warning('Ignoring unreadable local cache index %s: %s', path, exception)
+        return {}
+
+    return index if isinstance(index, dict) else {}
+
+
+def collect_local_cache_grains(data, all_needed_grains):
+    """
+    Read the grains, and pillar keys if needed, of the targeted minions
+    directly from the master's minion data cache on the local disk, and
+    return them in the format of a full return of the minions.
+
+    The target is matched as glob against the minion ids. With a local cache
+    index directory, the files are indexed by their modification time and
+    size, and files unchanged since the previous run are not read again.
+    """
+    needed_pillar = prepare_pillar(data)
+    grain_roots = {key.split(DEFAULT_TARGET_DELIM)[0] for key in all_needed_grains}
+    pillar_roots = {key.split(DEFAULT_TARGET_DELIM)[0] for key in needed_pillar}
+
+    index_path = local_cache_index_path(data, all_needed_grains) if data['local-cache-index-dir'] else None
+    previous = load_local_cache_index(index_path) if index_path else {}
+    index = {}
+
+    try:
+        entries = sorted(os.scandir(data['local-cache-dir']), key=lambda entry: entry.name)
+    except OSError as exception:
+        raise PepperException(f"Unable to read the minion data cache {data['local-cache-dir']}: {exception}")
+
+    minions = {}
+    read = 0
+    for entry in entries:
+        if not fnmatch.fnmatch(entry.name, data['tgt']):
+            continue
+
+        path = os.path.join(entry.path, 'data.p')
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            # not a minion, or its data was not cached yet
+            continue
+
+        indexed = previous.get(entry.name)
+        if isinstance(indexed, dict) and indexed.get('mtime') == file_stat.st_mtime_ns and \
+                indexed.get('size') == file_stat.st_size:
+            index[entry.name] = indexed
+            minions[entry.name] = {'ret': indexed['ret'], 'retcode': 0}
+            continue
+
+        try:
+            grains, pillar = read_minion_data(path, grain_roots, pillar_roots)
+        except (OSError, ValueError) as exception:
+            log.warning('Unable to read the cached data of %s: %s', entry.name, exception)
+            continue
+        read += 1
+
+        if not grains:
+            continue
+
+        ret = project_grains(grains, all_needed_grains)
+        for key, value in project_grains(pillar, needed_pillar).items():
+            ret[f'{PILLAR_PREFIX}{key}'] = value
+
+        index[entry.name] = {'mtime': file_stat.st_mtime_ns, 'size': file_stat.st_size, 'ret': ret}
+        minions[entry.name] = {'ret': ret, 'retcode': 0}
+
+    log.debug('Read %s of %s minions from the minion data cache', read, len(minions))
+
+    if index_path:
+        try:
+            write_grains_cache(index_path, index)
+        except OSError as exception:
+            log.warning('Unable to write the local cache index %s: %s', index_path, exception)
+
+    return minions
+
+
+def collect_grains(data, all_needed_grains):
+    """
+    Collect the grains of the targeted minions with the configured collector.
+    """
+    if data['collector'] == 'master-cache':
+        return collect_master_cache_grains(data, all_needed_grains)
+
+    if data['collector'] == 'async':
+        return collect_async_grains(data, all_needed_grains)
+
+    if data['collector'] == 'events':
+        return collect_event_grains(data, all_needed_grains)
+
+    if data['collector'] == 'local-cache':
+        return collect_local_cache_grains(data, all_needed_grains)
+
+    if data['shard-size'] or data['shard-targets']:
+        return collect_sharded_grains(data, all_needed_grains)
+
+    return collect_minions_grains(data, all_needed_grains)
+
+
+def grains_cache_path(data: dict, all_needed_grains: set) -> str:
+    """
+    Return the path of the grains cache file for this source's configuration.
+
+    The file name is derived from the API URL, target and needed keys, so
+    sources with different configurations can share the cache directory.
+    """
+    key = json.dumps([data['url'], data['tgt'], sorted(all_needed_grains), sorted(prepare_pillar(data))])
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return os.path.join(data['cache-dir'], f'grains-{digest}.json')
+
+
+def load_grains_cache(path: str) -> dict:
+    """
+    Load the grains cache, or return an empty cache if it does not exist or
+    cannot be read.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as cache_file:
+            cache = json_loads(cache_file.read())
+    except FileNotFoundError:
+        return {'refreshed': None, 'minions': {}}
+    except (OSError, ValueError) as exception:
+        log.warning('Ignoring unreadable grains cache %s: %s', path, exception)
+        return {'refreshed': None, 'minions': {}}
+
+    if not isinstance(cache, dict) or not isinstance(cache.get('minions'), dict):
+        log.warning('Ignoring malformed grains cache %s', path)
+        return {'refreshed': None, 'minions': {}}
+
+    return cache
+
+
+def write_grains_cache(path: str, cache: dict):
+    """
+    Atomically replace the grains cache file.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.grains-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as cache_file:
+            cache_file.write(json_dumps(cache))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def update_grains_cache(cache: dict, minions: dict, now: float, expiry: int) -> dict:
+    """
+    Merge the minions' returns of a refresh into the grains cache.
+
+    Minions without parsable return keep their previous grains. Minions not
+    seen for longer than expiry seconds are removed.
+    """
+    cached = cache['minions']
+    for minion, ret in minions.items():
+        if not isinstance(ret, dict) or ret.get('ret') is None:
+            continue
+        cached[minion] = {'last_seen': now, 'grains': ret['ret']}
+
+    for minion in [minion for minion, entry in cached.items() if now - entry['last_seen'] > expiry]:
+        log.debug('Minion %s expired from grains cache', minion)
+        del cached[minion]
+
+    cache['refreshed'] = now
+    return cache
+
+
+def cached_minions(cache: dict, now: float) -> dict:
+    """
+    Return the cached grains in the format of a full return of the minions.
+
+    Minions which did not answer the most recent refresh are marked as stale
+    with the age of their grains in seconds.
+    """
+    minions = {}
+    for minion, entry in cache['minions'].items():
+        minions[minion] = {'ret': entry['grains'], 'retcode': 0}
+        if entry['last_seen'] < cache['refreshed']:
+            minions[minion]['stale'] = int(now - entry['last_seen'])
+    return minions
+
+
+def refresh_grains_cache(data: dict, all_needed_grains: set, path: str) -> dict:
+    """
+    Collect the grains of the minions and update the grains cache.
+    """
+    minions = collect_grains(data, all_needed_grains)
+    cache = update_grains_cache(load_grains_cache(path), minions, time.time(), data['cache-expiry'])
+    write_grains_cache(path, cache)
+
+    # the cache is current again
+    try:
+        os.unlink(f'{path}.error')
+    except FileNotFoundError:
+        pass
+    return cache
+
+
+def record_refresh_error(path: str, exception: Exception, now: float):
+    """
+    Record the failure of a background refresh next to the grains cache, to
+    be reported by the next run serving the cache.
+    """
+    try:
+        write_grains_cache(f'{path}.error', {'failed': now, 'error': str(exception) or type(exception).__name__})
+    except OSError:
+        pass
+
+
+def report_refresh_error(path: str, refreshed: float, now: float):
+    """
+    Log a warning if the last background refresh of the grains cache failed.
+    """
+    try:
+        with open(f'{path}.error', 'r', encoding='utf-8') as error_file:
+            error = json_loads(error_file.read())
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as exception:
+        log.warning('Unable to read the error of the last background refresh: %s', exception)
+        return
+
+    log.warning('The background refresh of the grains cache failed %s seconds ago: %s. '
+                'Serving grains refreshed %s seconds ago.',
+                int(now - error['failed']), error['error'], int(now - refreshed))
+
+
+def _refresh_timeout(signum, frame):
+    raise TimeoutError('Background refresh exceeded its budget')
+
+
+def spawn_background_refresh(data: dict, all_needed_grains: set, path: str):
+    """
+    Refresh the grains cache in a detached child process.
+
+    Only one refresh per cache file runs at a time. The child's standard
+    streams are detached, so Rundeck does not wait for it, and it is aborted
+    without touching the cache once it exceeds the refresh budget. A failed
+    refresh is recorded next to the cache and reported by the next run.
+    """
+    lock_file = open(f'{path}.lock', 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        log.debug('Background refresh is already running')
+        lock_file.close()
+        return
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid > 0:
+        # the child holds the lock until it exits
+        lock_file.close()
+        return
+
+    status = 1
+    try:
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+
+        signal.signal(signal.SIGALRM, _refresh_timeout)
+        signal.alarm(data['refresh-budget'])
+        refresh_grains_cache(data, all_needed_grains, path)
+        signal.alarm(0)
+        status = 0
+    except (PepperException, OSError, ValueError) as exception:
+        signal.alarm(0)
+        # the child's standard streams are detached, the next run reports it
+        record_refresh_error(path, exception, time.time())
+    finally:
+        # the child never returns into the caller
+        os._exit(status)
+
+
 def get_os_family(os_family: str) -> str:
     """
     Map OS family to a standardized format.
     """
-    os_family_map = {
-        'Linux': 'unix',
-        'AIX': 'unix',
-        'MacOS': 'unix',
-        'VMware': 'unix',
-        'Windows': 'windows'
-    }
-    return os_family_map.get(os_family, os_family)
+    return OS_FAMILY_MAP.get(os_family, os_family)
 
 
-def process_tags(metadata: dict, needed_tags: set) -> set:
+class ExtractionPlan(NamedTuple):
     """
-    Extract tags from grains or pillar.
+    Tags and attributes compiled once from the configuration and applied to
+    the grains of every minion.
+
+    :param tags: The key and key path of each tag.
+    :type tags: List[Tuple[str, List[str]]]
+    :param attributes: The attribute name, key and key path of each attribute.
+    :type attributes: List[Tuple[str, str, List[str]]]
+    """
+    tags: List[Tuple[str, List[str]]]
+    attributes: List[Tuple[str, str, List[str]]]
+
+
+def compile_tags(needed_tags: set) -> List[Tuple[str, List[str]]]:
+    """
+    Compile the keys and key paths of the tags.
+    """
+    return [(tag, tag.split(DEFAULT_TARGET_DELIM)) for tag in sorted(needed_tags)]
+
+
+def compile_attributes(needed_attributes: set, reserved_keys: set) -> List[Tuple[str, str, List[str]]]:
+    """
+    Compile the names, keys and key paths of the attributes. Attributes named
+    like a reserved key of Rundeck's nodes are prefixed with salt-.
+    """
+    return [
+        (f'salt-{attribute}' if attribute in reserved_keys else attribute, attribute,
+         attribute.split(DEFAULT_TARGET_DELIM))
+        for attribute in sorted(needed_attributes)
+    ]
+
+
+def compile_extraction_plan(data: dict) -> ExtractionPlan:
+    """
+    Compile the extraction plan of the configured tags and attributes.
+    """
+    return ExtractionPlan(
+        tags=compile_tags(string_to_unique_set(data['tags'])),
+        attributes=compile_attributes(string_to_unique_set(data['attributes']), RESERVED_KEYS),
+    )
+
+
+def resolve_key(metadata: dict, key: str, path: List[str], default=None):
+    """
+    Return the value of a key within the grains or pillar.
+
+    Returns of grains.item contain the requested keys, including nested keys,
+    as they are. Otherwise nested keys are resolved along their path.
+    """
+    value = metadata.get(key, _MISSING)
+    if value is not _MISSING:
+        return value
+    if len(path) > 1:
+        return traverse_dict_and_list(metadata, path, default)
+    return default
+
+
+def extract_tags(metadata: dict, compiled_tags: List[Tuple[str, List[str]]]) -> set:
+    """
+    Extract the compiled tags from grains or pillar.
     """
     tags = set()
-    for tag in needed_tags:
-        tag_value = metadata.get(tag)
+    for tag, path in compiled_tags:
+        tag_value = resolve_key(metadata, tag, path)
         if tag_value is None:
             continue
         if isinstance(tag_value, (str, int, float)):
@@ -133,62 +1196,282 @@ def process_tags(metadata: dict, needed_tags: set) -> set:
         elif isinstance(tag_value, list):
             tags.update(str(elem) for elem in tag_value if isinstance(elem, (str, int, float)))
         else:
-            log.warning(f'The tag {tag} is not a supported type (str, int, float, or a list of these types)')
+            log.warning('The tag %s is not a supported type (str, int, float, or a list of these types)', tag)
     return tags
 
 
-def process_attributes(metadata, needed_attributes, reserved_keys):
+def extract_attributes(metadata: dict, compiled_attributes: List[Tuple[str, str, List[str]]]) -> dict:
     """
-    Process attributes from grains or pillar.
+    Extract the compiled attributes from grains or pillar.
     """
     processed_attributes = {}
-    for attribute in needed_attributes:
-        attribute_name = f'salt-{attribute}' if attribute in reserved_keys else attribute
-        attribute_value = metadata.get(attribute, '')
+    for attribute_name, attribute, path in compiled_attributes:
+        attribute_value = resolve_key(metadata, attribute, path, '')
         if isinstance(attribute_value, (str, int, float)):
             processed_attributes[attribute_name] = str(attribute_value)
         else:
-            log.warning(f'The attribute {attribute} is not a string. Nested values are not supported attribute values.')
+            log.warning('The attribute %s is not a string. Nested values are not supported attribute values.',
+                        attribute)
             processed_attributes[attribute_name] = ''
 
     return processed_attributes
 
 
+def process_tags(metadata: dict, needed_tags: set) -> set:
+    """
+    Extract tags from grains or pillar.
+    """
+    return extract_tags(metadata, compile_tags(needed_tags))
+
+
+def process_attributes(metadata, needed_attributes, reserved_keys):
+    """
+    Process attributes from grains or pillar.
+    """
+    return extract_attributes(metadata, compile_attributes(needed_attributes, reserved_keys))
+
+
+def generate_node(minion, ret, data, plan):
+    """
+    Generate the node of a minion from its return, or None if the return is
+    not parsable.
+    """
+    nodename = minion if data['prefix'] is None else f"{data['prefix']}{minion}"
+
+    if not isinstance(ret, dict) or ret.get('ret') is None:
+        log.warning('Minion %s does not have parsable return', minion)
+        return None
+
+    grains = ret['ret']
+
+    model = {
+        'nodename': nodename,
+        'hostname': minion,
+        'osArch': 'x86_64' if grains['cpuarch'] in ['x86_64', 'AMD64'] else grains['cpuarch'],
+        'osName': grains['os'],
+        'osVersion': grains['osrelease'],
+        'osFamily': get_os_family(grains['os_family']),
+        'tags': sorted(extract_tags(grains, plan.tags))
+    }
+
+    model.update(extract_attributes(grains, plan.attributes))
+
+    # minion served from the grains cache which did not answer recently
+    if ret.get('stale') is not None:
+        model['tags'].append('salt-stale')
+        model['salt-stale-age'] = str(ret['stale'])
+
+    return nodename, model
+
+
+def iter_resource_model(minion_returns, data):
+    """
+    Generator that yields the nodename and node for each minion's return.
+    """
+    plan = compile_extraction_plan(data)
+
+    for minion, ret in minion_returns:
+        node = generate_node(minion, ret, data, plan)
+        if node is not None:
+            yield node
+
+
 def generate_resource_model(minions, data):
     """
     Generate resource model from minions and grains data.
     """
-    reserved_keys = {'nodename', 'hostname', 'username', 'description', 'tags', 'osFamily', 'osArch', 'osName',
-                     'osVersion', 'editUrl', 'remoteUrl'}
+    return dict(iter_resource_model(minions.items(), data))
 
-    resource_model = {}
-    for minion, ret in minions.items():
-        nodename = minion if data['prefix'] is None else f"{data['prefix']}{minion}"
 
-        if not isinstance(ret, dict) or ret.get('ret') is None:
-            log.warning(f'Minion {minion} does not have parsable return')
+def write_resource_model(nodes, out):
+    """
+    Write the nodes as resourcejson document, one node at a time.
+
+    The output is identical to json_dumps of the complete resource model.
+    """
+    out.write('{')
+    for index, (nodename, model) in enumerate(nodes):
+        if index > 0:
+            out.write(',')
+        out.write(f'{json_dumps(nodename)}:{json_dumps(model)}')
+    out.write('}\n')
+
+
+def content_hash(value) -> str:
+    """
+    Return a short hash of a JSON serializable value, independent of the
+    order of its keys.
+    """
+    return hashlib.sha256(json_dumps(value, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def hash_nodes(nodes, node_hashes: dict):
+    """
+    Generator that yields the nodename and node for each node while keeping
+    the hash of the node and of each of its fields in node_hashes.
+    """
+    for nodename, model in nodes:
+        fields = {field: content_hash(value) for field, value in model.items()}
+        node_hashes[nodename] = {'hash': content_hash(fields), 'fields': fields}
+        yield nodename, model
+
+
+def diff_node_hashes(previous: dict, current: dict) -> dict:
+    """
+    Compare the node hashes of two runs and return the nodes added, removed
+    and changed, with the fields that changed.
+    """
+    changed = {}
+    for nodename in sorted(previous.keys() & current.keys()):
+        if previous[nodename]['hash'] == current[nodename]['hash']:
             continue
+        before, after = previous[nodename]['fields'], current[nodename]['fields']
+        changed[nodename] = sorted(field for field in before.keys() | after.keys()
+                                   if before.get(field) != after.get(field))
+
+    return {
+        'added': sorted(current.keys() - previous.keys()),
+        'removed': sorted(previous.keys() - current.keys()),
+        'changed': changed,
+    }
+
+
+def record_changes(path: str, node_hashes: dict, now: float):
+    """
+    Append the changes of the resource model since the previous run to the
+    change log, one compact JSON record per run. The node hashes of the run
+    are kept next to the change log for the next run.
+    """
+    state_path = f'{path}.state'
+    model_hash = content_hash({nodename: hashes['hash'] for nodename, hashes in node_hashes.items()})
+
+    with open(path, 'a', encoding='utf-8') as change_log:
+        # serialize concurrent runs
+        fcntl.flock(change_log, fcntl.LOCK_EX)
+
+        try:
+            with open(state_path, 'r', encoding='utf-8') as state_file:
+                state = json_loads(state_file.read())
+            previous_hash, previous = state['model'], state['nodes']
+        except FileNotFoundError:
+            previous_hash, previous = None, {}
+        except (OSError, ValueError, KeyError, TypeError) as exception:
+            log.warning('Ignoring unreadable change log state %s: %s', state_path, exception)
+            previous_hash, previous = None, {}
+
+        record = {'time': int(now), 'model': model_hash, 'previous': previous_hash, 'nodes': len(node_hashes)}
+        record.update(diff_node_hashes(previous, node_hashes))
+        change_log.write(json_dumps(record) + '\n')
+        change_log.flush()
+
+        write_grains_cache(state_path, {'model': model_hash, 'nodes': node_hashes})
+
+
+def output_resource_model(nodes, data: dict):
+    """
+    Print the nodes for Rundeck to pick up and, if enabled, record the
+    changes since the previous run in the change log.
+    """
+    if not data['change-log']:
+        write_resource_model(nodes, sys.stdout)
+        return
+
+    node_hashes = {}
+    write_resource_model(hash_nodes(nodes, node_hashes), sys.stdout)
+
+    try:
+        record_changes(data['change-log'], node_hashes, time.time())
+    except OSError as exception:
+        log.error('Unable to record changes in %s: %s', data['change-log'], exception)
+
+
+def stream_minions_grains(data, all_needed_grains):
+    """
+    Execute the low state API call and return a generator yielding the
+    minions' returns while the response is parsed.
+    """
+    client = api_login(data)
+    target = presence_target(data, client)
+    if target is None:
+        return iter(())
+
+    tgt, tgt_type = target
+    response = client.low_stream(lowstate=[grains_low_state(data, tgt, all_needed_grains, tgt_type)])
+
+    return iter_low_state_return(response)
+
+
+def streaming_supported(data) -> bool:
+    """
+    Whether the configured collection can be streamed.
+    """
+    return data['collector'] == 'minions' and not (data['shard-size'] or data['shard-targets'] or data['cache-dir']
+                                                   or prepare_pillar(data))
+
 
-        grains = ret['ret']
+def collect_resource_model(data: dict) -> dict:
+    """
+    Collect the grains of the targeted minions, from the grains cache if
+    enabled, and compile the resource model.
 
-        model = {
-            'nodename': nodename,
-            'hostname': minion,
-            'osArch': 'x86_64' if grains['cpuarch'] in ['x86_64', 'AMD64'] else grains['cpuarch'],
-            'osName': grains['os'],
-            'osVersion': grains['osrelease'],
-            'osFamily': get_os_family(grains['os_family']),
-            'tags': list(process_tags(grains, string_to_unique_set(data['tags'])))
-        }
+    :raises PepperException: if a request to the API failed
+    """
+    all_needed_grains = prepare_grains(data)
+    if data['cache-dir']:
+        # serve the last known grains and refresh them in the background
+        cache_path = grains_cache_path(data, all_needed_grains)
+        cache = load_grains_cache(cache_path)
+        if cache['refreshed'] is None:
+            cache = refresh_grains_cache(data, all_needed_grains, cache_path)
+        else:
+            report_refresh_error(cache_path, cache['refreshed'], time.time())
+            spawn_background_refresh(data, all_needed_grains, cache_path)
+        minions = cached_minions(cache, time.time())
+    else:
+        minions = collect_grains(data, all_needed_grains)
 
-        processed_attributes = process_attributes(grains, string_to_unique_set(data['attributes']), reserved_keys)
-        model.update(processed_attributes)
+    return generate_resource_model(minions, data)
 
-        resource_model[nodename] = model
+
+def collect_master_resource_model(data: dict) -> Optional[dict]:
+    """
+    Collect the resource model of a single master of a federated resource
+    model, or None if collecting failed.
+    """
+    try:
+        return generate_resource_model(collect_grains(data, prepare_grains(data)), data)
+    except PepperException as exception:
+        log.error('Collecting grains from %s failed: %s', data['url'], exception)
+        return None
+
+
+def collect_federated_resource_model(masters: List[dict]) -> Optional[dict]:
+    """
+    Collect the resource models of multiple masters concurrently and merge
+    them in the order of the masters. A node already provided by a preceding
+    master is skipped. Returns None if collecting failed on all masters.
+    """
+    # the collectors are blocking pipelines, each master's runs in a thread
+    # of its own and sends its requests on the event loop of its client
+    with ThreadPoolExecutor(max_workers=len(masters)) as executor:
+        models = list(executor.map(collect_master_resource_model, masters))
+
+    if all(model is None for model in models):
+        return None
+
+    resource_model = {}
+    for master, model in zip(masters, models):
+        for nodename, node in (model or {}).items():
+            if nodename in resource_model:
+                log.warning('Node %s of %s is already provided by a preceding master. '
+                            'Use a prefix per master to keep both.', nodename, master['url'])
+                continue
+            resource_model[nodename] = node
 
     return resource_model
 
 
+@profiled('salt-resource-model-source')
 def main():
     """
     Main function to generate ressource model
@@ -203,6 +1486,26 @@ def main():
         DataItem('prefix', 'RD_CONFIG_PREFIX', 'str'),
         DataItem('timeout', 'RD_CONFIG_TIMEOUT', 'int'),
         DataItem('gather-timeout', 'RD_CONFIG_GATHER_TIMEOUT', 'int'),
+        DataItem('collector', 'RD_CONFIG_COLLECTOR', 'str'),
+        DataItem('cache-fallback', 'RD_CONFIG_CACHE_FALLBACK', 'bool'),
+        DataItem('inventory-snapshot', 'RD_CONFIG_INVENTORY_SNAPSHOT', 'str'),
+        DataItem('inventory-max-age', 'RD_CONFIG_INVENTORY_MAX_AGE', 'int'),
+        DataItem('local-cache-dir', 'RD_CONFIG_LOCAL_CACHE_DIR', 'str'),
+        DataItem('local-cache-index-dir', 'RD_CONFIG_LOCAL_CACHE_INDEX_DIR', 'str'),
+        DataItem('answered-percent', 'RD_CONFIG_ANSWERED_PERCENT', 'int'),
+        DataItem('async-deadline', 'RD_CONFIG_ASYNC_DEADLINE', 'int'),
+        DataItem('presence', 'RD_CONFIG_PRESENCE', 'str'),
+        DataItem('presence-ttl', 'RD_CONFIG_PRESENCE_TTL', 'int'),
+        DataItem('shard-size', 'RD_CONFIG_SHARD_SIZE', 'int'),
+        DataItem('shard-targets', 'RD_CONFIG_SHARD_TARGETS', 'str'),
+        DataItem('shard-parallelism', 'RD_CONFIG_SHARD_PARALLELISM', 'int'),
+        DataItem('cache-dir', 'RD_CONFIG_CACHE_DIR', 'str'),
+        DataItem('cache-expiry', 'RD_CONFIG_CACHE_EXPIRY', 'int'),
+        DataItem('refresh-budget', 'RD_CONFIG_REFRESH_BUDGET', 'int'),
+        DataItem('streaming', 'RD_CONFIG_STREAMING', 'bool'),
+        DataItem('masters', 'RD_CONFIG_MASTERS', 'str'),
+        DataItem('masters-passwords', 'RD_CONFIG_MASTERS_PASSWORDS', 'str'),
+        DataItem('change-log', 'RD_CONFIG_CHANGE_LOG', 'str'),
         DataItem('url', 'RD_CONFIG_URL', 'str'),
         DataItem('eauth', 'RD_CONFIG_EAUTH', 'str'),
         DataItem('user', 'RD_CONFIG_USER', 'str'),
@@ -212,7 +1515,9 @@ def main():
     ]
 
     data = parse_data(data_items)
-    log.debug(f"Data: {sanitize_dict(data, ['password'])}")
+    sanitized_data = sanitize_dict(data, ['password', 'masters-passwords'])
+    sanitized_data['masters'] = sanitize_masters(data['masters'])
+    log.debug('Data: %s', sanitized_data)
 
     # use rundeck's log level if defined
     configure_logging(data['log-level'])
@@ -220,19 +1525,48 @@ def main():
     # sanity checks
     validate_required_inputs(data)
 
-    # queue the Salt-API
-    all_needed_grains = prepare_grains(data)
-    minions = collect_minions_grains(data, all_needed_grains)
+    if data['masters']:
+        if data['streaming'] or data['cache-dir']:
+            log.warning('Streaming and the grains cache are not supported with multiple masters')
+
+        # query all masters concurrently
+        resource_model = collect_federated_resource_model(data['masters'])
+        if resource_model is None:
+            print('Collecting grains failed on all masters')
+            sys.exit(1)
+
+        output_resource_model(resource_model.items(), data)
+        sys.exit(0)
+
+    if data['streaming'] and streaming_supported(data):
+        # compile and print the Rundeck Resource Model while the response is parsed
+        try:
+            minion_returns = stream_minions_grains(data, prepare_grains(data))
+            output_resource_model(iter_resource_model(minion_returns, data), data)
+        except PepperException as exception:
+            print(str(exception))
+            sys.exit(1)
+        except ValueError as exception:
+            log.error('Unable to parse the server response: %s', exception)
+            sys.exit(1)
+        sys.exit(0)
 
-    # compile the Rundeck Resource Model
-    resource_model = generate_resource_model(minions, data)
+    if data['streaming']:
+        log.warning('Streaming is only supported by the minions collector without sharding, the grains cache and '
+                    'pillar keys')
+
+    # queue the Salt-API and compile the Rundeck Resource Model
+    try:
+        resource_model = collect_resource_model(data)
+    except PepperException as exception:
+        print(str(exception))
+        sys.exit(1)
 
     # print response to stdout for Rundeck to pickup
-    print(json.dumps(resource_model))
+    output_resource_model(resource_model.items(), data)
 
     sys.exit(0)
 
-
 if __name__ == '__main__':
     main()
 
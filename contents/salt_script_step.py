@@ -0,0 +1,232 @@
+#!/usr/bin/env python -u
+import logging
+import os
+import posixpath
+import secrets
+import shlex
+import sys
+import tempfile
+
+from typing import List, Optional
+
+from pepper.exceptions import PepperException
+
+from common import DataItem, Preview, SaltApiClient, batch_low_states, chunk_low_states, parse_data, profiled, \
+    sanitize_dict
+
+log = logging.getLogger(__name__)
+
+# return code of the run stage if the script was not copied completely
+INCOMPLETE_RETCODE = 125
+
+
+def run_command(dest: str, size: int, interpreter: Optional[str], args: Optional[str]) -> str:
+    """
+    Compile the shell command running the copied script.
+
+    The script only runs if it was copied completely, as the run travels in
+    the same request as the copy and is executed even if a chunk failed.
+
+    :param dest: The path of the script on the minion
+    :param size: The size of the script in bytes
+    :param interpreter: The interpreter running the script, or None to
+                        execute the script itself
+    :param args: The arguments of the script, as a shell string
+    """
+    script = shlex.quote(dest)
+    run = f'{interpreter} {script}' if interpreter else script
+    if args:
+        run = f'{run} {args}'
+
+    return (f'if [ "$(wc -c 2>/dev/null < {script})" -eq {size} ] 2>/dev/null; then {run}; '
+            f'else echo "The script was not copied completely" >&2; exit {INCOMPLETE_RETCODE}; fi')
+
+
+def script_low_states(host: str, src: str, dest: str, chunk_size: int, request_size: int,
+                      run_args: List[str]) -> List[List[dict]]:
+    """
+    Compile the requests copying the script and running it.
+
+    The chunks are grouped into requests as by the FileCopier. The run of
+    the script and the removal of the copy are appended to the request of
+    the final chunk, so a script of a single request is copied and run with
+    one request to the Salt-API.
+
+    :param run_args: The arguments of cmd.run, starting with the command
+    """
+    requests = list(batch_low_states(chunk_low_states(host, src, dest, chunk_size), request_size))
+    requests[-1].extend([
+        {
+            'client': 'local',
+            'tgt': host,
+            'fun': 'cmd.run',
+            'arg': run_args,
+            'full_return': True,  # full return to get retcode
+        },
+        {
+            'client': 'local',
+            'tgt': host,
+            'fun': 'file.remove',
+            'arg': [dest],
+            'full_return': True,
+        },
+    ])
+    return requests
+
+
+def stage_returns(low_states: List[dict], response: dict, host: str) -> List[dict]:
+    """
+    Return the full return of the minion for each low state of a request,
+    or an empty dictionary if the minion did not return.
+    """
+    returns = response.get('return', [])
+    minion_returns = []
+    for position in range(len(low_states)):
+        ret = returns[position] if position < len(returns) else {}
+        minion_returns.append(ret.get(host, {}) if isinstance(ret, dict) else {})
+    return minion_returns
+
+
+def remove_copy(client: SaltApiClient, remove_low_state: dict):
+    """
+    Remove the partial copy of the script after the copy stage failed in an
+    earlier request than the removal.
+    """
+    try:
+        response = client.low(lowstate=[remove_low_state])
+    except PepperException as exception:
+        log.warning('Unable to remove the script %s: %s', remove_low_state['arg'][0], exception)
+        return
+    log.debug('Received raw response: %s', Preview(response))
+
+
+@profiled('salt-script-step')
+def main():
+    """
+    Main function to copy and run a script on a node via Salt-API
+
+    This function retrieves necessary data from environment variables provided by Rundeck.
+    """
+    # parse environment provided by rundeck
+    data_items = [
+        DataItem('host', 'RD_NODE_HOSTNAME', 'str'),
+        DataItem('script', 'RD_CONFIG_SCRIPT', 'str'),
+        DataItem('script-args', 'RD_CONFIG_ARGS', 'str'),
+        DataItem('interpreter', 'RD_CONFIG_INTERPRETER', 'str'),
+        DataItem('directory', 'RD_CONFIG_DIRECTORY', 'str'),
+        DataItem('runas', 'RD_CONFIG_RUNAS', 'str'),
+        DataItem('args', 'RD_CONFIG_CMD_RUN_ARGS', 'shstr'),
+        DataItem('chunk-size', 'RD_CONFIG_CHUNK_SIZE', 'int'),
+        DataItem('request-size', 'RD_CONFIG_REQUEST_SIZE', 'int'),
+        DataItem('url', 'RD_CONFIG_URL', 'str'),
+        DataItem('eauth', 'RD_CONFIG_EAUTH', 'str'),
+        DataItem('user', 'RD_CONFIG_USER', 'str'),
+        DataItem('password', 'RD_CONFIG_PASSWORD', 'str'),
+        DataItem('verify_ssl', 'RD_CONFIG_VERIFYSSL', 'bool'),
+        DataItem('log-level', 'RD_JOB_LOGLEVEL', 'str'),
+    ]
+
+    data = parse_data(data_items)
+    log.debug('Data: %s', sanitize_dict(data, ['password']))
+
+    # use rundeck's log level if defined
+    if data['log-level'] == 'DEBUG':
+        log_level = 'DEBUG'
+    else:
+        log_level = 'ERROR'
+    log.setLevel(logging.getLevelName(log_level))
+
+    # Sanity checks for required input
+    for key in ['host', 'script', 'url', 'eauth', 'user', 'password']:
+        if not data[key]:
+            log.error('No %s specified. Script not run.', key)
+            sys.exit(1)
+
+    # set defaults if not provided
+    if data['directory'] is None or data['directory'] == '':
+        data['directory'] = '/tmp'
+    if data['chunk-size'] is None:
+        data['chunk-size'] = 1048576
+    if data['request-size'] is None:
+        data['request-size'] = 0
+
+    # the copy is only readable by the minion's user, unless the script is
+    # run as another user
+    mode = 0o755 if data['runas'] else 0o700
+    dest = posixpath.join(data['directory'], f'rundeck-salt-script-{secrets.token_hex(8)}')
+    script = data['script'].encode('utf-8')
+
+    # prepare payload contents
+    args = [run_command(dest, len(script), data['interpreter'], data['script-args'])]
+
+    if data['runas'] is not None and data['runas'] != '':
+        args.append(f"runas={data['runas']}")
+
+    if data['args'] is not None and data['args'] != '':
+        args.extend(data['args'])
+
+    fd, src = tempfile.mkstemp(prefix='rundeck-salt-script-')
+    try:
+        with os.fdopen(fd, 'wb') as script_file:
+            script_file.write(script)
+        os.chmod(src, mode)
+        requests = script_low_states(data['host'], src, dest, data['chunk-size'], data['request-size'], args)
+    finally:
+        os.unlink(src)
+
+    # login to the API
+    client = SaltApiClient(api_url=data['url'], ignore_ssl_errors=not data['verify_ssl'])
+    try:
+        response = client.login(username=data['user'], password=data['password'], eauth=data['eauth'])
+    except PepperException as exception:
+        print(str(exception))
+        sys.exit(1)
+    log.debug('Logging into API: %s', Preview(response))
+
+    total_chunks = sum(len(request) for request in requests) - 2
+    transferred = 0
+    run_return = None
+    for index, request in enumerate(requests, start=1):
+        # the final request copies and runs the script
+        stage = 'Copy and run' if index == len(requests) else 'Copy'
+        log.debug('Sending %s low state(s) in request %s of %s', len(request), index, len(requests))
+
+        # send payload
+        try:
+            response = client.low(lowstate=request)
+        except PepperException as exception:
+            print(f'{stage} stage failed: {exception}', file=sys.stderr)
+            sys.exit(1)
+        log.debug('Received raw response: %s', Preview(response))
+
+        for low_state, ret in zip(request, stage_returns(request, response, data['host'])):
+            if low_state['fun'] == 'cp.recv_chunked':
+                if ret.get('retcode', 1) != 0:
+                    print(f'Copy stage failed at chunk {transferred + 1} of {total_chunks}: '
+                          f"{ret.get('ret', 'No response received')}", file=sys.stderr)
+                    if index < len(requests):
+                        remove_copy(client, requests[-1][-1])
+                    sys.exit(ret.get('retcode') or 1)
+                transferred += 1
+            elif low_state['fun'] == 'cmd.run':
+                run_return = ret
+            elif ret.get('retcode', 1) != 0:
+                log.warning('Unable to remove the script %s: %s', dest, ret.get('ret'))
+
+    if not run_return:
+        print('Run stage failed: No response received', file=sys.stderr)
+        sys.exit(1)
+
+    # print response to stdout for Rundeck to pickup
+    print(run_return.get('ret', ''))
+
+    return_code = run_return.get('retcode', 1)
+    if return_code != 0:
+        print(f'Run stage failed with return code {return_code}', file=sys.stderr)
+
+    # rundeck reads return code
+    sys.exit(return_code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Benchmark of the compressed HTTP transport against a local Salt-API stand-in.
+
+Measures the bytes on the wire and the wall time of a grains.item response of
+a large fleet with and without gzip compressed responses, and of a file upload
+by the FileCopier with and without gzip compressed requests. The stand-in
+limits its bandwidth to simulate the link between Rundeck and the Salt-API.
+
+Run from the repository root:
+    PYTHONPATH=contents python -m tests.benchmarks.bench_compression
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from contents.common import SaltApiClient
+from contents.salt_file_copier import batch_low_states, chunk_low_states
+from contents.salt_resource_model_source import prepare_grains
+from tests.benchmarks.synthetic import grains_item_returns, synthetic_fleet
+
+DATA = {
+    'prefix': None,
+    'tags': 'os,roles,virtual,datacenter,kernel',
+    'attributes': 'master,num_cpus,mem_total,systemd:version,osfinger,datacenter,kernelrelease,hostname',
+}
+
+# CherryPy's default gzip compression level
+SERVER_COMPRESSLEVEL = 5
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _transfer(self, size):
+        # time the payload takes on a link of the configured bandwidth
+        time.sleep(size * 8 / self.server.bandwidth)
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        content = self.rfile.read(length)
+        self._transfer(length)
+        self.server.received += length
+        if self.headers.get('Content-Encoding') == 'gzip':
+            content = gzip.decompress(content)
+        request = json.loads(content)
+
+        if self.path == '/login':
+            body = {'return': [{'token': 'abc', 'eauth': 'auto'}]}
+        elif request[0]['fun'] == 'grains.item':
+            body = {'return': [self.server.grains]}
+        else:
+            body = {'return': [{low_state['tgt']: {'ret': True, 'retcode': 0}} for low_state in request]}
+
+        content = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            content = gzip.compress(content, compresslevel=SERVER_COMPRESSLEVEL)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self._transfer(len(content))
+        self.server.sent += len(content)
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def synthetic_file(path, size, seed=0):
+    """
+    Write a log file of about size bytes, as uploaded by a job.
+    """
+    rng = random.Random(seed)
+    levels = ['INFO', 'INFO', 'INFO', 'DEBUG', 'WARNING', 'ERROR']
+    with open(path, 'w', encoding='utf-8') as log_file:
+        written = 0
+        while written < size:
+            line = (f'2024-01-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:'
+                    f'{rng.randint(0, 59):02d} {rng.choice(levels)} worker-{rng.randint(1, 16)} '
+                    f'request {rng.getrandbits(64):016x} took {rng.randint(1, 5000)} ms\n')
+            written += log_file.write(line)
+
+
+def measure(server, function, repeat):
+    """
+    Return the best wall time of repeated calls in seconds, and the bytes
+    received and sent by the server per call.
+    """
+    best = None
+    for _ in range(repeat):
+        server.received = server.sent = 0
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, server.received, server.sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--minions', type=int, default=10000)
+    parser.add_argument('--file-size', type=int, default=4 * 2 ** 20)
+    parser.add_argument('--bandwidth', type=float, default=100, help='bandwidth of the link in Mbit/s')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.bandwidth = args.bandwidth * 1e6
+    server.received = server.sent = 0
+    server.grains = grains_item_returns(synthetic_fleet(args.minions), prepare_grains(DATA))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f'http://127.0.0.1:{server.server_port}'
+
+    with tempfile.TemporaryDirectory() as directory:
+        src = os.path.join(directory, 'upload.log')
+        synthetic_file(src, args.file_size)
+
+        print(f'{args.minions} minions, file of {args.file_size / 2 ** 20:.1f} MiB, '
+              f'{args.bandwidth:g} Mbit/s, best of {args.repeat}')
+        for compression in (False, True):
+            client = SaltApiClient(api_url=url, compression=compression, compress_requests=compression)
+            client.login(username='user', password='secret', eauth='auto')
+
+            low_state = {'client': 'local', 'tgt': '*', 'fun': 'grains.item', 'arg': sorted(prepare_grains(DATA))}
+            response = client.low([low_state])
+            assert response['return'][0] == server.grains
+
+            def upload():
+                for batch in batch_low_states(chunk_low_states('minion', src, '/tmp/upload.log', 65536), 2 ** 20):
+                    client.low(batch)
+
+            name = 'gzip' if compression else 'identity'
+            elapsed, _, sent = measure(server, lambda: client.low([low_state]), args.repeat)
+            print(f'grains.item response, {name:>8}: {sent / 2 ** 20:6.2f} MiB, {elapsed * 1000:8.1f} ms')
+            elapsed, received, _ = measure(server, upload, args.repeat)
+            print(f'    file upload, {name:>8}: {received / 2 ** 20:6.2f} MiB, {elapsed * 1000:8.1f} ms')
+            client.close()
+
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Benchmark of the JSON codec on realistic grains payloads.
+
+Compares the json module with the codec of common.py, which uses orjson if
+installed, parsing a grains.item response of a large fleet, writing its resource model
+and writing its grains to the grains cache.
+
+Run from the repository root:
+    PYTHONPATH=contents python -m tests.benchmarks.bench_json_codec
+"""
+import argparse
+import io
+import json
+import time
+
+from contents.common import JSON_CODEC, json_dumps, json_loads
+from contents.salt_resource_model_source import generate_resource_model, prepare_grains, write_resource_model
+from tests.benchmarks.synthetic import grains_item_returns, synthetic_fleet
+
+DATA = {
+    'prefix': None,
+    'tags': 'os,roles,virtual,datacenter,kernel',
+    'attributes': 'master,num_cpus,mem_total,systemd:version,osfinger,datacenter,kernelrelease,hostname',
+}
+
+
+def stdlib_write_resource_model(resource_model, out):
+    """
+    Write the resource model with the json module.
+    """
+    out.write(json.dumps(resource_model, separators=(',', ':')) + '\n')
+
+
+def codec_write_resource_model(resource_model, out):
+    """
+    Write the resource model with the codec, one node at a time.
+    """
+    write_resource_model(resource_model.items(), out)
+
+
+def measure(function, argument, repeat):
+    """
+    Return the best wall time of repeated calls in seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(argument)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--minions', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    # the response of grains.item collecting all grains of the fleet
+    fleet = synthetic_fleet(args.minions)
+    returns = {minion: {'ret': grains, 'retcode': 0} for minion, grains in fleet.items()}
+    response = json.dumps({'return': [returns]}).encode()
+    resource_model = generate_resource_model(grains_item_returns(fleet, prepare_grains(DATA)), DATA)
+
+    # the output is byte-identical
+    stdlib_out, codec_out = io.StringIO(), io.StringIO()
+    stdlib_write_resource_model(resource_model, stdlib_out)
+    codec_write_resource_model(resource_model, codec_out)
+    assert stdlib_out.getvalue() == codec_out.getvalue()
+    assert json_loads(response) == json.loads(response)
+
+    print(f'{args.minions} minions, response of {len(response) / 2 ** 20:.1f} MiB, codec {JSON_CODEC}, '
+          f'best of {args.repeat}')
+    for name, function, argument in [
+        ('parse response, json', json.loads, response),
+        ('parse response, codec', json_loads, response),
+        ('write model, json', lambda model: stdlib_write_resource_model(model, io.StringIO()), resource_model),
+        ('write model, codec', lambda model: codec_write_resource_model(model, io.StringIO()), resource_model),
+        ('write cache, json', json.dumps, returns),
+        ('write cache, codec', json_dumps, returns),
+    ]:
+        elapsed = measure(function, argument, args.repeat)
+        print(f'{name:>22}: {elapsed * 1000:8.1f} ms total, {elapsed / args.minions * 1e6:6.2f} us per minion')
+
+
+if __name__ == '__main__':
+    main()
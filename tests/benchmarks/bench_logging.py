@@ -0,0 +1,85 @@
+"""
+Benchmark of the debug logging of the FileCopier per uploaded batch of chunks.
+
+Measures the time spent logging the low state payload and the response of
+each batch, formatted eagerly with f-strings as before and lazily with
+Preview, at the ERROR level Rundeck runs the providers with by default and
+at the DEBUG level.
+
+Run from the repository root:
+    PYTHONPATH=contents python -m tests.benchmarks.bench_logging
+"""
+import argparse
+import io
+import logging
+import os
+import tempfile
+import time
+
+from contents.common import Preview
+from contents.salt_file_copier import batch_low_states, chunk_low_states
+from tests.benchmarks.bench_compression import synthetic_file
+
+log = logging.getLogger('bench_logging')
+
+
+def eager(batch, response):
+    log.debug(f'Low state Payload: {batch}')
+    log.debug(f'Received raw response: {response}')
+
+
+def lazy(batch, response):
+    log.debug('Low state Payload: %s', Preview(batch))
+    log.debug('Received raw response: %s', Preview(response))
+
+
+def measure(function, batches, repeat):
+    """
+    Return the best wall time of logging all batches in seconds, and the
+    number of characters logged.
+    """
+    best = None
+    for _ in range(repeat):
+        stream = io.StringIO()
+        handler = logging.StreamHandler(stream)
+        log.addHandler(handler)
+        start = time.perf_counter()
+        for batch, response in batches:
+            function(batch, response)
+        elapsed = time.perf_counter() - start
+        log.removeHandler(handler)
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(stream.getvalue())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--file-size', type=int, default=16 * 2 ** 20)
+    parser.add_argument('--chunk-size', type=int, default=65536)
+    parser.add_argument('--request-size', type=int, default=2 ** 20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        src = os.path.join(directory, 'upload.log')
+        synthetic_file(src, args.file_size)
+        batches = []
+        for batch in batch_low_states(chunk_low_states('minion', src, '/tmp/upload.log', args.chunk_size),
+                                      args.request_size):
+            response = {'return': [{low_state['tgt']: {'ret': True, 'retcode': 0}} for low_state in batch]}
+            batches.append((batch, response))
+
+    chunks = sum(len(batch) for batch, _ in batches)
+    print(f'file of {args.file_size / 2 ** 20:.1f} MiB, {chunks} chunks in {len(batches)} requests, '
+          f'best of {args.repeat}')
+    log.propagate = False
+    for level in (logging.ERROR, logging.DEBUG):
+        log.setLevel(level)
+        for name, function in (('f-string', eager), ('lazy', lazy)):
+            elapsed, logged = measure(function, batches, args.repeat)
+            print(f'{logging.getLevelName(level):>5}, {name:>8}: {elapsed / chunks * 1e6:9.2f} us per chunk, '
+                  f'{logged / 1024:8.1f} KiB logged')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Benchmark of the per-node cost of compiling the resource model.
+
+Compares compiling the tags and attributes once into an extraction plan with
+parsing the configuration again for every minion.
+
+Run from the repository root:
+    PYTHONPATH=contents python -m tests.benchmarks.bench_resource_model
+"""
+import argparse
+import time
+
+from contents.salt_resource_model_source import RESERVED_KEYS, generate_resource_model, get_os_family, \
+    prepare_grains, process_attributes, process_tags, string_to_unique_set
+from tests.benchmarks.synthetic import grains_item_returns, synthetic_fleet
+
+DATA = {
+    'prefix': None,
+    'tags': 'os,roles,virtual,datacenter,kernel',
+    'attributes': 'master,num_cpus,mem_total,systemd:version,osfinger,datacenter,kernelrelease,hostname',
+}
+
+
+def per_minion_resource_model(minions, data):
+    """
+    Compile the resource model parsing the configuration for every minion.
+    """
+    resource_model = {}
+    for minion, ret in minions.items():
+        grains = ret['ret']
+        model = {
+            'nodename': minion,
+            'hostname': minion,
+            'osArch': 'x86_64' if grains['cpuarch'] in ['x86_64', 'AMD64'] else grains['cpuarch'],
+            'osName': grains['os'],
+            'osVersion': grains['osrelease'],
+            'osFamily': get_os_family(grains['os_family']),
+            'tags': sorted(process_tags(grains, string_to_unique_set(data['tags']))),
+        }
+        model.update(process_attributes(grains, string_to_unique_set(data['attributes']), RESERVED_KEYS))
+        resource_model[minion] = model
+    return resource_model
+
+
+def measure(function, minions, repeat):
+    """
+    Return the best wall time of repeated calls in seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(minions, DATA)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--minions', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    minions = grains_item_returns(synthetic_fleet(args.minions), prepare_grains(DATA))
+    assert per_minion_resource_model(minions, DATA) == generate_resource_model(minions, DATA)
+
+    print(f'{args.minions} minions, best of {args.repeat}')
+    for name, function in [('per-minion configuration', per_minion_resource_model),
+                           ('compiled extraction plan', generate_resource_model)]:
+        elapsed = measure(function, minions, args.repeat)
+        print(f'{name:>26}: {elapsed * 1000:8.1f} ms total, {elapsed / args.minions * 1e6:6.2f} us per node')
+
+
+if __name__ == '__main__':
+    main()
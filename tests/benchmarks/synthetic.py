@@ -0,0 +1,90 @@
+"""
+Synthetic grains of a fleet of minions, shaped like the grains of real
+minions, for benchmarks and scale tests.
+"""
+import random
+
+OS_RELEASES = [
+    ('SUSE', 'Suse', '15.5'),
+    ('openSUSE', 'Suse', '15.6'),
+    ('Ubuntu', 'Debian', '22.04'),
+    ('Debian', 'Debian', '12'),
+    ('RedHat', 'RedHat', '9.3'),
+    ('Rocky', 'RedHat', '8.9'),
+    ('Windows', 'Windows', '2022Server'),
+    ('AIX', 'AIX', '7.2'),
+]
+
+ROLES = ['web', 'db', 'cache', 'queue', 'proxy', 'monitoring', 'build', 'storage']
+
+
+def synthetic_grains(index: int, rng: random.Random) -> dict:
+    """
+    Return the complete grains of a single minion, including lists, nested
+    dicts and optional grains which are missing on some minions.
+    """
+    os_name, os_family, osrelease = OS_RELEASES[index % len(OS_RELEASES)]
+    minion_id = f'minion{index:06d}.example.org'
+
+    grains = {
+        'id': minion_id,
+        'host': minion_id.split('.')[0],
+        'hostname': minion_id.split('.')[0],
+        'fqdn': minion_id,
+        'cpuarch': 'AMD64' if os_family == 'Windows' else rng.choice(['x86_64', 'x86_64', 'aarch64']),
+        'os': os_name,
+        'os_family': os_family,
+        'osrelease': osrelease,
+        'osfinger': f'{os_name}-{osrelease}',
+        'kernel': 'Windows' if os_family == 'Windows' else 'Linux',
+        'kernelrelease': f'5.{rng.randint(3, 19)}.{rng.randint(0, 200)}-default',
+        'num_cpus': rng.choice([2, 4, 8, 16, 32, 64]),
+        'mem_total': rng.choice([2048, 4096, 8192, 16384, 65536]),
+        'virtual': rng.choice(['physical', 'kvm', 'VMware']),
+        'saltversion': '3006.7',
+        'master': 'salt.example.org',
+        'ipv4': [f'10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}', '127.0.0.1'],
+        'ipv6': ['::1', f'fe80::{index:x}'],
+        'ip_interfaces': {
+            'eth0': [f'10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}'],
+            'lo': ['127.0.0.1', '::1'],
+        },
+        'systemd': {
+            'version': str(rng.randint(234, 255)),
+            'features': '+PAM +AUDIT +SELINUX -APPARMOR +IMA +SMACK +SECCOMP +GCRYPT',
+        },
+        'disks': [f'sd{chr(97 + disk)}' for disk in range(rng.randint(1, 4))],
+        'gpus': [{'model': 'Virtual', 'vendor': 'unknown'}],
+        'selinux': {'enabled': rng.random() < 0.5, 'enforced': 'Permissive'},
+    }
+
+    # optional grains only set on some minions
+    if rng.random() < 0.8:
+        grains['roles'] = rng.sample(ROLES, rng.randint(1, 3))
+    if rng.random() < 0.5:
+        grains['datacenter'] = rng.choice(['fra1', 'ams2', 'nyc3'])
+
+    return grains
+
+
+def synthetic_fleet(count: int, seed: int = 0) -> dict:
+    """
+    Return the complete grains of a fleet of minions, by minion id.
+    """
+    rng = random.Random(seed)
+    fleet = {}
+    for index in range(count):
+        grains = synthetic_grains(index, rng)
+        fleet[grains['id']] = grains
+    return fleet
+
+
+def grains_item_returns(fleet: dict, keys: set) -> dict:
+    """
+    Return the full returns of grains.item for the given keys, as received
+    from the Salt-API.
+    """
+    from contents.salt_resource_model_source import project_grains
+
+    return {minion: {'ret': project_grains(grains, keys), 'retcode': 0, 'jid': '20240101000000000000'}
+            for minion, grains in fleet.items()}
@@ -1,3 +1,6 @@
+import pytest
+
+
 def pytest_addoption(parser):
     parser.addoption(
          '--salt-api-backend',
@@ -5,3 +8,29 @@ def pytest_addoption(parser):
          default='rest_cherrypy',
          help='which backend to use for salt-api, must be one of rest_cherrypy or rest_tornado',
      )
+    parser.addoption(
+        '--run-scale',
+        action='store_true',
+        default=False,
+        help='run the scale tests of large synthetic fleets',
+    )
+    parser.addoption(
+        '--update-scale-baselines',
+        action='store_true',
+        default=False,
+        help='write the measurements of the scale tests as new baselines instead of comparing against them',
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'scale: scale test of a large synthetic fleet, run with --run-scale')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--run-scale') or config.getoption('--update-scale-baselines'):
+        return
+
+    skip_scale = pytest.mark.skip(reason='scale tests run with --run-scale')
+    for item in items:
+        if 'scale' in item.keywords:
+            item.add_marker(skip_scale)
@@ -102,8 +102,10 @@ def test_empty_destination_file(rundeck_environment_base, session_minion_id, ses
     assert sys_exit.value.code == 1
 
 
-@pytest.mark.parametrize("file_length", [1000, 1024*2])
-def test_file_transfer(rundeck_environment_base, session_minion_id, session_salt_api, file_length, tmp_path, capsys):
+@pytest.mark.parametrize("request_size", ['0', str(4096)])
+@pytest.mark.parametrize("file_length", [1000, 1024*2, 1024*5])
+def test_file_transfer(rundeck_environment_base, session_minion_id, session_salt_api, file_length, request_size,
+                       tmp_path, capsys):
     assert session_salt_api.is_running()
 
     env = rundeck_environment_base.copy()
@@ -116,6 +118,7 @@ def test_file_transfer(rundeck_environment_base, session_minion_id, session_salt
         'RD_FILE_COPY_FILE': str(src),
         'RD_FILE_COPY_DESTINATION': str(dest),
         'RD_CONFIG_SALT_FILE_COPY_CHUNK_SIZE': str(1024),
+        'RD_CONFIG_SALT_FILE_COPY_REQUEST_SIZE': request_size,
     })
 
     # create test file
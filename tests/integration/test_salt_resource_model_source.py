@@ -102,7 +102,9 @@ def test_nonexisting_target_resource_model(rundeck_environment_base, session_sal
     assert sys_exit.value.code == 0
 
 
-def test_resource_model_with_tags_and_attributes(rundeck_environment_base, session_minion_id, session_salt_api, capsys):
+@pytest.mark.parametrize("streaming", ['false', 'true'])
+def test_resource_model_with_tags_and_attributes(rundeck_environment_base, session_minion_id, session_salt_api,
+                                                 streaming, capsys):
     assert session_salt_api.is_running()
 
     env = rundeck_environment_base.copy()
@@ -111,6 +113,7 @@ def test_resource_model_with_tags_and_attributes(rundeck_environment_base, sessi
         'RD_CONFIG_TGT': session_minion_id,
         'RD_CONFIG_TAGS': 'os,osrelease',
         'RD_CONFIG_ATTRIBUTES': 'os,osrelease',
+        'RD_CONFIG_STREAMING': streaming,
     })
 
     with mock.patch.dict(os.environ, env):
@@ -137,3 +140,37 @@ def test_resource_model_with_tags_and_attributes(rundeck_environment_base, sessi
 
     # test shouldn't have run into an error
     assert sys_exit.value.code == 0
+
+
+def test_master_cache_resource_model(rundeck_environment_base, session_minion_id, session_salt_api, capsys):
+    assert session_salt_api.is_running()
+
+    env = rundeck_environment_base.copy()
+
+    env.update({
+        'RD_CONFIG_TGT': session_minion_id,
+        'RD_CONFIG_COLLECTOR': 'master-cache',
+        'RD_CONFIG_CACHE_FALLBACK': 'true',
+        'RD_CONFIG_ATTRIBUTES': 'os,osrelease',
+    })
+
+    with mock.patch.dict(os.environ, env):
+        with pytest.raises(SystemExit) as sys_exit:
+            main_function()
+
+    out, err = capsys.readouterr()
+
+    assert err == ''
+
+    try:
+        out_data = json.loads(out)
+        assert isinstance(out_data, dict)
+    except json.JSONDecodeError:
+        pytest.fail("Failed to parse JSON string")
+
+    # the minion should be part of the returned object
+    assert session_minion_id in out_data.keys()
+    assert 'os' in out_data.get(session_minion_id, {}).keys()
+
+    # test shouldn't have run into an error
+    assert sys_exit.value.code == 0
@@ -0,0 +1,138 @@
+"""
+Scale and memory regression tests of the resource model source.
+
+Compiles the resource model of synthetic fleets and writes its JSON output,
+measuring the wall time and the peak memory traced by tracemalloc. The wall
+time is taken relative to a calibration workload on the same fleet, so it
+does not depend on the speed of the machine. Both are compared against the
+baselines committed in baselines.json and fail once they regress beyond the
+tolerance.
+
+Run from the tests directory:
+    PYTHONPATH=../contents python -m pytest -q scale --run-scale
+
+After an intended change of the measurements, or with a different Python
+version, write new baselines with --update-scale-baselines.
+"""
+import gc
+import io
+import json
+import logging
+import os
+import time
+import tracemalloc
+
+import pytest
+
+from contents.salt_resource_model_source import generate_resource_model, prepare_grains, write_resource_model
+from tests.benchmarks.synthetic import grains_item_returns, synthetic_fleet
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+
+# relative regressions of the relative wall time and peak memory which fail
+# the test
+TIME_TOLERANCE = 0.5
+MEMORY_TOLERANCE = 0.1
+
+# the wall time is the best of a few runs, each starting without garbage
+REPEAT = 5
+
+DATA = {
+    'prefix': None,
+    'tags': 'os,roles,virtual,datacenter,kernel,cpuarch',
+    'attributes': 'master,num_cpus,mem_total,systemd:version,osfinger,datacenter,kernelrelease,hostname,disks,'
+                  'selinux:enabled,gpus:0:vendor',
+}
+
+
+def load_baselines() -> dict:
+    try:
+        with open(BASELINES, 'r', encoding='utf-8') as baselines_file:
+            return json.load(baselines_file)
+    except FileNotFoundError:
+        return {}
+
+
+def write_baseline(minions: int, measurement: dict):
+    baselines = load_baselines()
+    baselines[str(minions)] = measurement
+    with open(BASELINES, 'w', encoding='utf-8') as baselines_file:
+        json.dump(baselines, baselines_file, indent=2, sort_keys=True)
+        baselines_file.write('\n')
+
+
+def resource_model_output(minions: dict) -> int:
+    """
+    Compile the resource model and write its JSON output, returning the size
+    of the output.
+    """
+    out = io.StringIO()
+    write_resource_model(generate_resource_model(minions, DATA).items(), out)
+    return out.tell()
+
+
+def calibration_workload(minions: dict) -> int:
+    """
+    Format every grain of the fleet, plain Python work scaling with the fleet
+    like the resource model, against which its wall time is measured.
+    """
+    size = 0
+    for minion, ret in minions.items():
+        for key, value in ret['ret'].items():
+            size += len(f'{minion}:{key}={value!r}')
+    return size
+
+
+def best_seconds(function, *args) -> float:
+    """
+    Return the best wall time of repeated calls, each starting without
+    garbage.
+    """
+    seconds = None
+    for _ in range(REPEAT):
+        gc.collect()
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    return seconds
+
+
+@pytest.fixture
+def quiet_resource_model_source():
+    # warnings about unsupported attribute values are not measured
+    logger = logging.getLogger('contents.salt_resource_model_source')
+    level = logger.level
+    logger.setLevel(logging.ERROR)
+    yield
+    logger.setLevel(level)
+
+
+@pytest.mark.scale
+@pytest.mark.parametrize('count', [1000, 10000, 50000])
+def test_resource_model_scale(request, quiet_resource_model_source, count):
+    minions = grains_item_returns(synthetic_fleet(count), prepare_grains(DATA))
+
+    relative_time = best_seconds(resource_model_output, minions) / best_seconds(calibration_workload, minions)
+
+    tracemalloc.start()
+    try:
+        size = resource_model_output(minions)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    measurement = {'relative_time': round(relative_time, 3), 'peak_bytes': peak, 'output_bytes': size}
+    if request.config.getoption('--update-scale-baselines'):
+        write_baseline(count, measurement)
+        return
+
+    baseline = load_baselines().get(str(count))
+    if baseline is None:
+        pytest.fail(f'No baseline for {count} minions, write it with --update-scale-baselines')
+
+    assert size == baseline['output_bytes'], 'The output of the synthetic fleet changed'
+    assert relative_time <= baseline['relative_time'] * (1 + TIME_TOLERANCE), \
+        f"Wall time regressed from {baseline['relative_time']:.2f} to {relative_time:.2f} times the calibration"
+    assert peak <= baseline['peak_bytes'] * (1 + MEMORY_TOLERANCE), \
+        f"Peak memory regressed from {baseline['peak_bytes'] / 2 ** 20:.1f} MiB to {peak / 2 ** 20:.1f} MiB"
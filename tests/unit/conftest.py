@@ -0,0 +1,230 @@
+import gzip
+import json
+import shutil
+import socket
+import ssl
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class FakeSaltApiHandler(BaseHTTPRequestHandler):
+    """
+    Salt-API stand-in answering logins, low states and the event stream.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('X-Auth-Token'), self.headers.get('Accept')))
+
+        # the stream ends when the connection is closed
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(b'retry: 400\n\n')
+        for event in self.server.events:
+            self.wfile.write(sse(event))
+        self.wfile.flush()
+        # a silent stream keeps the connection open
+        self.server.release.wait(self.server.silence)
+        self.close_connection = True
+
+    def do_POST(self):
+        with self.server.lock:
+            if self.client_address not in self.server.connections:
+                self.server.resumed.append(getattr(self.connection, 'session_reused', None))
+            self.server.connections.add(self.client_address)
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+        try:
+            self.respond()
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def respond(self):
+        content = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            content = gzip.decompress(content)
+        request = json.loads(content)
+        self.server.requests.append((self.path, self.headers.get('X-Auth-Token'), request))
+        self.server.headers.append(self.headers)
+
+        status = 200
+        if self.path == '/login':
+            status = 200 if request.get('password') == 'secret' else 401
+            body = {'return': [{'token': 'abc', 'eauth': request.get('eauth')}]}
+        else:
+            for low_state in request:
+                if low_state.get('fun') == 'test.sleep':
+                    time.sleep(low_state['arg'][0])
+                elif low_state.get('fun') == 'test.exception':
+                    status = 500
+            body = {'return': [low_state_return(low_state) for low_state in request]}
+
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            content = gzip.compress(content)
+            self.send_header('Content-Encoding', 'gzip')
+
+        if self.server.chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for position in range(0, len(content), 16):
+                chunk = content[position:position + 16]
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def low_state_return(low_state):
+    """
+    Return the fake return of a low state.
+    """
+    if low_state['client'] == 'wheel':
+        return {'data': {'return': {'minions': ['m1', 'm2']}}}
+    if low_state['client'] == 'local_async':
+        return {'jid': '20240101000000000000', 'minions': ['m1']}
+    return {low_state['tgt']: True}
+
+
+def sse(event):
+    """
+    Encode an event as server-sent event.
+    """
+    return f"tag: {event['tag']}\ndata: {json.dumps(event)}\n\n".encode()
+
+
+def start_fake_salt_api(context=None):
+    """
+    Start a FakeSaltApiHandler server, serving HTTPS with the TLS context if
+    given.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSaltApiHandler)
+    if context is not None:
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.connections = set()
+    # whether each connection resumed a TLS session
+    server.resumed = []
+    server.requests = []
+    server.headers = []
+    server.in_flight = server.max_in_flight = 0
+    server.chunked = False
+    server.events = []
+    server.silence = 0
+    server.release = threading.Event()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def stop_fake_salt_api(server):
+    server.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fake_salt_api():
+    server = start_fake_salt_api()
+    yield server
+    stop_fake_salt_api(server)
+
+
+@pytest.fixture
+def fake_salt_api_tls(tmp_path):
+    """
+    FakeSaltApiHandler server serving HTTPS with a self-signed certificate.
+    """
+    if shutil.which('openssl') is None:
+        pytest.skip('openssl is required to create a certificate')
+
+    cert, key = tmp_path / 'cert.pem', tmp_path / 'key.pem'
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                    '-nodes', '-days', '1', '-subj', '/CN=127.0.0.1', '-keyout', str(key), '-out', str(cert)],
+                   check=True, capture_output=True)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+
+    server = start_fake_salt_api(context)
+    yield server
+    stop_fake_salt_api(server)
+
+
+class ScriptedSaltApi:
+    """
+    Salt-API stand-in answering the requests of each connection as scripted:
+    'respond' sends a response and keeps the connection open, 'close' closes
+    the connection without a response and 'truncate' closes it in the middle
+    of the response.
+    """
+
+    def __init__(self, scripts):
+        self.scripts = list(scripts)
+        self.requests = 0
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        for script in self.scripts:
+            try:
+                connection, _ = self.sock.accept()
+            except OSError:
+                # closed before the scripted connection was opened
+                return
+            with connection, connection.makefile('rb') as request:
+                for action in script:
+                    length = 0
+                    for line in iter(request.readline, b'\r\n'):
+                        if line.lower().startswith(b'content-length:'):
+                            length = int(line.split(b':')[1])
+                    request.read(length)
+                    self.requests += 1
+
+                    content = json.dumps({'return': [{'minion': True}]}).encode()
+                    head = b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n'
+                    if action == 'respond':
+                        connection.sendall(head % len(content) + content)
+                    elif action == 'truncate':
+                        connection.sendall(head % len(content) + content[:10])
+                        break
+                    else:
+                        break
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def scripted_salt_api():
+    """
+    Factory of ScriptedSaltApi stand-ins, which are closed after the test.
+    """
+    servers = []
+
+    def start(scripts):
+        server = ScriptedSaltApi(scripts)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
@@ -0,0 +1,162 @@
+import asyncio
+import socket
+import time
+
+import pytest
+
+from contents.common import AsyncSaltApiClient, SaltApiClient, SaltApiError
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def low_state(tgt, fun='test.ping', arg=None):
+    return {'client': 'local', 'tgt': tgt, 'fun': fun, 'arg': arg or []}
+
+
+@pytest.mark.parametrize('compression', [True, False])
+@pytest.mark.parametrize('chunked', [True, False])
+def test_requests_reuse_connections(fake_salt_api, compression, chunked):
+    fake_salt_api.chunked = chunked
+    client = AsyncSaltApiClient(api_url=f'http://127.0.0.1:{fake_salt_api.server_port}', compression=compression)
+
+    async def requests():
+        await client.login(username='user', password='secret', eauth='auto')
+        responses = [await client.low([low_state(f'm{index}')]) for index in range(3)]
+        client.close()
+        return responses
+
+    assert run(requests()) == [{'return': [{f'm{index}': True}]} for index in range(3)]
+    assert client.auth == {'token': 'abc', 'eauth': 'auto'}
+
+    # the token is sent with every request after login
+    assert [token for _, token, _ in fake_salt_api.requests] == [None, 'abc', 'abc', 'abc']
+    assert len(fake_salt_api.connections) == 1
+
+
+def test_concurrency_bound(fake_salt_api):
+    client = AsyncSaltApiClient(api_url=f'http://127.0.0.1:{fake_salt_api.server_port}', max_connections=2)
+
+    async def requests():
+        responses = await asyncio.gather(*(client.low([low_state(f'm{index}', 'test.sleep', [0.1])])
+                                           for index in range(6)))
+        client.close()
+        return responses
+
+    assert run(requests()) == [{'return': [{f'm{index}': True}]} for index in range(6)]
+    assert fake_salt_api.max_in_flight == 2
+    # the connections are reused by the waiting requests
+    assert len(fake_salt_api.connections) == 2
+
+
+def test_deadline(fake_salt_api):
+    client = AsyncSaltApiClient(api_url=f'http://127.0.0.1:{fake_salt_api.server_port}')
+
+    async def requests():
+        with pytest.raises(SaltApiError, match='deadline of 0.1 seconds') as excinfo:
+            await client.low([low_state('slow', 'test.sleep', [1])], deadline=0.1)
+
+        # the connection of the request missing its deadline is dropped
+        response = await client.low([low_state('fast')], deadline=5)
+        client.close()
+        return excinfo.value, response
+
+    error, response = run(requests())
+    assert (error.path, error.status) == ('/', None)
+    assert response == {'return': [{'fast': True}]}
+
+
+@pytest.mark.parametrize(('path', 'request_data', 'message', 'status'), [
+    ('/login', {'username': 'user', 'password': 'wrong', 'eauth': 'auto'}, 'Authentication denied', 401),
+    ('/', [low_state('minion', 'test.exception')], 'Server error.', 500),
+])
+def test_status_errors(fake_salt_api, path, request_data, message, status):
+    client = AsyncSaltApiClient(api_url=f'http://127.0.0.1:{fake_salt_api.server_port}')
+
+    with pytest.raises(SaltApiError, match=message) as excinfo:
+        run(client.req(path, request_data))
+
+    assert (excinfo.value.path, excinfo.value.status) == (path, status)
+
+
+def test_connection_refused():
+    # a port nobody listens on
+    with socket.socket() as unused:
+        unused.bind(('127.0.0.1', 0))
+        port = unused.getsockname()[1]
+    client = AsyncSaltApiClient(api_url=f'http://127.0.0.1:{port}')
+
+    with pytest.raises(SaltApiError, match='Error with request'):
+        run(client.low([low_state('minion')]))
+
+
+@pytest.mark.parametrize(('scripts', 'succeeds', 'requests'), [
+    # the server closed the idle connection, the request is sent again
+    ([['respond', 'close'], ['respond']], True, 3),
+    # the request on a fresh connection is not sent again
+    ([['respond'], ['close']], False, 2),
+    # the response was cut off, the request was processed
+    ([['respond', 'truncate'], ['respond']], False, 2),
+], ids=['idle-closed', 'fresh-closed', 'truncated'])
+def test_retry_only_unprocessed_requests(scripted_salt_api, scripts, succeeds, requests):
+    server = scripted_salt_api(scripts)
+    client = AsyncSaltApiClient(api_url=f'http://127.0.0.1:{server.port}')
+    command = low_state('minion', 'cmd.run', ['true'])
+
+    async def exchange():
+        assert await client.low([command]) == {'return': [{'minion': True}]}
+        if scripts[0] == ['respond']:
+            client.close()
+        if succeeds:
+            assert await client.low([command]) == {'return': [{'minion': True}]}
+        else:
+            with pytest.raises(SaltApiError, match='Error with request'):
+                await client.low([command])
+        client.close()
+
+    run(exchange())
+    server.close()
+    assert server.requests == requests
+
+
+def test_low_as_completed(fake_salt_api):
+    client = SaltApiClient(api_url=f'http://127.0.0.1:{fake_salt_api.server_port}')
+    client.login(username='user', password='secret', eauth='auto')
+
+    responses = list(client.low_as_completed([
+        [low_state('m1', 'test.sleep', [0.4])],
+        [low_state('m2', 'test.exception')],
+        [low_state('m3', 'test.sleep', [0.2])],
+    ], concurrency=3))
+    client.close()
+
+    # the responses are yielded as the requests complete, a failed request
+    # does not affect the others
+    assert [position for position, _ in responses] == [1, 2, 0]
+    assert isinstance(responses[0][1], SaltApiError) and responses[0][1].status == 500
+    assert responses[1][1] == {'return': [{'m3': True}]}
+    assert responses[2][1] == {'return': [{'m1': True}]}
+    assert fake_salt_api.max_in_flight >= 2
+
+    # the requests share the token of the client
+    assert [token for _, token, _ in fake_salt_api.requests] == [None, 'abc', 'abc', 'abc']
+
+
+def test_low_as_completed_stopped(fake_salt_api):
+    client = SaltApiClient(api_url=f'http://127.0.0.1:{fake_salt_api.server_port}')
+
+    responses = client.low_as_completed([
+        [low_state('m1')],
+        [low_state('m2', 'test.sleep', [5])],
+    ], concurrency=2)
+    assert next(responses) == (0, {'return': [{'m1': True}]})
+
+    # the pending request is cancelled when the caller stops
+    started = time.monotonic()
+    responses.close()
+    assert time.monotonic() - started < 1
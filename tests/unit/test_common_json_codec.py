@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+import contents.common
+from contents.common import json_dumps, json_loads
+
+
+VALUES = [
+    {},
+    {'return': [{'m1': {'ret': {'os': 'SUSE', 'num_cpus': 4, 'ipv4': ['127.0.0.1'], 'virtual': None}, 'retcode': 0}}]},
+    {'nodename': 'mïnion', 'description': 'tab\tquote" backslash\\ emoji \U0001f600 control \x7f\x01'},
+    {1: 'int key', None: 'null key'},
+    {True: 'bool key', False: 'bool key'},
+    [2 ** 63, -2 ** 64, 1.5, 0.1, -0.0, True, False, None],
+    {1e-07: 'float key', 1.5: 'float key'},
+    1e-07,
+]
+
+
+@pytest.fixture(params=['orjson', 'json'])
+def codec(request, monkeypatch):
+    if request.param == 'json':
+        monkeypatch.setattr(contents.common, 'orjson', None)
+    elif contents.common.orjson is None:
+        pytest.skip('orjson is not installed')
+    return request.param
+
+
+@pytest.mark.parametrize('value', VALUES)
+@pytest.mark.parametrize('sort_keys', [False, True])
+def test_json_dumps(codec, value, sort_keys):
+    if sort_keys and isinstance(value, dict) and len({type(key) for key in value}) > 1:
+        pytest.skip('keys of mixed types cannot be sorted')
+
+    assert json_dumps(value, sort_keys) == json.dumps(value, separators=(',', ':'), sort_keys=sort_keys)
+
+
+@pytest.mark.parametrize('grains', [
+    {'load': 0.00001},
+    {'ratio': 1e-07, 'os': 'SUSE'},
+    {'sizes': [1e300, 1e16, -1.5e-07]},
+    {'version': 1.5},
+    # floats in strings are left as they are
+    {'osrelease': '15.5', 'ipv6': ['fe80::1e5'], 'note': 'a:1e-7,'},
+])
+def test_json_dumps_float_grains(codec, grains):
+    value = {'m1': {'ret': grains, 'retcode': 0}}
+
+    assert json_dumps(value) == json.dumps(value, separators=(',', ':'))
+
+
+@pytest.mark.parametrize('content', [
+    b'{"return": [{"m1": {"ret": {"os": "SUSE"}, "retcode": 0}}]}',
+    '{"nodename": "mïnion"}',
+    '[18446744073709551616, NaN, 1e+16]',
+])
+def test_json_loads(codec, content):
+    assert json_dumps(json_loads(content)) == json_dumps(json.loads(content))
+
+
+def test_json_dumps_ascii(codec):
+    # the output can be written in a locale of any encoding
+    assert json_dumps({'nodename': 'mïnion \U0001f600'}).encode('ascii') == \
+        b'{"nodename":"m\\u00efnion \\ud83d\\ude00"}'
+
+
+def test_json_loads_invalid(codec):
+    with pytest.raises(ValueError):
+        json_loads(b'{"return": [')
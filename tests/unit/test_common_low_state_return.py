@@ -0,0 +1,35 @@
+import io
+import json
+
+import pytest
+
+from contents.common import iter_low_state_return
+
+
+MINIONS = {
+    'minion1': {'ret': {'os': 'SUSE', 'num_cpus': 16, 'ipv4': ['10.0.0.1', '127.0.0.1']}, 'retcode': 0},
+    'minion2': {'ret': {'os': 'Debian', 'mem_total': 2.5, 'nested': {'key': 'välue'}}, 'retcode': 0},
+    'minion3': False,
+}
+
+
+@pytest.mark.parametrize('read_size', [1, 7, 65536])
+@pytest.mark.parametrize('indent', [None, 4])
+def test_iter_low_state_return(read_size, indent):
+    stream = io.BytesIO(json.dumps({'return': [MINIONS]}, indent=indent).encode())
+    assert list(iter_low_state_return(stream, read_size=read_size)) == list(MINIONS.items())
+
+
+@pytest.mark.parametrize('body', ['{"return": []}', '{"return": [{}]}'])
+def test_iter_empty_low_state_return(body):
+    assert list(iter_low_state_return(io.BytesIO(body.encode()))) == []
+
+
+@pytest.mark.parametrize('body', [
+    '{"error": []}',
+    '{"return": [{"minion1": {"ret": ',
+    '{"return": [{"minion1" {}}]}',
+])
+def test_iter_invalid_low_state_return(body):
+    with pytest.raises(ValueError):
+        list(iter_low_state_return(io.BytesIO(body.encode())))
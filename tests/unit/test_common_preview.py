@@ -0,0 +1,45 @@
+import logging
+
+import pytest
+
+from contents.common import Preview
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('short', 'short'),
+    (b'bytes', 'bytes'),
+    ({'return': [{'m1': True}]}, '{"return":[{"m1":true}]}'),
+    ([1, None], '[1,null]'),
+    ({'data': {1, 2}}, "{'data': {1, 2}}"),
+])
+def test_preview_short(value, expected):
+    assert str(Preview(value)) == expected
+
+
+@pytest.mark.parametrize('value, size, expected', [
+    ('a' * 12 + 'b' * 12, 8, 'aaaaaa ... bb (24 bytes)'),
+    (b'a' * 12 + b'b' * 12, 8, 'aaaaaa ... bb (24 bytes)'),
+    ('ä' * 10, 4, 'äää ... ä (20 bytes)'),
+    ('x' * 8, 8, 'xxxxxxxx'),
+])
+def test_preview_capped(value, size, expected):
+    assert str(Preview(value, size)) == expected
+
+
+def test_preview_lazy(caplog):
+    class Payload:
+        serialized = 0
+
+        def __repr__(self):
+            Payload.serialized += 1
+            return 'payload'
+
+    log = logging.getLogger('test_preview_lazy')
+    with caplog.at_level(logging.INFO, logger='test_preview_lazy'):
+        log.debug('Payload: %s', Preview(Payload()))
+        assert Payload.serialized == 0
+
+    with caplog.at_level(logging.DEBUG, logger='test_preview_lazy'):
+        log.debug('Payload: %s', Preview(Payload()))
+        assert Payload.serialized
+    assert caplog.messages == ['Payload: payload']
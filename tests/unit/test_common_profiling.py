@@ -0,0 +1,104 @@
+import os
+import sys
+
+import pytest
+
+from contents.common import profiled
+
+
+@profiled('provider')
+def provider_main(size):
+    data = [str(index) for index in range(size)]
+    sys.exit(len(data) % 2)
+
+
+@pytest.mark.parametrize(('profilers', 'expected_sections', 'expected_prof'), [
+    ('cpu', ['Functions with the highest cumulative time'], True),
+    ('memory', ['Peak memory traced'], False),
+    ('cpu, memory,unknown', ['Functions with the highest cumulative time', 'Peak memory traced'], True),
+])
+def test_profiled(monkeypatch, tmp_path, profilers, expected_sections, expected_prof):
+    monkeypatch.setenv('SALT_PLUGIN_PROFILE', profilers)
+    monkeypatch.setenv('SALT_PLUGIN_PROFILE_DIR', str(tmp_path))
+
+    # the exit code of the provider is kept
+    with pytest.raises(SystemExit) as exit_info:
+        provider_main(1001)
+    assert exit_info.value.code == 1
+
+    reports = sorted(tmp_path.glob('provider-*.txt'))
+    assert len(reports) == 1
+    content = reports[0].read_text()
+    assert all(section in content for section in expected_sections)
+    assert reports[0].with_suffix('.prof').exists() == expected_prof
+
+
+@pytest.mark.parametrize('environment', [
+    # Profiling disabled
+    {'SALT_PLUGIN_PROFILE_DIR': 'profiles'},
+    # No directory specified
+    {'SALT_PLUGIN_PROFILE': 'cpu'},
+    # Invocation not sampled
+    {'SALT_PLUGIN_PROFILE': 'cpu', 'SALT_PLUGIN_PROFILE_DIR': 'profiles', 'SALT_PLUGIN_PROFILE_SAMPLE': '0'},
+])
+def test_profiled_disabled(monkeypatch, tmp_path, environment):
+    monkeypatch.chdir(tmp_path)
+    for key in ('SALT_PLUGIN_PROFILE', 'SALT_PLUGIN_PROFILE_DIR'):
+        monkeypatch.delenv(key, raising=False)
+    for key, value in environment.items():
+        monkeypatch.setenv(key, value)
+
+    with pytest.raises(SystemExit):
+        provider_main(10)
+
+    assert not (tmp_path / 'profiles').exists()
+
+
+def test_profiled_keeps_latest_reports(monkeypatch, tmp_path):
+    monkeypatch.setenv('SALT_PLUGIN_PROFILE', 'cpu')
+    monkeypatch.setenv('SALT_PLUGIN_PROFILE_DIR', str(tmp_path))
+    monkeypatch.setenv('SALT_PLUGIN_PROFILE_KEEP', '3')
+
+    for invocation in range(5):
+        with pytest.raises(SystemExit):
+            provider_main(10)
+        # distinct modification times order the reports
+        for report in tmp_path.glob('*.txt'):
+            os.utime(report, (report.stat().st_mtime - 1, report.stat().st_mtime - 1))
+
+    # unique file names, bounded number of reports
+    assert len(list(tmp_path.glob('provider-*.txt'))) == 3
+    assert len(list(tmp_path.glob('provider-*.prof'))) == 3
+
+
+def test_profiled_keeps_other_files(monkeypatch, tmp_path):
+    monkeypatch.setenv('SALT_PLUGIN_PROFILE', 'cpu')
+    monkeypatch.setenv('SALT_PLUGIN_PROFILE_DIR', str(tmp_path))
+    monkeypatch.setenv('SALT_PLUGIN_PROFILE_KEEP', '1')
+    others = ['notes.txt', 'notes.prof', 'other-provider-20240101T120000-4242-x1y2.txt']
+    for other in others:
+        (tmp_path / other).write_text('')
+        os.utime(tmp_path / other, (0, 0))
+
+    for invocation in range(2):
+        with pytest.raises(SystemExit):
+            provider_main(10)
+
+    # only the reports of the provider are removed
+    assert len(list(tmp_path.glob('provider-*.txt'))) == 1
+    assert all((tmp_path / other).exists() for other in others)
+
+
+@pytest.mark.parametrize('setting', ['SALT_PLUGIN_PROFILE_KEEP', 'SALT_PLUGIN_PROFILE_SAMPLE'])
+def test_profiled_invalid_setting(monkeypatch, tmp_path, caplog, setting):
+    monkeypatch.setenv('SALT_PLUGIN_PROFILE', 'cpu')
+    monkeypatch.setenv('SALT_PLUGIN_PROFILE_DIR', str(tmp_path))
+    monkeypatch.setenv(setting, 'ten')
+
+    # the provider runs unprofiled
+    with pytest.raises(SystemExit) as exit_info:
+        provider_main(1001)
+    assert exit_info.value.code == 1
+
+    assert not list(tmp_path.iterdir())
+    assert 'invalid profiling setting' in caplog.text
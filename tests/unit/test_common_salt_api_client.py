@@ -0,0 +1,195 @@
+import socket
+import threading
+
+import pytest
+from pepper.exceptions import PepperException
+
+from contents.common import SaltApiClient, iter_low_state_return
+
+
+def test_requests_share_one_connection(fake_salt_api):
+    client = SaltApiClient(api_url=f'http://127.0.0.1:{fake_salt_api.server_port}')
+    client.login(username='user', password='secret', eauth='auto')
+
+    for _ in range(3):
+        response = client.low([{'client': 'local', 'tgt': 'minion', 'fun': 'test.ping'}])
+        assert response == {'return': [{'minion': True}]}
+
+    client.close()
+
+    assert len(fake_salt_api.requests) == 4
+    assert len(fake_salt_api.connections) == 1
+    # the token is sent with every request after login
+    assert [token for _, token, _ in fake_salt_api.requests] == [None, 'abc', 'abc', 'abc']
+
+
+def test_reconnect_after_close(fake_salt_api):
+    client = SaltApiClient(api_url=f'http://127.0.0.1:{fake_salt_api.server_port}')
+    client.login(username='user', password='secret', eauth='auto')
+    client.close()
+
+    response = client.low([{'client': 'local', 'tgt': 'minion', 'fun': 'test.ping'}])
+    assert response == {'return': [{'minion': True}]}
+    assert len(fake_salt_api.connections) == 2
+
+
+def test_authentication_denied(fake_salt_api):
+    client = SaltApiClient(api_url=f'http://127.0.0.1:{fake_salt_api.server_port}')
+
+    with pytest.raises(PepperException, match='Authentication denied'):
+        client.login(username='user', password='wrong', eauth='auto')
+
+
+@pytest.mark.parametrize('chunked', [True, False])
+def test_low_stream(fake_salt_api, chunked):
+    fake_salt_api.chunked = chunked
+    client = SaltApiClient(api_url=f'http://127.0.0.1:{fake_salt_api.server_port}')
+    client.login(username='user', password='secret', eauth='auto')
+
+    response = client.low_stream([{'client': 'local', 'tgt': 'minion', 'fun': 'test.ping'}])
+    assert list(iter_low_state_return(response)) == [('minion', True)]
+    response.close()
+
+    # the connection remains usable after the body was read
+    assert client.low([{'client': 'local', 'tgt': 'minion', 'fun': 'test.ping'}]) == {'return': [{'minion': True}]}
+    assert len(fake_salt_api.connections) == 1
+
+
+@pytest.mark.parametrize('compression', [True, False])
+def test_compressed_responses(fake_salt_api, compression):
+    client = SaltApiClient(api_url=f'http://127.0.0.1:{fake_salt_api.server_port}', compression=compression)
+    client.login(username='user', password='secret', eauth='auto')
+
+    low_state = {'client': 'local', 'tgt': 'minion', 'fun': 'test.ping'}
+    assert client.low([low_state]) == {'return': [{'minion': True}]}
+    assert list(iter_low_state_return(client.low_stream([low_state]))) == [('minion', True)]
+
+    # the connection is still usable after the compressed bodies were read
+    assert client.low([low_state]) == {'return': [{'minion': True}]}
+    assert len(fake_salt_api.connections) == 1
+
+    expected = 'gzip' if compression else 'identity'
+    assert {headers['Accept-Encoding'] for headers in fake_salt_api.headers} == {expected}
+
+
+@pytest.mark.parametrize(('arg', 'expected_encoding'), [
+    ('x', None),
+    ('x' * 4096, 'gzip'),
+], ids=['small', 'large'])
+def test_compressed_requests(fake_salt_api, arg, expected_encoding):
+    client = SaltApiClient(api_url=f'http://127.0.0.1:{fake_salt_api.server_port}', compress_requests=True)
+    client.login(username='user', password='secret', eauth='auto')
+
+    low_state = {'client': 'local', 'tgt': 'minion', 'fun': 'test.arg', 'arg': [arg]}
+    client.low([low_state])
+
+    # small bodies are sent uncompressed
+    assert fake_salt_api.requests[-1][2] == [low_state]
+    assert fake_salt_api.headers[-1].get('Content-Encoding') == expected_encoding
+
+
+@pytest.mark.parametrize(('scripts', 'succeeds', 'requests'), [
+    # the server closed the idle connection, the request is sent again
+    ([['respond', 'close'], ['respond']], True, 3),
+    # the request on a fresh connection is not sent again
+    ([['respond'], ['close']], False, 2),
+    # the response was cut off, the request was processed
+    ([['respond', 'truncate'], ['respond']], False, 2),
+], ids=['idle-closed', 'fresh-closed', 'truncated'])
+def test_retry_only_unprocessed_requests(scripted_salt_api, scripts, succeeds, requests):
+    server = scripted_salt_api(scripts)
+    client = SaltApiClient(api_url=f'http://127.0.0.1:{server.port}')
+    low_state = {'client': 'local', 'tgt': 'minion', 'fun': 'cmd.run', 'arg': ['true']}
+
+    assert client.low([low_state]) == {'return': [{'minion': True}]}
+    if scripts[0] == ['respond']:
+        client.close()
+    if succeeds:
+        assert client.low([low_state]) == {'return': [{'minion': True}]}
+    else:
+        with pytest.raises(PepperException, match='Error with request'):
+            client.low([low_state])
+
+    client.close()
+    server.close()
+    assert server.requests == requests
+
+
+class ConnectProxy:
+    """
+    Proxy tunneling CONNECT requests to their target.
+    """
+
+    def __init__(self):
+        self.targets = []
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                connection, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.tunnel, args=(connection,), daemon=True).start()
+
+    def tunnel(self, connection):
+        with connection.makefile('rb') as request:
+            target = request.readline().split()[1].decode()
+            while request.readline() not in (b'\r\n', b''):
+                pass
+        self.targets.append(target)
+        host, port = target.rsplit(':', 1)
+        upstream = socket.create_connection((host, int(port)))
+        connection.sendall(b'HTTP/1.1 200 Connection established\r\n\r\n')
+
+        def pipe(source, destination):
+            try:
+                while True:
+                    content = source.recv(65536)
+                    if not content:
+                        break
+                    destination.sendall(content)
+            except OSError:
+                pass
+            finally:
+                source.close()
+                destination.close()
+
+        threading.Thread(target=pipe, args=(upstream, connection), daemon=True).start()
+        pipe(connection, upstream)
+
+    def close(self):
+        self.sock.close()
+
+
+def test_tls_session_resumed(fake_salt_api_tls):
+    client = SaltApiClient(api_url=f'https://127.0.0.1:{fake_salt_api_tls.server_port}', ignore_ssl_errors=True)
+    client.login(username='user', password='secret', eauth='auto')
+    client.close()
+
+    assert client.low([{'client': 'local', 'tgt': 'minion', 'fun': 'test.ping'}]) == {'return': [{'minion': True}]}
+    client.close()
+
+    # the second connection resumes the TLS session of the first
+    assert fake_salt_api_tls.resumed == [False, True]
+
+
+def test_https_proxy_tunnel(monkeypatch, fake_salt_api_tls):
+    proxy = ConnectProxy()
+    for key in ('no_proxy', 'NO_PROXY'):
+        monkeypatch.delenv(key, raising=False)
+    monkeypatch.setenv('https_proxy', f'http://127.0.0.1:{proxy.port}')
+    client = SaltApiClient(api_url=f'https://127.0.0.1:{fake_salt_api_tls.server_port}', ignore_ssl_errors=True)
+
+    client.login(username='user', password='secret', eauth='auto')
+    assert client.low([{'client': 'local', 'tgt': 'minion', 'fun': 'test.ping'}]) == {'return': [{'minion': True}]}
+    client.close()
+    proxy.close()
+
+    # both requests are sent through one tunnel
+    assert proxy.targets == [f'127.0.0.1:{fake_salt_api_tls.server_port}']
+    assert len(fake_salt_api_tls.connections) == 1
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+from contents.salt_batch_step import collect_batch_returns, format_report, node_filter_target, write_report
+
+
+@pytest.mark.parametrize(('node_filter', 'expected'), [
+    # Bare node names
+    ('web1', ['web1']),
+    ('web1 web2 web1', ['web1', 'web2']),
+
+    # Node names by key, with or without a space after the colon
+    ('name: web1,web2', ['web1', 'web2']),
+    ('name:web1,web2 db1', ['web1', 'web2', 'db1']),
+    ('hostname: web1.example.org', ['web1.example.org']),
+    ('nodename: web1 db1', ['web1', 'db1']),
+
+    # Filters resolved against Rundeck's resource model cannot be converted
+    ('', None),
+    ('tags: web', None),
+    ('name: web.*', None),
+    ('web[12]', None),
+    ('!name: web1', None),
+    ('name: web1 osFamily: unix', None),
+])
+def test_node_filter_target(node_filter, expected):
+    assert node_filter_target(node_filter) == expected
+
+
+def test_collect_batch_returns():
+    response = {'return': [
+        {'web1': {'pid': 1, 'retcode': 0, 'stdout': 'ok', 'stderr': ''}},
+        {'web2': {'pid': 2, 'retcode': 2, 'stdout': '', 'stderr': 'failed'},
+         'web3': "'cmd.run_all' is not available."},
+        'No minions matched the target.',
+    ]}
+
+    assert collect_batch_returns(response) == {
+        'web1': {'retcode': 0, 'stdout': 'ok', 'stderr': ''},
+        'web2': {'retcode': 2, 'stdout': '', 'stderr': 'failed'},
+        'web3': {'retcode': 1, 'stdout': '', 'stderr': "'cmd.run_all' is not available."},
+    }
+
+
+@pytest.mark.parametrize(('results', 'missing', 'expected_lines', 'expected_code'), [
+    # All minions succeeded
+    ({'web2': {'retcode': 0, 'stdout': 'b', 'stderr': ''}, 'web1': {'retcode': 0, 'stdout': 'a', 'stderr': ''}}, [],
+     ['--- web1 (retcode 0) ---', 'a', '--- web2 (retcode 0) ---', 'b',
+      '2 minions returned, 0 failed, 0 did not return'], 0),
+
+    # A failed minion fails the step
+    ({'web1': {'retcode': 2, 'stdout': '', 'stderr': 'failed'}}, [],
+     ['--- web1 (retcode 2) ---', 'failed', '1 minions returned, 1 failed, 0 did not return', 'Failed: web1'], 1),
+
+    # A minion without return fails the step
+    ({'web1': {'retcode': 0, 'stdout': '', 'stderr': ''}}, ['web2'],
+     ['--- web1 (retcode 0) ---', '--- web2 (no return) ---', '1 minions returned, 0 failed, 1 did not return'], 1),
+])
+def test_format_report(results, missing, expected_lines, expected_code):
+    report, return_code = format_report(results, missing)
+    assert report.splitlines() == expected_lines
+    assert return_code == expected_code
+
+
+def test_write_report(tmp_path):
+    path = tmp_path / 'reports' / 'report.json'
+    results = {'web1': {'retcode': 0, 'stdout': 'ok', 'stderr': ''}}
+
+    write_report(str(path), results, ['web2'])
+
+    assert json.loads(path.read_text()) == {'minions': results, 'missing': ['web2']}
+    assert [item.name for item in path.parent.iterdir()] == ['report.json']
@@ -0,0 +1,53 @@
+import pytest
+
+from contents.salt_file_copier import batch_low_states, chunk_retcodes, describe_failure
+
+
+def low_state(chunk):
+    return {'fun': 'cp.recv_chunked', 'arg': ['/dest', chunk, False, True, None]}
+
+
+@pytest.mark.parametrize(('chunks', 'request_size', 'expected_batches'), [
+    # Test cases for batch_low_states function
+
+    # No chunks return no batches
+    ([], 0, []),
+
+    # Request size of 0 sends every chunk on its own
+    (['aaaa', 'bbbb', 'cc'], 0, [['aaaa'], ['bbbb'], ['cc']]),
+
+    # Chunks are packed while they fit into the request size
+    (['aaaa', 'bbbb', 'cc'], 8, [['aaaa', 'bbbb'], ['cc']]),
+    (['aaaa', 'bbbb', 'cc'], 10, [['aaaa', 'bbbb', 'cc']]),
+
+    # A chunk larger than the request size is sent on its own
+    (['aaaaaaaaaa', 'bb', 'cc'], 4, [['aaaaaaaaaa'], ['bb', 'cc']]),
+])
+def test_batch_low_states(chunks, request_size, expected_batches):
+    batches = batch_low_states((low_state(chunk) for chunk in chunks), request_size)
+    assert [[item['arg'][1] for item in batch] for batch in batches] == expected_batches
+
+
+def test_chunk_retcodes():
+    response = {'return': [{'minion': {'retcode': 0}}, {'minion': {'retcode': 2}}, {}]}
+    # chunks without return count as failed
+    assert chunk_retcodes(response, 'minion', 4) == [0, 2, 1, 1]
+
+
+@pytest.mark.parametrize(('retcodes', 'transferred', 'expected'), [
+    # The first chunk failed, nothing was written
+    ([1], 0, ''),
+    ([1, 1], 0, ''),
+
+    # The chunks before the failed chunk were written
+    ([0, 1], 0, ' File partially transferred (1 of 6 chunks).'),
+    ([1], 3, ' File partially transferred (3 of 6 chunks).'),
+    ([0, 1, 1], 2, ' File partially transferred (3 of 6 chunks).'),
+
+    # Later chunks of the request were appended after the failed chunk
+    ([1, 0], 0, ' File corrupt: chunk 1 of 6 failed, but 1 later chunk(s) of the same request were still appended.'),
+    ([0, 1, 1, 0], 2,
+     ' File corrupt: chunk 4 of 6 failed, but 1 later chunk(s) of the same request were still appended.'),
+])
+def test_describe_failure(retcodes, transferred, expected):
+    assert describe_failure(retcodes, transferred, 6) == expected
@@ -0,0 +1,164 @@
+import io
+import time
+
+import pytest
+
+from contents.common import iter_events
+from contents.salt_inventory_daemon import SnapshotFlusher, apply_event, follow_events, load_snapshot, \
+    write_snapshot
+from contents.salt_resource_model_source import collect_event_grains
+from tests.unit.conftest import sse
+
+
+GRAINS = {'id': 'm1', 'os': 'SUSE', 'osrelease': '15', 'systemd': {'version': '249'}}
+
+
+def follow_data(fake_salt_api, snapshot, **settings):
+    data = {'url': f'http://127.0.0.1:{fake_salt_api.server_port}', 'verify_ssl': False, 'user': 'user',
+            'password': 'secret', 'eauth': 'auto', 'tgt': '*', 'snapshot': str(snapshot), 'flush-interval': 60,
+            'read-timeout': 300, 'backfill-interval': 600}
+    data.update(settings)
+    return data
+
+
+def test_iter_events():
+    events = [{'tag': 'salt/auth', 'data': {'id': 'm1'}}, {'tag': 'salt/minion/m1/start', 'data': {'id': 'm1'}}]
+    stream = io.BytesIO(b'retry: 400\n\n' + b''.join(sse(event) for event in events) + b'data: {"broken\n\n')
+
+    assert list(iter_events(stream)) == events
+
+
+@pytest.mark.parametrize(('event', 'expected_changed', 'expected_refresh', 'expected_minions'), [
+    # Test cases for apply_event function
+
+    # A restarted minion is asked for its grains
+    ({'tag': 'salt/minion/m3/start', 'data': {'id': 'm3'}}, False, {'m3'}, ['m1', 'm2']),
+
+    # An accepted key is asked for its grains, a deleted one is removed
+    ({'tag': 'salt/key', 'data': {'id': 'm3', 'act': 'accept'}}, False, {'m3'}, ['m1', 'm2']),
+    ({'tag': 'salt/key', 'data': {'id': 'm2', 'act': 'delete'}}, True, set(), ['m1']),
+
+    # Returns of grains.items replace the grains, returns of grains.item update them
+    ({'tag': 'salt/job/1/ret/m3', 'data': {'fun': 'grains.items', 'success': True, 'return': GRAINS}},
+     True, set(), ['m1', 'm2', 'm3']),
+    ({'tag': 'salt/job/1/ret/m1', 'data': {'fun': 'grains.item', 'success': True, 'return': {'os': 'Debian'}}},
+     True, set(), ['m1', 'm2']),
+
+    # Changed grains are collected again
+    ({'tag': 'salt/job/1/ret/m2', 'data': {'fun': 'saltutil.refresh_grains', 'success': True, 'return': True}},
+     False, {'m2'}, ['m1', 'm2']),
+
+    # Unrelated and failed returns are ignored
+    ({'tag': 'salt/job/1/ret/m1', 'data': {'fun': 'test.ping', 'success': True, 'return': True}},
+     False, set(), ['m1', 'm2']),
+    ({'tag': 'salt/job/1/ret/m1', 'data': {'fun': 'grains.items', 'success': False, 'return': 'error'}},
+     False, set(), ['m1', 'm2']),
+])
+def test_apply_event(event, expected_changed, expected_refresh, expected_minions):
+    index = {'updated': 0, 'minions': {'m1': {'grains': GRAINS, 'updated': 0}, 'm2': {'grains': {}, 'updated': 0}}}
+
+    assert apply_event(index, event, 1) == (expected_changed, expected_refresh)
+    assert sorted(index['minions']) == expected_minions
+    if event['data'].get('fun') == 'grains.item':
+        assert index['minions']['m1']['grains'] == dict(GRAINS, os='Debian')
+
+
+def test_follow_events(fake_salt_api, tmp_path):
+    snapshot = tmp_path / 'inventory.json'
+    fake_salt_api.events = [
+        {'tag': 'salt/job/1/ret/m1', 'data': {'fun': 'grains.items', 'success': True, 'return': GRAINS}},
+        {'tag': 'salt/job/1/ret/m2', 'data': {'fun': 'grains.items', 'success': True,
+                                              'return': dict(GRAINS, id='m2', os='Debian')}},
+        {'tag': 'salt/minion/m2/start', 'data': {'id': 'm2'}},
+    ]
+    data = follow_data(fake_salt_api, snapshot)
+    # m3 was deleted while disconnected
+    index = {'updated': 0, 'minions': {'m3': {'grains': GRAINS, 'updated': 0}}}
+
+    # the snapshot is written when the stream ends
+    assert follow_events(data, index, SnapshotFlusher(str(snapshot), index, 60)) == 3
+
+    assert sorted(index['minions']) == ['m1', 'm2']
+    assert load_snapshot(str(snapshot)) == index
+
+    requests = fake_salt_api.requests
+    assert requests[1] == ('/events', 'abc', 'text/event-stream')
+    published = [request[0] for path, token, request in requests if path == '/' and token == 'abc']
+    assert published[0] == {'client': 'wheel', 'fun': 'key.list', 'match': 'accepted'}
+    # backfill after subscribing and refresh after the restart
+    assert published[1:] == [
+        {'client': 'local_async', 'tgt': '*', 'fun': 'grains.items'},
+        {'client': 'local_async', 'tgt': 'm2', 'fun': 'grains.items', 'tgt_type': 'list'},
+    ]
+
+    # the snapshot is read by the resource model source
+    minions = collect_event_grains({'inventory-snapshot': str(snapshot), 'inventory-max-age': 900, 'tgt': 'm*',
+                                    'tags': None, 'attributes': 'systemd:version'}, {'os', 'systemd:version'})
+    assert minions['m1'] == {'ret': {'os': 'SUSE', 'systemd:version': '249'}, 'retcode': 0}
+    assert minions['m2']['ret']['os'] == 'Debian'
+
+
+def test_follow_events_read_timeout(fake_salt_api, tmp_path):
+    snapshot = tmp_path / 'inventory.json'
+    fake_salt_api.silence = 10
+    data = follow_data(fake_salt_api, snapshot, **{'read-timeout': 1})
+    # all minions were asked for their grains recently
+    index = {'updated': 0, 'backfilled': time.time(), 'minions': {}}
+
+    # the silent stream is given up after the read timeout
+    start = time.monotonic()
+    assert follow_events(data, index, SnapshotFlusher(str(snapshot), index, 60)) == 0
+    assert time.monotonic() - start < 5
+
+    # the backfill is not repeated within the backfill interval
+    published = [request[0] for path, token, request in fake_salt_api.requests if path == '/' and token == 'abc']
+    assert published == [{'client': 'wheel', 'fun': 'key.list', 'match': 'accepted'}]
+
+    # the snapshot records the stream alive
+    assert load_snapshot(str(snapshot))['alive'] >= start - 1
+
+
+def test_snapshot_flusher(tmp_path):
+    snapshot = tmp_path / 'inventory.json'
+    index = {'updated': 0, 'minions': {}}
+    flusher = SnapshotFlusher(str(snapshot), index, 0.05)
+    flusher.start()
+
+    with flusher.lock:
+        index['minions']['m1'] = {'grains': GRAINS, 'updated': 1}
+        flusher.mark_changed()
+
+    # the change is written without waiting for further events
+    for _ in range(100):
+        if snapshot.exists():
+            break
+        time.sleep(0.05)
+    assert load_snapshot(str(snapshot)) == index
+
+    flusher.stop()
+    assert not flusher.is_alive()
+
+
+@pytest.mark.parametrize(('age', 'expected_os'), [
+    # a recently alive stream serves the snapshot
+    (10, 'SUSE'),
+    (3600, 'live'),
+    # snapshot of a service without heartbeat
+    (None, 'live'),
+])
+def test_collect_event_grains_max_age(mocker, tmp_path, age, expected_os):
+    snapshot = tmp_path / 'inventory.json'
+    index = {'updated': 0, 'minions': {'m1': {'grains': GRAINS, 'updated': 0}}}
+    if age is not None:
+        index['alive'] = time.time() - age
+    write_snapshot(str(snapshot), index)
+    collect_minions_grains = mocker.patch('contents.salt_resource_model_source.collect_minions_grains',
+                                          return_value={'m1': {'ret': {'os': 'live'}, 'retcode': 0}})
+
+    data = {'inventory-snapshot': str(snapshot), 'inventory-max-age': 900, 'tgt': '*', 'tags': None,
+            'attributes': None}
+    minions = collect_event_grains(data, {'os'})
+
+    # a stale snapshot falls back to the minions
+    assert minions['m1']['ret']['os'] == expected_os
+    assert collect_minions_grains.called == (expected_os == 'live')
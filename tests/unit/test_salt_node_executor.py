@@ -0,0 +1,142 @@
+import base64
+import gzip
+import io
+import os
+import subprocess
+
+import pytest
+
+from contents.salt_node_executor import bound_output, compressed_command, decode_compressed_output, \
+    prune_spill_files, run_all_return, run_with_timeout, spill_output
+
+
+@pytest.mark.parametrize(('output', 'limit', 'spill_path', 'expected'), [
+    # Head and tail share the limit
+    ('aaaabbbbcc', 4, '/tmp/spill.log',
+     'aa\n... 6 of 10 bytes omitted, the complete output is in /tmp/spill.log ...\ncc'),
+    ('aaaabbbbcc', 5, '/tmp/spill.log',
+     'aa\n... 5 of 10 bytes omitted, the complete output is in /tmp/spill.log ...\nbcc'),
+
+    # Without spill file only the omitted bytes are noted
+    ('aaaabbbbcc', 4, None, 'aa\n... 6 of 10 bytes omitted ...\ncc'),
+
+    # Characters cut in half at the edges are dropped
+    ('äöüß', 3, None, '\n... 5 of 8 bytes omitted ...\nß'),
+    ('äöüß', 4, None, 'ä\n... 4 of 8 bytes omitted ...\nß'),
+])
+def test_bound_output(output, limit, spill_path, expected):
+    assert bound_output(output, limit, spill_path) == expected
+
+
+def test_spill_output(tmp_path):
+    spill_dir = tmp_path / 'spill'
+
+    first = spill_output('complete output\n', str(spill_dir), 'minion.example.org')
+    second = spill_output('ä' * 10, str(spill_dir), 'minion.example.org')
+
+    assert first != second
+    assert spill_dir.joinpath(first).read_text(encoding='utf-8') == 'complete output\n'
+    assert spill_dir.joinpath(second).read_text(encoding='utf-8') == 'ä' * 10
+    assert all(path.name.startswith('salt-node-executor-minion.example.org-') for path in spill_dir.iterdir())
+
+
+def test_prune_spill_files(tmp_path):
+    spill_files = [tmp_path / f'salt-node-executor-minion-{index}.log' for index in range(4)]
+    for mtime, path in enumerate(spill_files):
+        path.write_text('output', encoding='utf-8')
+        os.utime(path, (mtime, mtime))
+    other = tmp_path / 'other.log'
+    other.write_text('other', encoding='utf-8')
+
+    prune_spill_files(str(tmp_path), 2)
+
+    # only the latest spill files are kept, other files are left alone
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        'other.log', 'salt-node-executor-minion-2.log', 'salt-node-executor-minion-3.log']
+
+
+@pytest.mark.parametrize(('ret', 'expected'), [
+    ({'pid': 1, 'retcode': 0, 'stdout': 'out', 'stderr': ''}, {'ret': 'out', 'retcode': 0}),
+    ({'pid': 1, 'retcode': 2, 'stdout': 'out', 'stderr': 'err'}, {'ret': 'out\nerr', 'retcode': 2}),
+    ("'cmd.run_all' is not available.", {'ret': "'cmd.run_all' is not available.", 'retcode': 1}),
+])
+def test_run_all_return(ret, expected):
+    assert run_all_return(ret) == expected
+
+
+@pytest.mark.parametrize(('polls', 'timeout', 'expected', 'expected_lookups'), [
+    # The command returns before the timeout
+    ([{}, {'minion': {'pid': 1, 'retcode': 3, 'stdout': 'out', 'stderr': ''}}], 10,
+     {'ret': 'out', 'retcode': 3}, 2),
+
+    # The command is killed after the timeout
+    ([{}, {}, {}, {}, {}], 3.5, None, 3),
+])
+def test_run_with_timeout(mocker, polls, timeout, expected, expected_lookups):
+    clock = iter(range(100))
+    mocker.patch('contents.salt_node_executor.time.monotonic', side_effect=lambda: float(next(clock)))
+    mocker.patch('contents.salt_node_executor.time.sleep')
+    job = {'return': [{'jid': '20240101', 'minions': ['minion']}]}
+    client = mocker.Mock()
+    client.low.side_effect = [job] + [{'return': [poll]} for poll in polls[:expected_lookups]] + [{'return': [{}]}]
+
+    low_state = {'client': 'local', 'tgt': 'minion', 'fun': 'cmd.run', 'arg': ['sleep 60'], 'full_return': True,
+                 'gather_job_timeout': 5}
+    assert run_with_timeout(client, low_state, 'minion', timeout) == expected
+
+    calls = [call.kwargs['lowstate'][0] for call in client.low.call_args_list]
+    assert calls[0] == {'client': 'local_async', 'tgt': 'minion', 'fun': 'cmd.run_all',
+                        'arg': ['sleep 60', 'redirect_stderr=True']}
+    assert calls[1:1 + expected_lookups] == [
+        {'client': 'runner', 'fun': 'jobs.lookup_jid', 'jid': '20240101'}] * expected_lookups
+    if expected is None:
+        assert calls[-1] == {'client': 'local', 'tgt': 'minion', 'fun': 'saltutil.kill_job', 'arg': ['20240101']}
+    else:
+        assert len(calls) == 1 + expected_lookups
+
+
+def test_run_with_timeout_not_targeted(mocker):
+    client = mocker.Mock()
+    client.low.return_value = {'return': [{'jid': '20240101', 'minions': []}]}
+
+    low_state = {'client': 'local', 'tgt': 'minion', 'fun': 'cmd.run', 'arg': ['true'], 'full_return': True}
+    assert run_with_timeout(client, low_state, 'minion', 10) == {}
+    assert client.low.call_count == 1
+
+
+@pytest.mark.parametrize('command', [
+    'echo hello',
+    'printf "no trailing newline"',
+    'printf "trailing blanks\\n\\n  \\n"',
+    'echo out; echo err >&2; exit 3',
+    'exit 7',
+    'seq 1 50000  # a comment',
+])
+@pytest.mark.parametrize('read_size', [10, 65536])
+def test_compressed_command(command, read_size):
+    plain = subprocess.run(['sh', '-c', command], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    compressed = subprocess.run(['sh', '-c', compressed_command(command)], capture_output=True, text=True)
+    assert compressed.returncode == 0
+
+    out = io.BytesIO()
+    assert decode_compressed_output(compressed.stdout, out, read_size) == plain.returncode
+    assert out.getvalue() == plain.stdout.rstrip()
+
+
+@pytest.mark.parametrize('encoded', [
+    # Not base64
+    'not base64!',
+
+    # Not gzip compressed
+    base64.b64encode(b'plain output').decode(),
+
+    # Truncated
+    base64.b64encode(gzip.compress(b'output\n__rundeck_salt_retcode__ 0\n'))[:-8].decode(),
+
+    # Without trailer
+    base64.b64encode(gzip.compress(b'output\n')).decode(),
+    '',
+])
+def test_decode_compressed_output_invalid(encoded):
+    with pytest.raises(ValueError):
+        decode_compressed_output(encoded, io.BytesIO())
@@ -1,6 +1,22 @@
+import io
+import json
+import os
+import re
+import time
+
 import pytest
+from pepper.exceptions import PepperException
+
+import contents.salt_resource_model_source
 
-from contents.salt_resource_model_source import string_to_unique_set, prepare_grains, process_tags, process_attributes
+from contents.salt_resource_model_source import string_to_unique_set, prepare_grains, process_tags, process_attributes, \
+    update_grains_cache, cached_minions, generate_resource_model, grains_cache_path, load_grains_cache, \
+    write_grains_cache, project_grains, collect_master_cache_grains, minion_shards, collect_sharded_grains, \
+    iter_resource_model, write_resource_model, prepare_pillar, merge_pillar_returns, collect_minions_grains, \
+    compile_extraction_plan, extract_tags, extract_attributes, master_configurations, sanitize_masters, \
+    collect_federated_resource_model, collect_async_grains, narrow_target, live_minions, hash_nodes, record_changes, \
+    read_minion_data, collect_local_cache_grains, spawn_background_refresh, report_refresh_error, \
+    refresh_grains_cache
 
 
 @pytest.mark.parametrize(('input_str', 'expected_set'), [
@@ -30,6 +46,10 @@ def test_string_to_unique_set(input_str, expected_set):
 
     # Tags and attributes with multiple values return set with default keys and those values
     ({'tags': 'abc', 'attributes': 'a,b'}, set(['id', 'cpuarch', 'os', 'os_family', 'osrelease', 'hostname', 'abc', 'a', 'b'])),
+
+    # Pillar keys are not requested as grains
+    ({'tags': 'pillar:roles', 'attributes': 'a,pillar:owner'},
+     set(['id', 'cpuarch', 'os', 'os_family', 'osrelease', 'hostname', 'a'])),
 ])
 def test_prepare_grains(input_data, expected_set):
     assert prepare_grains(input_data) == expected_set
@@ -102,3 +122,593 @@ def test_process_tags(input_data, needed_tags, expected_list):
 def test_process_attributes(input_data, needed_attributes, reserved_keys, expected_list):
     assert process_attributes(input_data, needed_attributes, reserved_keys) == expected_list
 
+
+@pytest.mark.parametrize(('cache', 'minions', 'expected_minions'), [
+    # Test cases for update_grains_cache function
+
+    # Answering minions are added to the cache
+    ({'refreshed': None, 'minions': {}},
+     {'m1': {'ret': {'os': 'SUSE'}, 'retcode': 0}},
+     {'m1': {'last_seen': 100, 'grains': {'os': 'SUSE'}}}),
+
+    # Minions without parsable return keep their previous grains
+    ({'refreshed': 90, 'minions': {'m1': {'last_seen': 90, 'grains': {'os': 'SUSE'}}}},
+     {'m1': False},
+     {'m1': {'last_seen': 90, 'grains': {'os': 'SUSE'}}}),
+
+    # Minions not seen for longer than the expiry are removed
+    ({'refreshed': 90, 'minions': {'m1': {'last_seen': 10, 'grains': {}}, 'm2': {'last_seen': 90, 'grains': {}}}},
+     {},
+     {'m2': {'last_seen': 90, 'grains': {}}}),
+])
+def test_update_grains_cache(cache, minions, expected_minions):
+    updated = update_grains_cache(cache, minions, 100, 60)
+    assert updated['minions'] == expected_minions
+    assert updated['refreshed'] == 100
+
+
+def test_stale_minions_from_grains_cache():
+    grains = {'cpuarch': 'x86_64', 'os': 'SUSE', 'osrelease': '15', 'os_family': 'Suse'}
+    cache = {
+        'refreshed': 100,
+        'minions': {
+            'fresh': {'last_seen': 100, 'grains': grains},
+            'stale': {'last_seen': 40, 'grains': grains},
+        },
+    }
+
+    minions = cached_minions(cache, 130)
+    assert minions['fresh'] == {'ret': grains, 'retcode': 0}
+    assert minions['stale'] == {'ret': grains, 'retcode': 0, 'stale': 90}
+
+    model = generate_resource_model(minions, {'prefix': None, 'tags': None, 'attributes': None})
+    assert model['fresh']['tags'] == []
+    assert 'salt-stale-age' not in model['fresh']
+    assert model['stale']['tags'] == ['salt-stale']
+    assert model['stale']['salt-stale-age'] == '90'
+
+
+def test_grains_cache_roundtrip(tmp_path):
+    data = {'url': 'http://localhost:8000', 'tgt': '*', 'cache-dir': str(tmp_path / 'cache')}
+    path = grains_cache_path(data, {'os', 'id'})
+
+    assert load_grains_cache(path) == {'refreshed': None, 'minions': {}}
+
+    cache = {'refreshed': 100, 'minions': {'m1': {'last_seen': 100, 'grains': {'os': 'SUSE'}}}}
+    write_grains_cache(path, cache)
+    assert load_grains_cache(path) == cache
+
+    # a different configuration uses its own cache file
+    assert grains_cache_path(dict(data, tgt='web*'), {'os', 'id'}) != path
+
+
+def test_background_refresh_failure(mocker, tmp_path, caplog):
+    path = str(tmp_path / 'grains.json')
+    mocker.patch('contents.salt_resource_model_source.collect_grains',
+                 side_effect=PepperException('Authentication denied'))
+
+    spawn_background_refresh({'refresh-budget': 60}, {'os'}, path)
+    for _ in range(100):
+        if os.path.exists(f'{path}.error'):
+            break
+        time.sleep(0.05)
+
+    # the failure of the detached child is reported by the next run
+    report_refresh_error(path, time.time() - 3600, time.time())
+    assert re.search(r'failed \d+ seconds ago: Authentication denied', caplog.text)
+    assert 'refreshed 3600 seconds ago' in caplog.text
+
+    # a successful refresh clears the error
+    mocker.patch('contents.salt_resource_model_source.collect_grains', return_value={})
+    refresh_grains_cache({'cache-expiry': 60}, {'os'}, path)
+    caplog.clear()
+    report_refresh_error(path, time.time(), time.time())
+    assert not caplog.text
+
+
+@pytest.mark.parametrize(('grains', 'key', 'expected'), [
+    # Test cases for project_grains function
+
+    # Plain key
+    ({'os': 'SUSE'}, 'os', 'SUSE'),
+
+    # Missing key returns an empty string like grains.item
+    ({'os': 'SUSE'}, 'missing', ''),
+
+    # Nested key
+    ({'systemd': {'version': '249'}}, 'systemd:version', '249'),
+
+    # Nested key within list
+    ({'ip_interfaces': {'eth0': ['10.0.0.1', '10.0.0.2']}}, 'ip_interfaces:eth0:1', '10.0.0.2'),
+
+    # Nested key within embedded dict of list
+    ({'disks': [{'sda': 'ssd'}, {'sdb': 'hdd'}]}, 'disks:sdb', 'hdd'),
+
+    # Nested key below a scalar value
+    ({'os': 'SUSE'}, 'os:version', ''),
+])
+def test_project_grains(grains, key, expected):
+    assert project_grains(grains, {key}) == {key: expected}
+
+
+def test_collect_master_cache_grains(mocker):
+    data = {'tgt': '*', 'timeout': None, 'gather-timeout': None, 'cache-fallback': True}
+    cached = {
+        'm1': {'os': 'SUSE', 'kernel': 'Linux', 'systemd': {'version': '249'}},
+        'm2': {},
+    }
+    live = {'m2': {'ret': {'os': 'Debian', 'systemd:version': ''}, 'retcode': 0}}
+
+    mocker.patch('contents.salt_resource_model_source.api_login')
+    send_low_states = mocker.patch(
+        'contents.salt_resource_model_source.send_low_states',
+        side_effect=[{'return': [cached]}, {'return': [live]}],
+    )
+
+    minions = collect_master_cache_grains(data, {'os', 'systemd:version'})
+
+    assert minions == {
+        'm1': {'ret': {'os': 'SUSE', 'systemd:version': '249'}, 'retcode': 0},
+        'm2': {'ret': {'os': 'Debian', 'systemd:version': ''}, 'retcode': 0},
+    }
+
+    runner_low_state = send_low_states.call_args_list[0].args[1][0]
+    assert runner_low_state == {'client': 'runner', 'fun': 'cache.grains', 'tgt': '*'}
+
+    # minions missing from the cache are targeted directly
+    fallback_low_state = send_low_states.call_args_list[1].args[1][0]
+    assert fallback_low_state['tgt'] == '* and not L@m1'
+    assert fallback_low_state['tgt_type'] == 'compound'
+
+
+@pytest.mark.parametrize(('data', 'accepted', 'expected_shards'), [
+    # Test cases for minion_shards function
+
+    # Accepted minions matching the target are split into list targets
+    ({'tgt': '*', 'shard-size': 2, 'shard-targets': None}, ['m3', 'm1', 'm2'],
+     [('m1,m2', 'list'), ('m3', 'list')]),
+
+    # Minions not matching the glob target are left out
+    ({'tgt': 'web*', 'shard-size': 2, 'shard-targets': None}, ['web1', 'db1', 'web2', 'web3'],
+     [('web1,web2', 'list'), ('web3', 'list')]),
+
+    # No matching minions return no shards
+    ({'tgt': 'web*', 'shard-size': 2, 'shard-targets': None}, ['db1'], []),
+
+    # Shard targets are used as compound targets
+    ({'tgt': '*', 'shard-size': None, 'shard-targets': 'N@web; N@db;'}, [],
+     [('N@web', 'compound'), ('N@db', 'compound')]),
+])
+def test_minion_shards(mocker, data, accepted, expected_shards):
+    mocker.patch('contents.salt_resource_model_source.list_accepted_minions', return_value=accepted)
+    assert minion_shards(data, None) == expected_shards
+
+
+def test_collect_sharded_grains(mocker):
+    data = {'tgt': '*', 'shard-size': 1, 'shard-targets': None, 'shard-parallelism': 2, 'presence': None}
+
+    def shard_returns(requests, concurrency):
+        assert concurrency == 2
+        # the shards complete in reverse order
+        for position, request in reversed(list(enumerate(requests))):
+            tgt = request[0]['tgt']
+            if tgt == 'm2':
+                yield position, PepperException('Server error.')
+            else:
+                yield position, {'return': [{tgt: {'ret': {'id': tgt}, 'retcode': 0}}]}
+
+    api_login = mocker.patch('contents.salt_resource_model_source.api_login')
+    api_login.return_value.low_as_completed.side_effect = shard_returns
+    mocker.patch('contents.salt_resource_model_source.list_accepted_minions', return_value=['m1', 'm2', 'm3'])
+    mocker.patch('contents.salt_resource_model_source.minions_low_states',
+                 side_effect=lambda data, tgt, all_needed_grains, tgt_type: [{'tgt': tgt, 'tgt_type': tgt_type}])
+
+    # the failed shard does not affect the others
+    assert collect_sharded_grains(data, {'id'}) == {
+        'm1': {'ret': {'id': 'm1'}, 'retcode': 0},
+        'm3': {'ret': {'id': 'm3'}, 'retcode': 0},
+    }
+
+
+def test_write_resource_model():
+    data = {'prefix': 'salt-', 'tags': 'roles', 'attributes': 'os,hostname'}
+    grains = {'cpuarch': 'AMD64', 'os': 'Windows', 'osrelease': '2022', 'os_family': 'Windows',
+              'roles': ['web'], 'hostname': 'mïnion'}
+    minions = {'m1': {'ret': grains, 'retcode': 0}, 'm2': False, 'm3': {'ret': grains, 'retcode': 0}}
+
+    resource_model = generate_resource_model(minions, data)
+    assert list(resource_model) == ['salt-m1', 'salt-m3']
+
+    out = io.StringIO()
+    write_resource_model(iter_resource_model(minions.items(), data), out)
+    assert out.getvalue() == json.dumps(resource_model, separators=(',', ':')) + '\n'
+
+    out = io.StringIO()
+    write_resource_model(iter([]), out)
+    assert json.loads(out.getvalue()) == {}
+
+
+@pytest.mark.parametrize(('input_data', 'expected_set'), [
+    # Test cases for prepare_pillar function
+
+    # Empty input returns an empty set
+    ({}, set()),
+
+    # Grains are not requested from the pillar
+    ({'tags': 'abc', 'attributes': 'a,b'}, set()),
+
+    # Pillar keys of tags and attributes without prefix
+    ({'tags': 'pillar:roles,abc', 'attributes': 'pillar:owner,pillar:roles,pillar:nested:key'},
+     set(['roles', 'owner', 'nested:key'])),
+])
+def test_prepare_pillar(input_data, expected_set):
+    assert prepare_pillar(input_data) == expected_set
+
+
+@pytest.mark.parametrize(('returns', 'expected_minions'), [
+    # Test cases for merge_pillar_returns function
+
+    # Grains only
+    ([{'m1': {'ret': {'os': 'SUSE'}, 'retcode': 0}}],
+     {'m1': {'ret': {'os': 'SUSE'}, 'retcode': 0}}),
+
+    # Pillar keys are merged with prefix
+    ([{'m1': {'ret': {'os': 'SUSE'}, 'retcode': 0}},
+      {'m1': {'ret': {'owner': 'ops', 'roles': ['web']}, 'retcode': 0}}],
+     {'m1': {'ret': {'os': 'SUSE', 'pillar:owner': 'ops', 'pillar:roles': ['web']}, 'retcode': 0}}),
+
+    # Minions without pillar return keep their grains
+    ([{'m1': {'ret': {'os': 'SUSE'}, 'retcode': 0}, 'm2': False},
+      {'m1': False, 'm3': {'ret': {'owner': 'ops'}, 'retcode': 0}}],
+     {'m1': {'ret': {'os': 'SUSE'}, 'retcode': 0}, 'm2': False}),
+])
+def test_merge_pillar_returns(returns, expected_minions):
+    assert merge_pillar_returns(returns) == expected_minions
+
+
+def test_collect_minions_grains_and_pillar(mocker):
+    data = {'tgt': 'web*', 'presence': None, 'tags': 'pillar:roles', 'attributes': 'os,pillar:owner', 'timeout': 5,
+            'gather-timeout': None}
+    grains = {'m1': {'ret': {'os': 'SUSE'}, 'retcode': 0}}
+    pillar = {'m1': {'ret': {'owner': 'ops', 'roles': ['web', 'db']}, 'retcode': 0}}
+
+    mocker.patch('contents.salt_resource_model_source.api_login')
+    send_low_states = mocker.patch('contents.salt_resource_model_source.send_low_states',
+                                   return_value={'return': [grains, pillar]})
+
+    minions = collect_minions_grains(data, prepare_grains(data))
+
+    assert minions['m1']['ret'] == {'os': 'SUSE', 'pillar:owner': 'ops', 'pillar:roles': ['web', 'db']}
+    assert process_tags(minions['m1']['ret'], string_to_unique_set(data['tags'])) == {'web', 'db'}
+
+    # grains and pillar are collected in a single request
+    send_low_states.assert_called_once()
+    low_states = send_low_states.call_args.args[1]
+    assert [low_state['fun'] for low_state in low_states] == ['grains.item', 'pillar.item']
+    assert sorted(low_states[1]['arg']) == ['owner', 'roles']
+    assert low_states[1]['tgt'] == 'web*'
+    assert low_states[1]['kwarg'] == {'timeout': 5}
+
+
+def test_compile_extraction_plan():
+    plan = compile_extraction_plan({'tags': 'roles,os', 'attributes': 'systemd:version,hostname'})
+
+    assert plan.tags == [('os', ['os']), ('roles', ['roles'])]
+    assert plan.attributes == [('salt-hostname', 'hostname', ['hostname']),
+                               ('systemd:version', 'systemd:version', ['systemd', 'version'])]
+
+
+@pytest.mark.parametrize('grains', [
+    # Return of grains.item with the requested keys
+    {'roles': ['web', 'db'], 'systemd:version': '249', 'hostname': 'minion'},
+
+    # Complete grains resolved along the key paths
+    {'roles': ['web', 'db'], 'systemd': {'version': '249'}, 'hostname': 'minion'},
+])
+def test_extraction_plan_key_paths(grains):
+    plan = compile_extraction_plan({'tags': 'roles', 'attributes': 'systemd:version,hostname'})
+
+    assert extract_tags(grains, plan.tags) == {'web', 'db'}
+    assert extract_attributes(grains, plan.attributes) == {'systemd:version': '249', 'salt-hostname': 'minion'}
+
+
+def test_master_configurations():
+    data = {'url': 'https://salt:8000', 'user': 'rundeck', 'password': 'secret', 'tgt': '*', 'prefix': None,
+            'masters': '[{"url": "https://salt1:8000", "prefix": "dc1-"}, {"url": "https://salt2:8000", "tgt": "web*"}]'}
+
+    configurations = master_configurations(data)
+
+    assert [(c['url'], c['user'], c['password'], c['tgt'], c['prefix']) for c in configurations] == [
+        ('https://salt1:8000', 'rundeck', 'secret', '*', 'dc1-'),
+        ('https://salt2:8000', 'rundeck', 'secret', 'web*', None),
+    ]
+    assert all(configuration['masters'] is None for configuration in configurations)
+
+
+def test_master_configurations_passwords():
+    data = {'url': 'https://salt:8000', 'password': 'secret', 'masters': '[{"url": "https://salt1:8000"}, {}]',
+            'masters-passwords': '{"https://salt1:8000": "secret1"}'}
+
+    configurations = master_configurations(data)
+
+    # masters not listed in the passwords use the source's password
+    assert [(c['url'], c['password']) for c in configurations] == [
+        ('https://salt1:8000', 'secret1'),
+        ('https://salt:8000', 'secret'),
+    ]
+    assert all(configuration['masters-passwords'] is None for configuration in configurations)
+
+
+@pytest.mark.parametrize(('masters', 'expected'), [
+    (None, None),
+    ('[{"url": "https://salt1:8000", "password": "secret1"}, {"url": "https://salt2:8000"}]',
+     '[{"url":"https://salt1:8000","password":"********"},{"url":"https://salt2:8000"}]'),
+    ('[{"url": "https://salt1:8000", "password": "secret1"', '********'),
+])
+def test_sanitize_masters(masters, expected):
+    assert sanitize_masters(masters) == expected
+
+
+@pytest.mark.parametrize('masters', ['{"url": "https://salt1:8000"}', '[{"url": "https://salt1:8000", "foo": 1}]', '[',
+                                     '[{"url": "https://salt1:8000", "password": "secret1"}]', '[]', ' [ ] '])
+def test_invalid_master_configurations(masters):
+    with pytest.raises(SystemExit):
+        master_configurations({'masters': masters})
+
+
+def test_collect_federated_resource_model(mocker):
+    grains = {'cpuarch': 'x86_64', 'os': 'SUSE', 'osrelease': '15', 'os_family': 'Suse'}
+    returns = {
+        'https://salt1:8000': {'m1': {'ret': grains, 'retcode': 0}, 'm2': {'ret': grains, 'retcode': 0}},
+        'https://salt2:8000': {'m2': {'ret': dict(grains, os='Debian'), 'retcode': 0}},
+        'https://salt3:8000': {'m2': {'ret': grains, 'retcode': 0}},
+        'https://salt4:8000': PepperException('Authentication denied'),
+    }
+    mocker.patch('contents.salt_resource_model_source.collect_grains',
+                 side_effect=lambda data, all_needed_grains: returns[data['url']]
+                 if isinstance(returns[data['url']], dict) else (_ for _ in ()).throw(returns[data['url']]))
+
+    base = {'tags': None, 'attributes': None, 'prefix': None}
+    masters = [
+        dict(base, url='https://salt1:8000'),
+        dict(base, url='https://salt2:8000'),
+        dict(base, url='https://salt3:8000', prefix='dc3-'),
+        dict(base, url='https://salt4:8000'),
+    ]
+
+    resource_model = collect_federated_resource_model(masters)
+
+    # duplicate nodes of later masters are skipped, prefixed nodes are kept
+    assert list(resource_model) == ['m1', 'm2', 'dc3-m2']
+    assert resource_model['m2']['osName'] == 'SUSE'
+
+    # collecting failed on all masters
+    assert collect_federated_resource_model(masters[3:]) is None
+
+
+@pytest.mark.parametrize(('answered_percent', 'async_deadline', 'expected_minions', 'expected_polls'), [
+    # Polling stops once all minions answered
+    (100, 60, ['m1', 'm2', 'm3'], 3),
+
+    # Polling stops once the answered percentage is reached
+    (60, 60, ['m1', 'm2'], 2),
+
+    # Minions which did not answer before the deadline are left out
+    (100, 0.5, ['m1', 'm2'], 2),
+])
+def test_collect_async_grains(mocker, answered_percent, async_deadline, expected_minions, expected_polls):
+    data = {'tgt': '*', 'tags': None, 'attributes': 'pillar:owner', 'timeout': None, 'gather-timeout': None,
+            'presence': None, 'answered-percent': answered_percent, 'async-deadline': async_deadline}
+    grains = {'m1': {'os': 'SUSE'}, 'm2': {'os': 'Debian'}, 'm3': {'os': 'Ubuntu'}}
+    pillar = {'m1': {'owner': 'ops'}, 'm2': {'owner': 'dev'}, 'm3': {'owner': 'qa'}}
+    # m1 answers the first poll, m2 the second and m3 the third; the pillar
+    # of m2 lags behind its grains
+    polls = [
+        {'return': [{'m1': grains['m1'], 'm2': grains['m2']}, {'m1': pillar['m1']}]},
+        {'return': [{'m1': grains['m1'], 'm2': grains['m2']}, {'m1': pillar['m1'], 'm2': pillar['m2']}]},
+        {'return': [grains, pillar]},
+    ]
+    jobs = {'return': [{'jid': '1', 'minions': ['m1', 'm2', 'm3']}, {'jid': '2', 'minions': ['m1', 'm2', 'm3']}]}
+
+    clock = iter(range(100))
+    mocker.patch('contents.salt_resource_model_source.time.monotonic', side_effect=lambda: next(clock) * 0.2)
+    mocker.patch('contents.salt_resource_model_source.time.sleep')
+    mocker.patch('contents.salt_resource_model_source.api_login')
+    send_low_states = mocker.patch('contents.salt_resource_model_source.send_low_states',
+                                   side_effect=[jobs] + polls)
+
+    minions = collect_async_grains(data, prepare_grains(data))
+
+    assert sorted(minions) == expected_minions
+    assert minions['m1'] == {'ret': {'os': 'SUSE', 'pillar:owner': 'ops'}, 'retcode': 0}
+    assert send_low_states.call_count == 1 + expected_polls
+
+    published = send_low_states.call_args_list[0].args[1]
+    assert [(low_state['client'], low_state['fun']) for low_state in published] == [
+        ('local_async', 'grains.item'), ('local_async', 'pillar.item')]
+    assert send_low_states.call_args_list[1].args[1] == [
+        {'client': 'runner', 'fun': 'jobs.lookup_jid', 'jid': '1'},
+        {'client': 'runner', 'fun': 'jobs.lookup_jid', 'jid': '2'},
+    ]
+
+
+def test_collect_async_grains_publish_failed(mocker):
+    data = {'tgt': '*', 'tags': None, 'attributes': None, 'timeout': None, 'gather-timeout': None,
+            'presence': None, 'answered-percent': 100, 'async-deadline': 60}
+    mocker.patch('contents.salt_resource_model_source.api_login')
+    mocker.patch('contents.salt_resource_model_source.send_low_states', return_value={'return': [{}]})
+
+    with pytest.raises(PepperException):
+        collect_async_grains(data, prepare_grains(data))
+
+
+@pytest.mark.parametrize(('tgt', 'tgt_type', 'live', 'expected_target'), [
+    # Test cases for narrow_target function
+
+    # Presence filtering disabled
+    ('web*', None, None, ('web*', None)),
+
+    # All minions are narrowed to a list target of the live minions
+    ('*', None, {'m2', 'm1'}, ('m1,m2', 'list')),
+
+    # List targets are intersected with the live minions
+    ('m1,m2,m3', 'list', {'m2', 'm3', 'm4'}, ('m2,m3', 'list')),
+    ('m1', 'list', {'m2'}, None),
+
+    # Other targets are intersected in a compound target
+    ('web*', None, {'web1', 'db1'}, ('( web* ) and L@db1,web1', 'compound')),
+    ('N@web', 'compound', {'web1'}, ('( N@web ) and L@web1', 'compound')),
+
+    # No live minions
+    ('*', None, set(), None),
+])
+def test_narrow_target(tgt, tgt_type, live, expected_target):
+    assert narrow_target(tgt, tgt_type, live) == expected_target
+
+
+@pytest.mark.parametrize(('presence', 'expected_low_state'), [
+    ('manage.up', {'client': 'runner', 'fun': 'manage.up', 'tgt': 'web*', 'timeout': 5}),
+    ('manage.alived', {'client': 'runner', 'fun': 'manage.alived'}),
+])
+def test_live_minions_cached(mocker, tmp_path, presence, expected_low_state):
+    data = {'url': 'http://localhost:8000', 'tgt': 'web*', 'timeout': 5, 'gather-timeout': None,
+            'presence': presence, 'presence-ttl': 60, 'cache-dir': str(tmp_path)}
+    send_low_states = mocker.patch('contents.salt_resource_model_source.send_low_states',
+                                   return_value={'return': [['web1', 'web2']]})
+
+    assert live_minions(data, None) == {'web1', 'web2'}
+    send_low_states.assert_called_once_with(None, [expected_low_state])
+
+    # served from the presence cache within its TTL
+    assert live_minions(data, None) == {'web1', 'web2'}
+    send_low_states.assert_called_once()
+
+    # asked again once the TTL expired
+    data['presence-ttl'] = 0
+    assert live_minions(data, None) == {'web1', 'web2'}
+    assert send_low_states.call_count == 2
+
+
+def test_collect_minions_grains_live_minions(mocker):
+    data = {'tgt': '*', 'presence': 'manage.alived', 'presence-ttl': 60, 'cache-dir': None, 'tags': None,
+            'attributes': None, 'timeout': None, 'gather-timeout': None}
+
+    mocker.patch('contents.salt_resource_model_source.api_login')
+    send_low_states = mocker.patch('contents.salt_resource_model_source.send_low_states',
+                                   side_effect=[{'return': [['m2', 'm1']]}, {'return': [{}]}])
+
+    collect_minions_grains(data, prepare_grains(data))
+
+    low_state = send_low_states.call_args.args[1][0]
+    assert (low_state['tgt'], low_state['tgt_type']) == ('m1,m2', 'list')
+
+
+def test_record_changes(tmp_path):
+    change_log = tmp_path / 'changes.jsonl'
+    first = {
+        'm1': {'nodename': 'm1', 'osName': 'SUSE', 'tags': ['web']},
+        'm2': {'nodename': 'm2', 'osName': 'Debian', 'tags': []},
+    }
+    second = {
+        'm1': {'nodename': 'm1', 'osName': 'SUSE', 'tags': ['db'], 'owner': 'ops'},
+        'm3': {'nodename': 'm3', 'osName': 'Ubuntu', 'tags': []},
+    }
+
+    for now, resource_model in enumerate([first, second, second]):
+        node_hashes = {}
+        # the nodes are passed through unchanged
+        assert dict(hash_nodes(resource_model.items(), node_hashes)) == resource_model
+        record_changes(str(change_log), node_hashes, now)
+
+    records = [json.loads(line) for line in change_log.read_text().splitlines()]
+
+    assert [(record['added'], record['removed'], record['changed']) for record in records] == [
+        (['m1', 'm2'], [], {}),
+        (['m3'], ['m2'], {'m1': ['owner', 'tags']}),
+        ([], [], {}),
+    ]
+    assert records[0]['previous'] is None
+    assert records[1]['previous'] == records[0]['model'] != records[1]['model']
+    assert records[2]['model'] == records[1]['model']
+    assert [record['nodes'] for record in records] == [2, 2, 2]
+
+
+@pytest.fixture
+def minion_data_cache(tmp_path):
+    """
+    A minion data cache as kept by the master's localfs cache.
+    """
+    msgpack = pytest.importorskip('msgpack')
+    cache_dir = tmp_path / 'minions'
+    minions = {
+        'web1': {'grains': {'id': 'web1', 'os': 'SUSE', 'systemd': {'version': '254'}, 'ipv4': ['10.0.0.1'],
+                            'gpus': [{'vendor': 'unknown'}]},
+                 'pillar': {'owner': 'ops', 'secret': 'hidden'}},
+        'web2': {'grains': {'id': 'web2', 'os': 'Debian'}, 'pillar': {}},
+        'db1': {'grains': {'id': 'db1', 'os': 'Ubuntu'}, 'pillar': {'owner': 'dba'}},
+    }
+    for minion, minion_data in minions.items():
+        (cache_dir / minion).mkdir(parents=True)
+        (cache_dir / minion / 'data.p').write_bytes(msgpack.packb(minion_data, use_bin_type=True))
+
+    # a minion without cached data and a corrupt file
+    (cache_dir / 'new').mkdir()
+    (cache_dir / 'broken').mkdir()
+    (cache_dir / 'broken' / 'data.p').write_bytes(b'\xc1')
+
+    return cache_dir
+
+
+@pytest.mark.parametrize(('grain_roots', 'pillar_roots', 'expected_grains', 'expected_pillar'), [
+    ({'os', 'systemd'}, set(), {'os': 'SUSE', 'systemd': {'version': '254'}}, {}),
+    ({'id'}, {'owner'}, {'id': 'web1'}, {'owner': 'ops'}),
+    (set(), set(), {}, {}),
+])
+def test_read_minion_data(minion_data_cache, grain_roots, pillar_roots, expected_grains, expected_pillar):
+    path = minion_data_cache / 'web1' / 'data.p'
+    assert read_minion_data(str(path), grain_roots, pillar_roots) == (expected_grains, expected_pillar)
+
+
+def test_read_minion_data_invalid(minion_data_cache):
+    with pytest.raises(ValueError):
+        read_minion_data(str(minion_data_cache / 'broken' / 'data.p'), {'os'}, set())
+
+
+@pytest.mark.parametrize(('tgt', 'expected_minions'), [
+    ('*', ['db1', 'web1', 'web2']),
+    ('web*', ['web1', 'web2']),
+])
+def test_collect_local_cache_grains(minion_data_cache, tgt, expected_minions):
+    data = {'tgt': tgt, 'tags': None, 'attributes': 'systemd:version,gpus:0:vendor,pillar:owner',
+            'local-cache-dir': str(minion_data_cache), 'local-cache-index-dir': None}
+
+    minions = collect_local_cache_grains(data, prepare_grains(data))
+
+    assert sorted(minions) == expected_minions
+    assert minions['web1']['ret']['systemd:version'] == '254'
+    assert minions['web1']['ret']['gpus:0:vendor'] == 'unknown'
+    assert minions['web1']['ret']['pillar:owner'] == 'ops'
+    assert minions['web2']['ret']['pillar:owner'] == ''
+
+
+def test_collect_local_cache_grains_unchanged(mocker, minion_data_cache, tmp_path):
+    data = {'tgt': '*', 'tags': None, 'attributes': 'pillar:owner', 'local-cache-dir': str(minion_data_cache),
+            'local-cache-index-dir': str(tmp_path / 'index')}
+    all_needed_grains = prepare_grains(data)
+    read = mocker.spy(contents.salt_resource_model_source, 'read_minion_data')
+
+    first = collect_local_cache_grains(data, all_needed_grains)
+    assert read.call_count == 4
+
+    # unchanged files are not read again
+    assert collect_local_cache_grains(data, all_needed_grains) == first
+    assert read.call_count == 5
+
+    # a changed file is read again
+    data_file = minion_data_cache / 'db1' / 'data.p'
+    content = data_file.read_bytes().replace(b'dba', b'dbs')
+    data_file.write_bytes(content)
+    os.utime(data_file, ns=(0, 0))
+    minions = collect_local_cache_grains(data, all_needed_grains)
+    assert minions['db1']['ret']['pillar:owner'] == 'dbs'
+    assert read.call_count == 7
@@ -0,0 +1,56 @@
+import subprocess
+
+import pytest
+
+from contents.salt_script_step import INCOMPLETE_RETCODE, run_command, script_low_states, stage_returns
+
+
+@pytest.mark.parametrize(('content', 'size', 'interpreter', 'args', 'expected_output', 'expected_code'), [
+    # The complete script runs with its arguments
+    ('#!/bin/sh\necho "$@"\nexit 3\n', None, None, "one 'two three'", 'one two three\n', 3),
+    ('echo interpreted\n', None, 'sh', None, 'interpreted\n', 0),
+
+    # An incomplete script does not run
+    ('#!/bin/sh\necho partial\n', 100, None, None, '', INCOMPLETE_RETCODE),
+    (None, 10, None, None, '', INCOMPLETE_RETCODE),
+])
+def test_run_command(tmp_path, content, size, interpreter, args, expected_output, expected_code):
+    dest = tmp_path / 'rundeck salt script'
+    if content is not None:
+        dest.write_text(content)
+        dest.chmod(0o700)
+
+    command = run_command(str(dest), len(content) if size is None else size, interpreter, args)
+    process = subprocess.run(['sh', '-c', command], capture_output=True, text=True)
+
+    assert process.stdout == expected_output
+    assert process.returncode == expected_code
+    if expected_code == INCOMPLETE_RETCODE:
+        assert process.stderr == 'The script was not copied completely\n'
+
+
+@pytest.mark.parametrize(('size', 'chunk_size', 'request_size', 'expected_requests'), [
+    # A small script is copied and run in a single request
+    (10, 1024, 0, [['cp.recv_chunked', 'cmd.run', 'file.remove']]),
+
+    # The run travels with the final chunk
+    (2500, 1024, 0, [['cp.recv_chunked'], ['cp.recv_chunked'], ['cp.recv_chunked', 'cmd.run', 'file.remove']]),
+    (2500, 1024, 2 ** 20, [['cp.recv_chunked'] * 3 + ['cmd.run', 'file.remove']]),
+])
+def test_script_low_states(tmp_path, size, chunk_size, request_size, expected_requests):
+    src = tmp_path / 'script'
+    src.write_bytes(b'x' * size)
+
+    requests = script_low_states('minion', str(src), '/tmp/script', chunk_size, request_size, ['/tmp/script'])
+
+    assert [[low_state['fun'] for low_state in request] for request in requests] == expected_requests
+    assert requests[-1][-2]['arg'] == ['/tmp/script']
+    assert requests[-1][-1]['arg'] == ['/tmp/script']
+    assert all(low_state['tgt'] == 'minion' for request in requests for low_state in request)
+
+
+def test_stage_returns():
+    low_states = [{'fun': 'cp.recv_chunked'}, {'fun': 'cmd.run'}, {'fun': 'file.remove'}]
+    response = {'return': [{'minion': {'ret': '/tmp/script', 'retcode': 0}}, 'Unexpected error']}
+
+    assert stage_returns(low_states, response, 'minion') == [{'ret': '/tmp/script', 'retcode': 0}, {}, {}]